@@ -0,0 +1,60 @@
+# Nightly reprocessing with the flag cache (qc_cache): QCBatch on every haul against a cold cache, a warm cache and a
+# warm cache where a share of the hauls changed, with the hit/miss statistics and a check of the flags against QCBatch.
+# Usage:
+#   python benchmarks/bench_cache.py --hauls 2000 --samples 500 --changed 0.1
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from qc_batch import QCBatch
+from qc_cache import QCCache
+import synthetic
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def same(a, b):
+    return list(a.columns) == list(b.columns) and a.index.equals(b.index) and all(
+        np.array_equal(a[name].to_numpy(), b[name].to_numpy()) for name in a.columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hauls', type=int, default=2000)
+    parser.add_argument('--samples', type=int, default=500)
+    parser.add_argument('--changed', type=float, default=0.1, help='share of the hauls changed for the last run')
+    args = parser.parse_args()
+
+    df, meta = synthetic.batch(args.hauls, args.samples, seed=0, salinity=True)
+    changed = df.copy()
+    hauls = meta.index[:int(len(meta) * args.changed)]
+    changed.loc[changed['HAUL'].isin(hauls), 'TEMPERATURE'] += 0.01
+
+    ok = True
+    print('{:<16} {:>10} {:>8} {:>8} {:>10}'.format('run', 'seconds', 'hits', 'misses', 'cache MB'))
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = QCCache(os.path.join(tmp, 'flags.sqlite'))
+        for name, frame in [('QCBatch', None), ('cold cache', df), ('warm cache', df), ('changed hauls', changed)]:
+            if frame is None:
+                seconds, flags = timed(lambda: QCBatch(df, meta).flags)
+                print('{:<16} {:>10.2f}'.format(name, seconds))
+                continue
+            hits, misses = cache.hits, cache.misses
+            seconds, flags = timed(cache.run_frame, frame, meta)
+            stats = cache.stats()
+            identical = same(flags, QCBatch(frame, meta).flags)
+            ok &= identical
+            print('{:<16} {:>10.2f} {:>8} {:>8} {:>10.1f} {}'.format(name, seconds, stats['hits'] - hits,
+                                                                    stats['misses'] - misses, stats['bytes'] / 1e6,
+                                                                    '' if identical else 'FLAGS DIFFER'))
+        cache.close()
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,80 @@
+# Out-of-core QC (qc_chunked) of one long synthetic series against QC on the whole frame: time, peak memory of the
+# process and flags. Every run is done in a fresh process, so the peak memory (ru_maxrss) is the one of that run only.
+# The series has salinity, so every sensor type is checked against QC with its own limits (none for salinity but NKE).
+# Usage:
+#   python benchmarks/bench_chunked.py --sizes 1e6,4e6 --chunk-size 200000 --sensors NKE,Moana
+#   python benchmarks/bench_chunked.py --sizes 1e7 --no-memory     # chunked only (QC needs several GB)
+import argparse
+import hashlib
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic
+
+
+def make(path, n, row_group_size):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    df = synthetic.haul(n, seed=n % 997, salinity=True, mud=True, spikes=max(4, n // 1000), stuck=max(1, n // 5000),
+                        step=1e-8)
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path, row_group_size=row_group_size)
+
+
+def flag_hashes(df):
+    return {name: hashlib.sha1(np.ascontiguousarray(df[name].to_numpy(dtype=np.uint8)).tobytes()).hexdigest()
+            for name in sorted(c for c in df.columns if c.startswith('flag'))}
+
+
+def run_chunked(path, output, chunk_size, sensor_type):
+    import qc_chunked
+    start = time.perf_counter()
+    qc_chunked.run(path, 'v', 'Mobile', 'North Sea', sensor_type, output, chunk_size=chunk_size)
+    seconds = time.perf_counter() - start
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, flag_hashes(pd.read_parquet(output))
+
+
+def run_memory(path, sensor_type):
+    import qc_io
+    from QC import QC
+    start = time.perf_counter()
+    df = QC(qc_io.read(path), 'v', 'Mobile', 'North Sea', sensor_type).df
+    seconds = time.perf_counter() - start
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, flag_hashes(df)
+
+
+def fresh(function, *args):
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(function, *args).result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1e6,4e6')
+    parser.add_argument('--chunk-size', type=int, default=200000)
+    parser.add_argument('--sensors', default='NKE,Moana')
+    parser.add_argument('--no-memory', action='store_true', help='skip QC on the whole frame')
+    args = parser.parse_args()
+
+    same = True
+    print('{:<12} {:<10} {:<8} {:>10} {:>12}'.format('samples', 'sensor', 'mode', 'seconds', 'peak MB'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in [int(float(size)) for size in args.sizes.split(',')]:
+            path, output = os.path.join(tmp, 'series.parquet'), os.path.join(tmp, 'flags.parquet')
+            make(path, n, args.chunk_size)
+            for sensor in args.sensors.split(','):
+                seconds, peak, chunked = fresh(run_chunked, path, output, args.chunk_size, sensor)
+                print('{:<12} {:<10} {:<8} {:>10.2f} {:>12.0f}'.format(n, sensor, 'chunked', seconds, peak))
+                if not args.no_memory:
+                    seconds, peak, memory = fresh(run_memory, path, sensor)
+                    print('{:<12} {:<10} {:<8} {:>10.2f} {:>12.0f}  {}'.format(
+                        n, sensor, 'memory', seconds, peak, 'flags identical' if chunked == memory else 'FLAGS DIFFER'))
+                    same &= chunked == memory
+    sys.exit(0 if same else 1)
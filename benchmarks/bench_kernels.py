@@ -0,0 +1,110 @@
+# The loop kernels of qc_kernels (direction, seg_size, spike, stuck, mud) with the NumPy and the Numba (qc_jit)
+# backends: time of each and identical results, kernel by kernel on random and synthetic inputs (with NaN and hauls of
+# every length), then for the flags of QC and QCBatch on synthetic hauls. Exit code 1 if anything differs.
+# Usage:
+#   python benchmarks/bench_kernels.py                 # needs Numba
+#   python benchmarks/bench_kernels.py --size 1e7 --repeat 5
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qc_kernels
+from QC import QC
+from qc_batch import QCBatch
+import synthetic
+
+
+def inputs(size, seed):
+    rng = np.random.default_rng(seed)
+    df, meta = synthetic.batch(max(size // 500, 1), 500, seed=seed, salinity=True)
+    batch = QCBatch(df, meta, tests=['stuck'])
+    types = batch.type
+    group = batch.group
+    temperature = batch.temperature.copy()
+    pressure = batch.pressure.copy()
+    # plateaus, NaN and ties to hit every branch
+    temperature[rng.integers(0, len(temperature), len(temperature) // 100)] = np.nan
+    pressure[rng.integers(0, len(pressure), len(pressure) // 200)] = np.nan
+    where = rng.random(len(pressure)) < 0.5
+    return temperature, pressure, types, group, where
+
+
+def kernels(temperature, pressure, types, group, where):
+    near = qc_kernels.neighbours(temperature, group)
+    return {
+        'direction': lambda: qc_kernels.direction(pressure, where, group),
+        'seg_size': lambda: [qc_kernels.seg_size(pressure[:k], threshold) for k in (1, 100, len(pressure))
+                             for threshold in (np.nan, 50.0, np.nanmax(pressure))],
+        'spike': lambda: qc_kernels.spike(temperature, near, pressure, 6, 2),
+        'stuck': lambda: qc_kernels.stuck(temperature, near, types),
+        'mud': lambda: qc_kernels.mud(temperature, pressure, types, group),
+        'mud (one haul)': lambda: qc_kernels.mud(temperature[:2000], pressure[:2000], types[:2000]),
+    }
+
+
+def timed(function, repeat):
+    best, result = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def same(a, b):
+    return np.array_equal(np.asarray(a), np.asarray(b))
+
+
+def flags(seed):
+    out = []
+    df, meta = synthetic.batch(60, 400, seed=seed, salinity=True)
+    out.append(QCBatch(df, meta).flags)
+    for mud in (False, True):
+        out.append(QC(synthetic.haul(3000, seed=seed, salinity=True, mud=mud), 'v', 'Mobile', 'North Sea', 'NKE').df)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default='1e6')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seeds', type=int, default=3)
+    args = parser.parse_args()
+
+    qc_kernels.use(qc_kernels.NUMBA)
+    start = time.perf_counter()
+    kernels(*inputs(2000, 0))['mud']()
+    print('first Numba call (compilation or disk cache): {:.2f} s'.format(time.perf_counter() - start))
+
+    ok = True
+    print('{:<16} {:>10} {:>10} {:>8}'.format('kernel', 'numpy', 'numba', 'speedup'))
+    for seed in range(args.seeds):
+        data = inputs(int(float(args.size)) if seed == 0 else 5000, seed)
+        results = {}
+        for backend in (qc_kernels.NUMPY, qc_kernels.NUMBA):
+            qc_kernels.use(backend)
+            results[backend] = {name: timed(function, args.repeat if seed == 0 else 1)
+                                for name, function in kernels(*data).items()}
+        for name in results[qc_kernels.NUMPY]:
+            (numpy_seconds, expected), (numba_seconds, got) = results['numpy'][name], results['numba'][name]
+            identical = same(expected, got)
+            ok &= identical
+            if seed == 0 or not identical:
+                print('{:<16} {:>10.4f} {:>10.4f} {:>7.1f}x {}'.format(name, numpy_seconds, numba_seconds,
+                                                                       numpy_seconds / numba_seconds,
+                                                                       '' if identical else 'RESULTS DIFFER'))
+
+        qc_kernels.use(qc_kernels.NUMPY)
+        expected = flags(seed)
+        qc_kernels.use(qc_kernels.NUMBA)
+        for a, b in zip(expected, flags(seed)):
+            for name in [c for c in a.columns if c.startswith('flag') or c == 'type']:
+                if not same(a[name], b[name]):
+                    ok = False
+                    print('seed {} {:<20} FLAGS DIFFER'.format(seed, name))
+    print('identical results' if ok else 'RESULTS DIFFER')
+    sys.exit(0 if ok else 1)
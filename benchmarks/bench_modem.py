@@ -0,0 +1,100 @@
+# Telemetry throughput against the simulated modem (rockBlockSimulator): a backlog of messages sent one by one with
+# rockBlock.sendMessage (network time and signal checked before every message, a failed message retried until sent)
+# against the rockBlockOutbox sender (rockBlockSender: one signal check per window, then one session per message),
+# for several signal patterns. Messages per hour and time to drain the backlog are in modem time, so the run takes
+# timeScale of it (the delays of rockBlock and of the loops below are scaled the same way).
+# Usage:
+#   python benchmarks/bench_modem.py --messages 200 --failure 0.1 --scale 0.001
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rockBlock
+from rockBlockOutbox import rockBlockOutbox, rockBlockSender
+from rockBlockSimulator import rockBlockSimulator
+
+# (seconds, bars) repeated over time
+SIGNALS = {
+    'good': [(3600, 4)],
+    'patchy': [(120, 3), (60, 1), (180, 4), (90, 0)],
+    'outage': [(1200, 4), (1800, 0)],
+}
+RETRY_DELAY = 60  # legacy loop: wait before sending a failed message again
+
+
+# time module for rockBlock whose sleeps run in modem time
+class ScaledTime(object):
+    def __init__(self, scale):
+        self.scale = scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def legacy(modem, sim, backlog, scale):
+    for data in backlog:
+        while not modem.sendMessage(data):
+            time.sleep(RETRY_DELAY * scale)
+
+
+def outbox(modem, sim, backlog, scale):
+    with tempfile.TemporaryDirectory() as tmp:
+        box = rockBlockOutbox(os.path.join(tmp, 'outbox.sqlite'), clock=sim.clock)
+        box.putMessages(backlog)
+        sender = rockBlockSender(modem, box)
+        while box.depth() > 0:
+            if box.next() is None:
+                time.sleep(sender.windowDelay * scale)
+                continue
+            if sender.drain() > 0:
+                sender.delay = sender.windowDelay
+            else:
+                sender.delay = min(sender.delay * 2, sender.maxWindowDelay)
+            time.sleep(sender.delay * scale)
+        box.close()
+
+
+def run(loop, signal, args):
+    sim = rockBlockSimulator(signal=signal, failureRate=args.failure, sessionLatency=args.session,
+                             mtMessages=[b'cfg %d' % i for i in range(args.mt)], timeScale=args.scale, seed=args.seed)
+    backlog = [bytes([i % 256]) * args.size for i in range(args.messages)]
+    # rockBlock prints every transmission
+    with contextlib.redirect_stdout(io.StringIO()):
+        modem = rockBlock.rockBlock(sim, rockBlock.rockBlockProtocol())
+        start, wall = sim.clock(), time.perf_counter()
+        loop(modem, sim, backlog, args.scale)
+    elapsed, wall = sim.clock() - start, time.perf_counter() - wall
+    assert sorted(sim.delivered) == sorted(backlog), 'messages lost or duplicated'
+    return elapsed, wall, sim
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200, help='backlog to drain')
+    parser.add_argument('--size', type=int, default=340, help='bytes per message')
+    parser.add_argument('--failure', type=float, default=0.1, help='share of the sessions failing with signal')
+    parser.add_argument('--session', type=float, default=8.0, help='seconds per SBD session')
+    parser.add_argument('--mt', type=int, default=3, help='MT messages waiting at the gateway')
+    parser.add_argument('--scale', type=float, default=0.001, help='wall seconds per modem second')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rockBlock.time = ScaledTime(args.scale)
+
+    print('{} messages of {} bytes, {:.0%} failed sessions, {:.0f} s sessions'.format(
+        args.messages, args.size, args.failure, args.session))
+    print('{:<8} {:<8} {:>10} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+        'signal', 'sender', 'drain (h)', 'msg/h', 'sessions', 'failed', 'commands', 'wall'))
+    for name, signal in SIGNALS.items():
+        for label, loop in [('legacy', legacy), ('outbox', outbox)]:
+            elapsed, wall, sim = run(loop, signal, args)
+            print('{:<8} {:<8} {:>10.2f} {:>9.1f} {:>9} {:>9} {:>9} {:>7.1f}s'.format(
+                name, label, elapsed / 3600, args.messages * 3600 / elapsed, sim.sessions, sim.failedSessions,
+                sim.commands, wall))
@@ -0,0 +1,128 @@
+# Speed and flags of every QC test on synthetic hauls, compared with a stored baseline.
+# Cases: one haul of every size in --sizes (QC, timed per test with qc_profile) and a batch of --hauls short hauls
+# (QCBatch, and QC haul by haul on the first 50 of them). The flags of every case are summarised by their counts of
+# 3 and 4 and a hash of the flag arrays, so an optimization can be checked for both speed and identical flags.
+# Usage:
+#   python benchmarks/bench_qc.py --save benchmarks/baseline.json       # record a baseline
+#   python benchmarks/bench_qc.py --compare benchmarks/baseline.json    # exit code 1 if any flag differs
+#   python benchmarks/bench_qc.py --sizes 1e3,1e7                       # 10^7 samples needs several GB of RAM
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from QC import QC
+from qc_batch import QCBatch
+from qc_profile import QCProfiler
+import synthetic
+
+
+def flag_summary(flags):
+    out = {}
+    for name in sorted(c for c in flags.columns if c.startswith('flag')):
+        values = np.ascontiguousarray(flags[name].to_numpy(dtype=np.uint8))
+        out[name] = {'3': int((values == 3).sum()), '4': int((values == 4).sum()),
+                     'sha1': hashlib.sha1(values.tobytes()).hexdigest()}
+    return out
+
+
+def bench_haul(n, repeat):
+    df = synthetic.haul(n, seed=n % 997, salinity=True, mud=True, spikes=max(4, n // 1000), stuck=max(1, n // 5000))
+    best, steps = np.inf, None
+    for _ in range(repeat):
+        profiler = QCProfiler(memory=False)
+        start = time.perf_counter()
+        qc = QC(df.copy(), 'v', 'Mobile', 'North Sea', 'NKE', profiler=profiler)
+        seconds = time.perf_counter() - start
+        if seconds < best:
+            best = seconds
+            steps = {record['step']: record['seconds'] for record in profiler.records}
+    return {'rows': len(df), 'seconds': best, 'steps': steps, 'flags': flag_summary(qc.df)}
+
+
+def bench_batch(n_hauls, n, repeat):
+    df, meta = synthetic.batch(n_hauls, n, salinity=True)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        batch = QCBatch(df, meta)
+        best = min(best, time.perf_counter() - start)
+
+    # QC haul by haul, on a sample of the hauls, scaled to the batch
+    sample = meta.index[:50]
+    start = time.perf_counter()
+    for haul in sample:
+        m = meta.loc[haul]
+        try:
+            QC(df[df['HAUL'] == haul].drop(columns=['HAUL']).reset_index(drop=True), m['vessel'], m['gear_type'],
+               m['zone'], m['sensor_type'])
+        except Exception:
+            pass
+    per_haul = (time.perf_counter() - start) / len(sample) * n_hauls
+    return {'rows': len(df), 'hauls': n_hauls, 'seconds': best, 'steps': {'QC per haul': per_haul},
+            'errors': len(batch.errors), 'flags': flag_summary(batch.flags)}
+
+
+def compare(results, baseline, tolerance):
+    ok = True
+    for case, result in results.items():
+        if case not in baseline:
+            print('{:<22} not in baseline'.format(case))
+            continue
+        base = baseline[case]
+        ratio = result['seconds'] / base['seconds']
+        same = result['flags'] == base['flags']
+        ok &= same
+        print('{:<22} {:>10.4f} {:>10.4f} {:>7.2f}x {:>8} {}'.format(
+            case, base['seconds'], result['seconds'], ratio, 'slower' if ratio > tolerance else '',
+            'flags identical' if same else 'FLAGS DIFFER'))
+        if not same:
+            for name in sorted(set(result['flags']) | set(base['flags'])):
+                if result['flags'].get(name) != base['flags'].get(name):
+                    print('    {:<20} baseline {} now {}'.format(name, base['flags'].get(name),
+                                                                 result['flags'].get(name)))
+        for step, seconds in result['steps'].items():
+            base_seconds = base['steps'].get(step)
+            if base_seconds and seconds / base_seconds > tolerance and seconds > 1e-3:
+                print('    {:<20} {:>10.4f} {:>10.4f} {:>7.2f}x slower'.format(step, base_seconds, seconds,
+                                                                              seconds / base_seconds))
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1e3,1e4,1e5,1e6')
+    parser.add_argument('--hauls', type=int, default=1000)
+    parser.add_argument('--haul-size', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args()
+
+    results = {}
+    for n in [int(float(size)) for size in args.sizes.split(',')]:
+        case = 'haul %d' % n
+        results[case] = bench_haul(n, args.repeat if n <= 100000 else 1)
+        print('{:<22} {:>10.4f} s'.format(case, results[case]['seconds']))
+        steps = results[case]['steps']
+        print('    ' + ', '.join('{} {:.4f}'.format(step, seconds) for step, seconds in steps.items()))
+    if args.hauls:
+        case = 'batch %dx%d' % (args.hauls, args.haul_size)
+        results[case] = bench_batch(args.hauls, args.haul_size, args.repeat)
+        print('{:<22} {:>10.4f} s  (QC per haul {:.4f} s)'.format(case, results[case]['seconds'],
+                                                                  results[case]['steps']['QC per haul']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\n{:<22} {:>10} {:>10} {:>8}'.format('case', 'baseline', 'now', 'ratio'))
+        sys.exit(0 if compare(results, baseline, args.tolerance) else 1)
@@ -0,0 +1,67 @@
+# Size of a QC'd haul sent over Iridium SBD (340-byte messages): the CSV text rockBlock used to send against the binary
+# encoding of qc_sbd, with and without decimation by segment, and the worst quantization error after decoding.
+# Usage:
+#   python benchmarks/bench_sbd.py                                  # example_before_QC.csv
+#   python benchmarks/bench_sbd.py --input haul.csv --sensor Moana
+import argparse
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from QC import QC
+import qc_sbd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COLUMNS = ['DATETIME', 'TEMPERATURE', 'PRESSURE', 'SALINITY', 'LATITUDE', 'LONGITUDE']
+
+
+def csv_size(df, flags):
+    columns = [c for c in COLUMNS if c in df] + flags
+    return len(df[columns].to_csv(index=False).encode())
+
+
+def errors(df, decoded):
+    out = {}
+    for name in [c for c in COLUMNS[1:] if c in decoded]:
+        out[name] = float(np.nanmax(np.abs(df[name].to_numpy(dtype=float) - decoded[name].to_numpy())))
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default=os.path.join(HERE, '..', 'example_before_QC.csv'))
+    parser.add_argument('--vessel', default='v')
+    parser.add_argument('--gear', default='Mobile')
+    parser.add_argument('--zone', default='North Sea')
+    parser.add_argument('--sensor', default='NKE')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input)
+    df = df[[c for c in COLUMNS if c in df]]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        df = QC(df, args.vessel, args.gear, args.zone, args.sensor).df
+    all_flags = [name for name in qc_sbd.FLAGS if name in df]
+
+    print('{} samples'.format(len(df)))
+    print('{:<44} {:>8} {:>8} {:>9} {:>8}'.format('encoding', 'samples', 'bytes', 'messages', 'ratio'))
+    for flags in (['flag'], all_flags):
+        text = csv_size(df, flags)
+        label = 'aggregate flag' if flags == ['flag'] else 'all flags'
+        print('{:<44} {:>8} {:>8} {:>9} {:>8}'.format('CSV text, ' + label, len(df), text, -(-text // 340), '1.0x'))
+        for name, decimate in [('binary', None), ('binary, bottom 1/10', {'bottom': 10}),
+                               ('binary, 1/4 and bottom 1/20', {'down': 4, 'bottom': 20, 'up': 4})]:
+            payload = qc_sbd.encode(df, flags, decimate)
+            messages = qc_sbd.fragment(payload, 0)
+            decoded = qc_sbd.decode(payload)
+            print('{:<44} {:>8} {:>8} {:>9} {:>7.1f}x'.format(name + ', ' + label, len(decoded), len(payload),
+                                                             len(messages), text / len(payload)))
+    decoded = qc_sbd.decode(qc_sbd.encode(df, all_flags))
+    print('largest quantization error: ' + ', '.join('{} {:.2g}'.format(name, error)
+                                                     for name, error in errors(df, decoded).items()))
+    fit = qc_sbd.messages(df, 0, max_messages=1)
+    print('one message: {} samples in {} bytes'.format(len(qc_sbd.decode(fit[0][qc_sbd.HEADER.size:])), len(fit[0])))
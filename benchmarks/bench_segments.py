@@ -0,0 +1,56 @@
+# Scaling of the down/bottom/up segmentation (QC.Segments) from 1k to 1M samples.
+# The legacy while-loop boundary search is O(n^2) and is only timed on the smaller hauls.
+# Usage: python benchmarks/bench_segments.py
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from QC import Segments
+
+
+def synthetic_haul(n, seed=0):
+    rng = np.random.default_rng(seed)
+    n_down, n_up = n // 5, n // 5
+    n_bottom = n - n_down - n_up
+    pressure = np.concatenate([np.linspace(1, 400, n_down), 400 + rng.normal(0, 2, n_bottom),
+                               np.linspace(400, 1, n_up)])
+    datetime = pd.Timestamp('2021-03-01') + pd.to_timedelta(np.arange(n) * 2, unit='s')
+    return datetime, pressure
+
+
+def legacy_seg_size(pressure, threshold):
+    pressure = pd.Series(pressure)
+    min_seg_size = 1
+    while pressure.iloc[:min_seg_size].max() < threshold:
+        min_seg_size += 1
+    return min_seg_size
+
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    print('{:>9} {:>14} {:>14} {:>14}'.format('samples', 'Segments [s]', 'search [s]', 'legacy [s]'))
+    for n in [1000, 10000, 100000, 1000000]:
+        datetime, pressure = synthetic_haul(n)
+        threshold = 0.5 * pressure.max()
+        t_segments = best_of(lambda: Segments(datetime, pressure, 'NKE'))
+        t_search = best_of(lambda: (Segments._seg_size(pressure, threshold),
+                                    Segments._seg_size(pressure[::-1], threshold)))
+        t_legacy = float('nan')
+        if n <= 10000:
+            assert legacy_seg_size(pressure, threshold) == Segments._seg_size(pressure, threshold)
+            assert legacy_seg_size(pressure[::-1], threshold) == Segments._seg_size(pressure[::-1], threshold)
+            t_legacy = best_of(lambda: (legacy_seg_size(pressure, threshold),
+                                        legacy_seg_size(pressure[::-1], threshold)), repeat=1)
+        print('{:>9} {:>14.4f} {:>14.6f} {:>14.4f}'.format(n, t_segments, t_search, t_legacy))
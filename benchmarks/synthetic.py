@@ -0,0 +1,62 @@
+# Synthetic hauls for the benchmarks: down cast, bottom and up cast of configurable length and shape, with optional
+# Moana-style fishing gap, spikes, stuck values, mud on the up cast and bottom drift. Everything is seeded, so a
+# configuration always gives the same haul (and the same flags).
+import numpy as np
+import pandas as pd
+
+
+# One haul as a QC input frame (DATETIME as datetime64, as read by qc_io or after pd.to_datetime)
+def haul(n=1000, seed=0, shape=(0.2, 0.6, 0.2), depth=None, salinity=False, flat_bottom=False, fishing_gap=0,
+         spikes=4, stuck=1, mud=False, drift=0.0, interval=2.0, start='2021-03-01 10:00:00', position=(56.1, 3.2),
+         step=1e-5):
+    rng = np.random.default_rng(seed)
+    n_down = max(int(n * shape[0]), 2)
+    n_up = max(int(n * shape[2]), 2)
+    n_bottom = max(n - n_down - n_up, 1)
+    n = n_down + n_bottom + n_up
+    depth = depth or 200 + rng.random() * 400
+
+    pressure = np.concatenate([np.linspace(1, depth, n_down), depth + rng.normal(0, 0.1 if flat_bottom else 2, n_bottom),
+                               np.linspace(depth, 1, n_up)])
+    temperature = np.concatenate([np.linspace(14, 6, n_down), 6 + rng.normal(0, 0.05, n_bottom),
+                                  np.linspace(6, 14, n_up)]) + rng.normal(0, 0.02, n)
+    if drift:
+        temperature[n_down:n_down + n_bottom] += np.linspace(0, drift, n_bottom)
+    if mud:
+        # the sensor keeps the bottom temperature for the first third of the up cast
+        temperature[n_down + n_bottom:n_down + n_bottom + n_up // 3] = temperature[n_down + n_bottom - 1]
+
+    spiked = rng.integers(5, n - 5, spikes)
+    temperature[spiked] += 8
+    stuck_at = rng.integers(5, n - 10, stuck)
+    for i in stuck_at:
+        temperature[i:i + 5] = temperature[i]
+
+    dt = np.full(n, interval)
+    if fishing_gap:
+        dt[n_down + n_bottom // 2] = fishing_gap
+    datetime = np.datetime64(pd.Timestamp(start).to_datetime64(), 'us') + (np.cumsum(dt) * 1e6).astype(
+        'timedelta64[us]')
+
+    df = pd.DataFrame({'DATETIME': datetime, 'TEMPERATURE': temperature.round(4), 'PRESSURE': pressure.round(1),
+                       'LATITUDE': position[0] + np.arange(n) * step, 'LONGITUDE': position[1] + np.arange(n) * step})
+    if salinity:
+        sal = 35 + rng.normal(0, 0.01, n)
+        sal[spiked[:len(spiked) // 2]] += 3
+        for i in stuck_at:
+            sal[i:i + 5] = sal[i]
+        df['SALINITY'] = sal.round(3)
+    return df
+
+
+# Many hauls in one frame with a HAUL key, and their metadata (every fourth haul from a Moana sensor with a fishing
+# gap, every third one with mud)
+def batch(n_hauls=100, n=500, seed=0, salinity=False, zone='North Sea', gear_type='Mobile'):
+    frames, meta = [], []
+    for h in range(n_hauls):
+        moana = h % 4 == 3
+        frames.append(haul(n, seed=seed + h, salinity=salinity and not moana, fishing_gap=600 if moana else 0,
+                           mud=h % 3 == 2).assign(HAUL=h))
+        meta.append(dict(HAUL=h, vessel='v%d' % (h % 7), gear_type=gear_type, zone=zone,
+                         sensor_type='Moana' if moana else 'NKE'))
+    return pd.concat(frames, ignore_index=True), pd.DataFrame(meta).set_index('HAUL')
@@ -0,0 +1,94 @@
+import os
+import struct
+
+import numpy as np
+
+# Gridded climatology for the climatology test: temperature and salinity limits per month, depth bin and lat/lon cell.
+# The file holds a header, the depth bin edges (dbar) and a float32 array of shape (12, depth bins, rows, columns, 4)
+# with (min temperature, max temperature, min salinity, max salinity), NaN where there is no climatology. Rows go from
+# north to south and columns eastwards, as in land_mask. It is memory-mapped: opening it is free, only the pages of the
+# cells looked up are read, and they stay in the OS cache for the next hauls and for the other worker processes.
+# Samples outside the grid, or on NaN cells, fall back on the limits of the zone (QC.CLIMATOLOGY); without either they
+# are not flagged.
+
+MAGIC = b'BDCCLIM1'
+HEADER = struct.Struct('<8sIIIIddd')  # magic, months, depth bins, rows, columns, north edge, west edge, cell size
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'climatology.bin')
+
+
+class Climatology(object):
+    def __init__(self, path=DEFAULT_PATH):
+        with open(path, 'rb') as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+            magic, self.months, n_depth, self.rows, self.columns, self.north, self.west, self.resolution = header
+            if magic != MAGIC:
+                raise ValueError('%s is not a climatology file' % path)
+            if self.months != 12:
+                raise ValueError('%s has %d months, not 12' % (path, self.months))
+            self.depth_edges = np.frombuffer(f.read(8 * (n_depth + 1)), dtype='<f8')
+        self.path = path
+        self.limits = np.memmap(path, dtype='<f4', mode='r', offset=HEADER.size + 8 * (n_depth + 1),
+                                shape=(self.months, n_depth, self.rows, self.columns, 4))
+
+    # (min_temp, max_temp, min_sal, max_sal) of every sample, NaN outside the grid or where it has no data
+    def lookup(self, datetime, pressure, latitude, longitude):
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        pressure = np.asarray(pressure, dtype=float)
+        month = np.asarray(datetime, dtype='datetime64[M]').astype(np.int64) % 12
+        depth = np.searchsorted(self.depth_edges, pressure, side='right') - 1
+        row = np.floor((self.north - latitude) / self.resolution)
+        # eastwards from the west edge, across the antimeridian; only a global grid wraps around
+        column = np.floor(((longitude - self.west) % 360) / self.resolution)
+        if np.isclose(self.columns * self.resolution, 360):
+            column = column % self.columns
+        inside = (row >= 0) & (row < self.rows) & (column >= 0) & (column < self.columns) & (depth >= 0) & (
+                depth < len(self.depth_edges) - 1) & ~np.isnat(np.asarray(datetime, dtype='datetime64[M]'))
+
+        limits = np.full((len(latitude), 4), np.nan)
+        if inside.any():
+            limits[inside] = self.limits[month[inside], depth[inside], row[inside].astype(np.int64),
+                                         column[inside].astype(np.int64)]
+        return limits.T
+
+    # Writes a (12, depth bins, rows, columns, 4) array of limits as a climatology file
+    @staticmethod
+    def write(path, limits, depth_edges, north=90.0, west=-180.0, resolution=None):
+        limits = np.asarray(limits, dtype='<f4')
+        months, n_depth, rows, columns, _ = limits.shape
+        if months != 12:
+            raise ValueError('A climatology has 12 months, not %d' % months)
+        depth_edges = np.asarray(depth_edges, dtype='<f8')
+        if len(depth_edges) != n_depth + 1:
+            raise ValueError('%d depth bins need %d edges' % (n_depth, n_depth + 1))
+        resolution = resolution or 360.0 / columns
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, months, n_depth, rows, columns, north, west, resolution))
+            f.write(depth_edges.tobytes())
+            f.write(np.ascontiguousarray(limits).tobytes())
+
+
+_climatologies = {}
+
+
+# Climatology shared by every QC of the process, opened on first use. None when there is no climatology file at the
+# default path; an explicit path has to exist.
+def load(path=None):
+    if path is None:
+        if not os.path.exists(DEFAULT_PATH):
+            return None
+        path = DEFAULT_PATH
+    if path not in _climatologies:
+        _climatologies[path] = Climatology(path)
+    return _climatologies[path]
+
+
+# Limits of every sample: from the gridded climatology where it has data, else the fallback limits, as 4 values or
+# (4, samples) arrays (min_temp, max_temp, min_sal, max_sal; NaN when unknown)
+def limits(fallback, datetime, pressure, latitude, longitude):
+    out = np.broadcast_to(np.asarray(fallback, dtype=float).reshape(4, -1), (4, len(pressure)))
+    grid = load()
+    if grid is not None:
+        gridded = grid.lookup(datetime, pressure, latitude, longitude)
+        out = np.where(np.isnan(gridded), out, gridded)
+    return out
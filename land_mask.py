@@ -0,0 +1,77 @@
+import os
+import struct
+import sys
+import warnings
+
+import numpy as np
+
+# Land/ocean raster for the position on land test, replacing global_land_mask.
+# The file holds a small header and one bit per grid cell (1 = land), rows from north to south, columns eastwards.
+# It is memory-mapped, so opening it costs nothing, only the pages of the cells actually looked up are read, and all
+# the worker processes share the same pages of the OS cache. A 5 minutes ETOPO5 grid is 1.2 MB.
+# Build it once from the ETOPO5 binary (big-endian int16 elevations, 2160 x 4320, from 90N and 0E):
+#   python land_mask.py ETOPO5.DOS land_mask.bin
+
+MAGIC = b'BDCLAND1'
+HEADER = struct.Struct('<8sIIddd')  # magic, rows, columns, north edge, west edge, cell size in degrees
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'land_mask.bin')
+
+
+class LandMask(object):
+    def __init__(self, path=DEFAULT_PATH):
+        with open(path, 'rb') as f:
+            magic, self.rows, self.columns, self.north, self.west, self.resolution = HEADER.unpack(
+                f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a land mask file' % path)
+        self.path = path
+        self.bits = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER.size,
+                              shape=((self.rows * self.columns + 7) // 8,))
+
+    # True where the position falls in a land cell; NaN or impossible latitudes are not land
+    def is_land(self, latitude, longitude):
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        valid = (latitude >= -90) & (latitude <= 90) & np.isfinite(longitude)
+        row = np.clip(np.floor((self.north - np.where(valid, latitude, 0)) / self.resolution), 0, self.rows - 1)
+        column = np.floor(((np.where(valid, longitude, 0) - self.west) % 360) / self.resolution) % self.columns
+        cell = row.astype(np.int64) * self.columns + column.astype(np.int64)
+        return valid & ((self.bits[cell >> 3] >> (cell & 7).astype(np.uint8)) & 1).astype(bool)
+
+    # Writes a boolean grid (rows from north to south) as a land mask file
+    @staticmethod
+    def write(path, land, north=90.0, west=-180.0, resolution=None):
+        land = np.asarray(land, dtype=bool)
+        rows, columns = land.shape
+        resolution = resolution or 360.0 / columns
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, rows, columns, north, west, resolution))
+            f.write(np.packbits(land.ravel(), bitorder='little').tobytes())
+
+    # Land mask from the ETOPO5 (or TerrainBase) 5 minutes elevation grid: land where the elevation is above sea level
+    @classmethod
+    def from_etopo5(cls, source, path=DEFAULT_PATH):
+        elevation = np.fromfile(source, dtype='>i2').reshape(2160, 4320)
+        cls.write(path, elevation > 0, north=90.0, west=0.0, resolution=1 / 12.)
+        return cls(path)
+
+
+_masks = {}
+
+
+# Land mask shared by every QC of the process, opened on first use. None when there is no mask file at the default
+# path, so the test is skipped (with a warning) on installations without one; an explicit path has to exist.
+def load(path=None):
+    if path is None:
+        if not os.path.exists(DEFAULT_PATH):
+            warnings.warn('No land mask at %s, the position on land test is skipped: build it with '
+                          'python land_mask.py ETOPO5.DOS %s' % (DEFAULT_PATH, DEFAULT_PATH))
+            return None
+        path = DEFAULT_PATH
+    if path not in _masks:
+        _masks[path] = LandMask(path)
+    return _masks[path]
+
+
+if __name__ == '__main__':
+    LandMask.from_etopo5(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else DEFAULT_PATH)
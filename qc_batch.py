@@ -0,0 +1,403 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime
+import geopy.distance
+
+from QC import QC, is_datetime, as_datetime
+import land_mask
+import climatology
+import vessel_regions
+import qc_pipeline
+import qc_kernels
+from qc_kernels import neighbours, group_std, impossible_speed, neighbour_flags, mud
+
+
+# Batch QC: runs the tests of QC (all of them unless tests selects some, see qc_pipeline) on one long DataFrame
+# holding many hauls.
+# The hauls are told apart by a key column, and their vessel, gear_type, zone and sensor_type come from a metadata
+# frame indexed by that key. Every test runs as a grouped array operation over the whole batch (shifts within a haul,
+# grouped reductions and standard deviations), so no pandas object is built per haul. The flag columns are the same as
+# running QC on every haul separately. Hauls on which QC would raise (e.g. the IndexError of the segmentation on
+# monotonic profiles) are left out of the flags and reported in errors.
+# With key=None the whole input is one haul and meta holds its vessel, gear_type, zone and sensor_type (a dict).
+# The input is never written to. Besides a DataFrame it can be an Arrow Table or RecordBatch, a mapping of arrays
+# (e.g. a .npz) or a structured array. Columns that are already float64 (datetime64 for DATETIME), in a frame whose
+# hauls are stored one after the other, are read in place as read-only views, without any copy; the flags are a new
+# frame aligned to the index of the input.
+class QCBatch(object):
+    def __init__(self, df, meta, key='HAUL', tests=None, profiler=None):
+        self.key = key
+        names = _names(df)
+        if key is None:
+            self.hauls = pd.Index([0])
+            codes = np.zeros(_length(df, names), dtype=np.intp)
+            meta = pd.DataFrame([dict(meta)], index=self.hauls)
+        else:
+            codes, self.hauls = pd.factorize(_values(df, key))
+        # hauls already stored one after the other, in order of appearance, are read as they are
+        self.order = None if (codes[1:] >= codes[:-1]).all() else np.argsort(codes, kind='stable')
+        self.group = codes if self.order is None else codes[self.order]
+        self.starts, self.counts = _runs(self.group)
+        index = df.index if isinstance(df, pd.DataFrame) else pd.RangeIndex(len(codes))
+        self.index = index if self.order is None else index[self.order]
+
+        meta = meta.loc[self.hauls]
+        self.vessel = meta['vessel'].to_numpy()
+        self.gear = meta['gear_type'].to_numpy()
+        self.zone = meta['zone'].to_numpy()
+        self.sensor_type = meta['sensor_type'].to_numpy()
+
+        self.datetime = self._column(df, 'DATETIME')
+        self.temperature = self._column(df, 'TEMPERATURE')
+        self.pressure = self._column(df, 'PRESSURE')
+        self.latitude = self._column(df, 'LATITUDE')
+        self.longitude = self._column(df, 'LONGITUDE')
+        self.salinity = self._column(df, 'SALINITY') if 'SALINITY' in names else None
+        self.speed = self._column(df, 'SPEED') if 'SPEED' in names else None
+
+        self.errors = {}
+        self.type = None
+        self.columns = {'flag': np.ones(len(self.group), dtype=np.uint8)}
+        if len(self.group) != 0:
+            for step in qc_pipeline.plan(tests, fuse=profiler is None) + ['aggregate_flag']:
+                if profiler is None:
+                    getattr(self, step)()
+                else:
+                    profiler.run(self, step, len(self.hauls))
+        self.flags = self._flag_table()
+
+    # Same tests, in the same order, as QC
+
+    def regions(self):
+        self._new('flag_vessel_region')
+        registry = vessel_regions.load()
+        inside = (registry.membership(self.latitude, self.longitude) & registry.bits(self.zone)[self.group]) != 0
+        # as RegionRegistry.outside: samples without a position are not flagged
+        self._set('flag_vessel_region', ~inside & ~np.isnan(self.latitude) & ~np.isnan(self.longitude), 3)
+
+    def gear_type(self):
+        self._new('flag_gear_type')
+        first, last = self.starts, self.starts + self.counts - 1
+        wrong = np.zeros(len(self.hauls), dtype=bool)
+        for h in range(len(self.hauls)):
+            d = geopy.distance.geodesic((self.latitude[first[h]], self.longitude[first[h]]),
+                                        (self.latitude[last[h]], self.longitude[last[h]])).m
+            gt = 1 if d > 200 else 0
+            wrong[h] = (gt == 1 and self.gear[h] == 'Fixed') or (gt == 0 and self.gear[h] == 'Mobile')
+        self._set('flag_gear_type', wrong[self.group], 3)
+
+    def impossible_date(self):
+        self._new('flag_date')
+        currdate = np.datetime64(datetime.utcnow())
+        mindate = np.datetime64(datetime(2010, 1, 1))
+        self._set('flag_date', (self.datetime > currdate) | (self.datetime < mindate), 4)
+
+    def impossible_location(self):
+        self._new('flag_location')
+        self._set('flag_location', (self.latitude < -90) | (self.latitude > 90) | (self.longitude < -180) | (
+                self.longitude > 180), 4)
+
+    def position_on_land(self):
+        mask = land_mask.load()
+        if mask is not None:
+            self._new('flag_land')
+            self._set('flag_land', mask.is_land(self.latitude, self.longitude), 4)
+
+    def impossible_speed(self):
+        self.columns['flag_speed'] = impossible_speed(self.latitude, self.longitude, self.datetime, self.speed,
+                                                      self.group)
+
+    def global_range(self):
+        limits = np.array([[np.nan if limit is None else limit for limit in
+                            QC.global_limits(sensor_type, self.salinity is not None)]
+                           for sensor_type in self.sensor_type], dtype=float)
+        max_press, min_temp, max_temp, min_sal, max_sal = limits[self.group].T
+
+        self._new('flag_global_range')
+        self._set('flag_global_range', (self.pressure >= -5) & (self.pressure < 0), 3)
+        self._set('flag_global_range', self.pressure > max_press, 3)
+        self._set('flag_global_range', self.pressure < -5, 4)
+        self._set('flag_global_range', (self.temperature < min_temp) | (self.temperature > max_temp), 4)
+        if self.salinity is not None:
+            self._set('flag_global_range', (self.salinity < min_sal) | (self.salinity > max_sal), 4)
+
+    def neighbour_tests(self):
+        self.parse_segments()
+        self.columns.update(neighbour_flags(self.temperature, self.pressure, self.type, self.salinity, self.group))
+
+    def spike(self):
+        temp = neighbours(self.temperature, self.group)
+        self.columns['flag_temp_spike'] = qc_kernels.spike(self.temperature, temp, self.pressure, 6, 2)
+        if self.salinity is not None:
+            sal = neighbours(self.salinity, self.group)
+            self.columns['flag_sal_spike'] = qc_kernels.spike(self.salinity, sal, self.pressure, 0.9, 0.3)
+
+    def rollover(self):
+        self.parse_segments()
+        temp = neighbours(self.temperature, self.group)
+        self.columns['flag_rollover'] = qc_kernels.rollover(self.temperature, temp, self.type)
+
+    def stuck(self):
+        self.parse_segments()
+        self.columns['flag_temp_stuck'] = qc_kernels.stuck(self.temperature, neighbours(self.temperature, self.group),
+                                                           self.type)
+        if self.salinity is not None:
+            self.columns['flag_sal_stuck'] = qc_kernels.stuck(self.salinity, neighbours(self.salinity, self.group),
+                                                              self.type)
+
+    def rate_of_change(self):
+        self.parse_segments()
+        flags = qc_kernels.rate_of_change(self.temperature, neighbours(self.temperature, self.group), self.type,
+                                          self.group)
+        if self.salinity is not None:
+            flags = np.maximum(flags, qc_kernels.rate_of_change(self.salinity, neighbours(self.salinity, self.group),
+                                                                self.type, self.group))
+        self.columns['flag_RoC'] = flags
+
+    def timing_gap(self):
+        self._new('flag_timing_gap')
+        currdate = np.datetime64(datetime.utcnow())
+        tim_inc = 24  # hours
+        time_gap = (currdate - self.datetime[self.starts + self.counts - 1]) / np.timedelta64(1, 's')
+        self._set('flag_timing_gap', (time_gap / 3600 > tim_inc)[self.group], 3)
+
+    def climatology(self):
+        zone_limits = np.array([QC.zone_limits(zone) for zone in self.zone], dtype=float).reshape(-1, 4)
+        min_temp, max_temp, min_sal, max_sal = climatology.limits(zone_limits[self.group].T, self.datetime,
+                                                                  self.pressure, self.latitude, self.longitude)
+
+        self._new('flag_clima')
+        self._set('flag_clima', (self.temperature < min_temp) | (self.temperature > max_temp), 3)
+        if self.salinity is not None:
+            self._set('flag_clima', (self.salinity < min_sal) | (self.salinity > max_sal), 3)
+
+    def drift(self):
+        self._new('flag_drift')
+        self.parse_segments()
+        bottom = self.type == 3
+        idx = np.arange(len(self.group))
+        first = self._reduce(np.minimum, np.where(bottom, idx, len(idx)))
+        last = self._reduce(np.maximum, np.where(bottom, idx, -1))
+        has_bottom = last >= 0
+        first, last = np.where(has_bottom, first, 0), np.where(has_bottom, last, 0)
+        # QC.drift compares Timedelta.seconds, which never reaches a day, against 24 hours: the time window always passes
+        drifted = has_bottom & (np.abs(self.temperature[first] - self.temperature[last]) > 3)
+        self._set('flag_drift', drifted[self.group], 3)
+        if self.salinity is not None:
+            drifted = has_bottom & (np.abs(self.salinity[first] - self.salinity[last]) > 8)
+            self._set('flag_drift', drifted[self.group], 3)
+
+    def mud(self):
+        self.parse_segments()
+        self.columns['flag_mud'] = mud(self.temperature, self.pressure, self.type, self.group)
+
+    def aggregate_flag(self):
+        self.columns['flag'] = np.maximum.reduce([values for name, values in self.columns.items()
+                                                  if name not in QC.NOT_AGGREGATED])
+
+    def parse_segments(self):
+        if self.type is not None:
+            return
+        self.type = np.full(len(self.group), 3, dtype=np.int64)
+        moana = np.array(['Moana' in sensor_type for sensor_type in self.sensor_type], dtype=bool)[self.group]
+        for rows, segments in [(np.flatnonzero(moana), _segments_moana),
+                               (np.flatnonzero(~moana), _segments_profile)]:
+            if len(rows) == 0:
+                continue
+            group = self.group[rows]
+            types, failed = segments(self.datetime[rows], self.pressure[rows], group)
+            self.type[rows] = types
+            for h in np.unique(group[failed]):
+                self._error(h, IndexError('single positional indexer is out-of-bounds'))
+
+    # Helpers
+
+    # Rows and flag columns, as seen by qc_profile
+    def rows(self):
+        return len(self.group)
+
+    def flag_values(self, name):
+        return self.columns.get(name)
+
+    def _new(self, name):
+        self.columns[name] = np.ones(len(self.group), dtype=np.uint8)
+
+    def _set(self, name, mask, value):
+        self.columns[name][mask] = value
+
+    def _reduce(self, ufunc, values):
+        return ufunc.reduceat(values, self.starts)
+
+    def _error(self, h, error):
+        self.errors.setdefault(self.hauls[h], error)
+
+    def _flag_table(self):
+        keep = ~np.isin(self.group, [h for h in range(len(self.hauls)) if self.hauls[h] in self.errors])
+        columns = dict(self.columns)
+        if self.type is not None:
+            columns['type'] = self.type
+        flags = pd.DataFrame({name: values[keep] for name, values in columns.items()}, index=self.index[keep])
+        if self.order is None:
+            return flags
+        # back to the row order of the input
+        return flags.iloc[np.argsort(self.order[keep], kind='stable')]
+
+    # A column of the input, in haul order, as a read-only array (a view of the input when no conversion is needed)
+    def _column(self, df, name):
+        values = _values(df, name)
+        if name == 'DATETIME':
+            values = values if is_datetime(values) else as_datetime(values).to_numpy()
+        else:
+            values = np.asarray(values, dtype=float)
+        values = values.view() if self.order is None else values[self.order]
+        values.flags.writeable = False
+        return values
+
+
+# Columns of the input: a DataFrame, an Arrow Table or RecordBatch, a mapping of arrays or a structured array
+
+def _names(data):
+    if isinstance(data, pd.DataFrame):
+        return list(data.columns)
+    if hasattr(data, 'schema'):
+        return list(data.schema.names)
+    if isinstance(data, np.ndarray):
+        return list(data.dtype.names)
+    return list(data.keys())
+
+
+# The values of a column as a NumPy array, without a copy where the input allows it
+def _values(data, name):
+    if isinstance(data, pd.DataFrame):
+        return data[name].to_numpy()
+    if hasattr(data, 'schema'):
+        return data.column(name).to_numpy(zero_copy_only=False)
+    return np.asarray(data[name])
+
+
+def _length(data, names):
+    return len(data) if isinstance(data, pd.DataFrame) or not names else len(_values(data, names[0]))
+
+
+# Row-wise helpers over hauls stored contiguously, group holding the haul of every row
+
+def _runs(group):
+    if len(group) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    return starts, np.diff(np.r_[starts, len(group)])
+
+
+# Series.quantile(q) of every haul (linear interpolation as in numpy), valid marks the non-missing values
+def _quantile(values, valid, group, q):
+    starts, counts = _runs(group)
+    ordered = values[np.lexsort((values, ~valid, group))]
+    n = np.add.reduceat(valid.astype(np.int64), starts)
+    virtual = (n - 1) * q
+    gamma = virtual - np.floor(virtual)
+    above = virtual >= n - 1
+    previous = np.where(above, np.maximum(n - 1, 0), np.floor(virtual)).astype(np.int64)
+    following = np.where(above, previous, previous + 1)
+    a, b = ordered[starts + previous], ordered[starts + following]
+    diff = b - a
+    result = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    return np.where(n > 0, result, np.nan)
+
+
+# Running maximum (ignoring NaN) within every haul
+def _cummax(values, group):
+    filled = np.where(np.isnan(values), -np.inf, values)
+    cummax = pd.Series(filled).groupby(group, sort=False).cummax().to_numpy()
+    return np.where(cummax == -np.inf, np.nan, cummax)
+
+
+# qc_kernels.seg_size of every haul
+def _seg_sizes(values, group, threshold):
+    starts, counts = _runs(group)
+    n = np.repeat(counts, counts)
+    pos = np.arange(len(group)) - np.repeat(starts, counts)
+    below = _cummax(values, group) < np.repeat(threshold, counts)
+    first_reached = np.minimum.reduceat(np.where(below, n, pos), starts)
+    return np.where(first_reached == counts, counts, first_reached + 1)
+
+
+# Segments._parse (non-Moana branch) of every haul: returns the type of every row and the rows of failed hauls
+def _segments_profile(datetime, pressure, group):
+    starts, counts = _runs(group)
+    n = np.repeat(counts, counts)
+    pos = np.arange(len(group)) - np.repeat(starts, counts)
+
+    q90 = _quantile(pressure, ~np.isnan(pressure), group, 0.9)
+    gap_pressure = np.abs(pressure - np.repeat(q90, counts))
+    near_bottom = gap_pressure > 0.5 * np.repeat(np.fmax.reduceat(gap_pressure, starts), counts)
+
+    # True down and False up
+    direction = qc_kernels.direction(pressure, near_bottom, group)
+
+    # DatetimeArray quantiles are truncated back to the datetime unit
+    time = datetime.view(np.int64)
+    valid_time = ~np.isnat(datetime)
+    q10 = _quantile(time, valid_time, group, 0.1)
+    q90 = _quantile(time, valid_time, group, 0.9)
+    has_time = np.repeat(~np.isnan(q10), counts)
+    q10 = np.repeat(np.nan_to_num(q10).astype(np.int64), counts)
+    q90 = np.repeat(np.nan_to_num(q90).astype(np.int64), counts)
+    middle = valid_time & has_time & (time > q10) & (time < q90)
+    std_bottom = group_std(np.where(middle, pressure, np.nan), np.repeat(np.arange(len(starts)), counts), len(starts))
+    flat = std_bottom < 0.2
+
+    threshold = np.where(flat, 0.9, 0.5) * np.fmax.reduceat(pressure, starts)
+    down_seg_size = _seg_sizes(pressure, group, threshold)
+    min_seg_size = _seg_sizes(pressure[::-1], group[::-1], threshold[::-1])[::-1]
+    nodown = flat & (down_seg_size == 1)
+    noup = flat & (min_seg_size == 1)
+
+    min_seg_size = np.repeat(min_seg_size, counts)
+    direction[pos <= min_seg_size] = True
+    direction[pos >= n - min_seg_size] = False
+
+    first_up = np.minimum.reduceat(np.where(~direction, pos, n), starts)
+    last_down = np.maximum.reduceat(np.where(direction, pos, -1), starts)
+    failed = np.repeat((first_up == counts) | (last_down == -1), counts)
+
+    types = np.full(len(group), 3, dtype=np.int64)
+    types[pos <= np.repeat(first_up, counts) - 1] = 2
+    types[pos >= np.repeat(last_down, counts) + 1] = 1
+    types[(types == 2) & np.repeat(nodown, counts)] = 3
+    types[(types == 1) & np.repeat(noup, counts)] = 3
+    return types, failed
+
+
+# Segments._parse (Moana branch) of every haul
+def _segments_moana(datetime, pressure, group):
+    starts, counts = _runs(group)
+    n = np.repeat(counts, counts)
+    pos = np.arange(len(group)) - np.repeat(starts, counts)
+
+    gap = np.full(len(group), np.nan)
+    gap[1:] = (datetime[1:] - datetime[:-1]) / np.timedelta64(1, 's')
+    gap[pos == 0] = np.nan
+    max_pressure = np.repeat(np.fmax.reduceat(pressure, starts), counts)
+    fishing = (gap > 180) & (pressure > max_pressure / 2)
+
+    has_fishing = np.repeat(np.logical_or.reduceat(fishing, starts), counts)
+    idx1 = np.repeat(np.minimum.reduceat(np.where(fishing, pos, n), starts), counts)
+    idx2 = np.repeat(np.maximum.reduceat(np.where(fishing, pos, -1), starts), counts)
+    idx = np.repeat(np.minimum.reduceat(np.where(pressure == max_pressure, pos, n), starts), counts)
+
+    types = np.full(len(group), 3, dtype=np.int64)
+    types[~has_fishing & (pos <= idx)] = 2
+    types[~has_fishing & (pos > idx)] = 1
+    types[has_fishing & (pos <= idx1 - 1)] = 2
+    types[has_fishing & (pos >= idx2 - 1)] = 1
+    return types, ~has_fishing & (idx == n)
+
+
+# Copy-free QC of one haul: the flags of QC(df, vessel, gear_type, zone, sensor_type, tests) as a new frame aligned to
+# the index of the input, which is only read (see QCBatch with key=None). Raises what QC would raise.
+def flag_table(df, vessel, gear_type, zone, sensor_type, tests=None, profiler=None):
+    batch = QCBatch(df, dict(vessel=vessel, gear_type=gear_type, zone=zone, sensor_type=sensor_type), None, tests,
+                    profiler)
+    for error in batch.errors.values():
+        raise error
+    return batch.flags
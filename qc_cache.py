@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import pandas as pd
+import numpy as np
+
+from QC import QC, is_datetime, as_datetime
+from qc_batch import QCBatch, _names, _values, _length
+import qc_kernels
+import qc_pipeline
+import land_mask
+import climatology
+import vessel_regions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Code and data the flags depend on: a change to any of them changes every key
+SOURCES = ['QC.py', 'qc_batch.py', 'qc_kernels.py', 'qc_jit.py', 'qc_pipeline.py', 'land_mask.py', 'climatology.py',
+           'vessel_regions.py']
+DATA = [land_mask.DEFAULT_PATH, climatology.DEFAULT_PATH, vessel_regions.DEFAULT_PATH]
+
+# Tests whose flags depend on the current time, re-run on every hit
+TIME_DEPENDENT = ['impossible_date', 'timing_gap']
+
+
+# Persistent cache of QC flags, so unchanged hauls are not QC'ed again (e.g. by the nightly reprocessing).
+# An entry is keyed by a hash of the input columns of the haul read by the selected tests (values as QC reads them:
+# float64, datetime64[ns]), its vessel, gear_type, zone and sensor_type, the selected tests, the kernel backend in use
+# (qc_kernels.backend(): Numba or NumPy) and version(): the source of the QC modules, the zone limits and the land mask,
+# climatology and regions files. It holds the flag columns of the haul (uint8, zlib compressed) in a SQLite file.
+# On a hit the stored flags are returned with the time-dependent tests (impossible_date, timing_gap) run again on the
+# haul and the aggregate flag recomputed; only the misses are QC'ed, in one QCBatch. Hauls on which QC fails are not
+# stored and are reported in errors as with QCBatch.
+# Once the entries take more than max_bytes the least recently used ones are evicted. hits, misses and evictions count
+# the hauls of this instance, stats() adds the size of the cache.
+class QCCache(object):
+    def __init__(self, path='qc_cache.sqlite', max_bytes=1 << 30, key='HAUL', tests=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.key = key
+        self.tests = tests
+        self.time_tests = [test.name for test in qc_pipeline.select(tests) if test.name in TIME_DEPENDENT]
+        self.version = version()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.errors = {}
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS flags (key TEXT PRIMARY KEY, rows INTEGER, columns TEXT, '
+                        'data BLOB, size INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS flags_used ON flags (used)')
+        self.db.commit()
+
+    # One long frame with a key column, meta indexed by the key (vessel, gear_type, zone, sensor_type): the flags of
+    # QCBatch(df, meta, key, tests)
+    def run_frame(self, df, meta):
+        return self._run(df, meta, self.key)
+
+    # One haul: the flags of qc_batch.flag_table(df, vessel, gear_type, zone, sensor_type, tests). Raises what QC would
+    # raise.
+    def flag_table(self, df, vessel, gear_type, zone, sensor_type):
+        flags = self._run(df, dict(vessel=vessel, gear_type=gear_type, zone=zone, sensor_type=sensor_type), None)
+        for error in self.errors.values():
+            raise error
+        return flags
+
+    def stats(self):
+        entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM flags').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': entries,
+                'bytes': size}
+
+    def clear(self):
+        self.db.execute('DELETE FROM flags')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self, df, meta, key):
+        self.errors = {}
+        names = _names(df)
+        if key is None:
+            codes, hauls = np.zeros(_length(df, names), dtype=np.intp), pd.Index([0])
+            table = pd.DataFrame([dict(meta)], index=hauls)
+        else:
+            codes, hauls = pd.factorize(_values(df, key))
+            table = meta
+        order = np.argsort(codes, kind='stable')
+        starts = np.searchsorted(codes[order], np.arange(len(hauls)))
+        stops = np.r_[starts[1:], len(order)].astype(np.int64)
+        rows = [order[a:b] for a, b in zip(starts, stops)]
+
+        keys = self._keys(df, names, table.loc[hauls], order, starts, stops)
+        stored = self._get(keys)
+        hit = np.array([k in stored for k in keys], dtype=bool)
+        self.hits += int(hit.sum())
+        self.misses += int((~hit).sum())
+
+        columns, kept = {}, np.zeros(len(codes), dtype=bool)
+        if not hit.all():
+            missed = ~hit[codes]
+            batch = QCBatch(_take(df, names, np.flatnonzero(missed)), meta, key, self.tests)
+            failed = [h for h in range(len(hauls)) if hauls[h] in batch.errors]
+            self.errors.update(batch.errors)
+            positions = np.flatnonzero(missed & ~np.isin(codes, failed))
+            for name in batch.flags.columns:
+                columns[name] = np.ones(len(codes), dtype=batch.flags[name].dtype)
+                columns[name][positions] = batch.flags[name].to_numpy()
+            kept[positions] = True
+            self._put([(keys[h], rows[h]) for h in np.flatnonzero(~hit) if h not in failed], columns)
+
+        if hit.any():
+            for h in np.flatnonzero(hit):
+                names_h, values = stored[keys[h]]
+                for name, column in zip(names_h, values):
+                    if name not in columns:
+                        columns[name] = np.ones(len(codes), dtype=np.int64 if name == 'type' else np.uint8)
+                    columns[name][rows[h]] = column
+                kept[rows[h]] = True
+            positions = np.flatnonzero(hit[codes])
+            if self.time_tests:
+                batch = QCBatch(_take(df, names, positions), meta, key, self.time_tests)
+                for name in batch.flags.columns:
+                    if name != 'flag':
+                        columns[name][positions] = batch.flags[name].to_numpy()
+            columns['flag'][positions] = np.maximum.reduce([values[positions] for name, values in columns.items()
+                                                            if name.startswith('flag_') and
+                                                            name not in QC.NOT_AGGREGATED])
+        self.db.commit()
+
+        index = df.index if isinstance(df, pd.DataFrame) else pd.RangeIndex(len(codes))
+        return pd.DataFrame({name: values[kept] for name, values in columns.items()}, index=index[kept])
+
+    # Key of every haul
+    def _keys(self, df, names, meta, order, starts, stops):
+        columns = [(name, _hashable(_values(df, name), name)[order]) for name in qc_pipeline.columns(self.tests)
+                   if name in names]
+        prefix = json.dumps([self.version, qc_kernels.backend(), qc_pipeline.plan(self.tests)]).encode()
+        keys = []
+        for h, (a, b) in enumerate(zip(starts, stops)):
+            digest = hashlib.sha256(prefix)
+            digest.update(json.dumps([str(meta[field].iloc[h]) for field in
+                                      ('vessel', 'gear_type', 'zone', 'sensor_type')]).encode())
+            for name, values in columns:
+                digest.update(name.encode())
+                digest.update(values[a:b].tobytes())
+            keys.append(digest.hexdigest())
+        return keys
+
+    # Stored flags of the keys found, marked as used now
+    def _get(self, keys):
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = 'SELECT key, rows, columns, data FROM flags WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            for key, rows, columns, data in self.db.execute(query, chunk):
+                names = json.loads(columns)
+                found[key] = names, np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(len(names), rows)
+        now = time.time()
+        self.db.executemany('UPDATE flags SET used = ? WHERE key = ?', [(now, key) for key in found])
+        return found
+
+    # Stores the flags of every (key, rows of the haul), then evicts down to max_bytes
+    def _put(self, entries, columns):
+        names = list(columns)
+        now = time.time()
+        records = []
+        for key, rows in entries:
+            data = zlib.compress(np.stack([columns[name][rows] for name in names]).astype(np.uint8).tobytes())
+            records.append((key, len(rows), json.dumps(names), data, len(data) + len(key), now))
+        self.db.executemany('INSERT OR REPLACE INTO flags VALUES (?, ?, ?, ?, ?, ?)', records)
+        self._evict()
+
+    def _evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM flags').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.db.execute('SELECT key, size FROM flags ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.db.executemany('DELETE FROM flags WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+
+# Fingerprint of the QC code, thresholds and data files
+def version():
+    digest = hashlib.sha256()
+    for name in SOURCES:
+        with open(os.path.join(HERE, name), 'rb') as f:
+            digest.update(f.read())
+    digest.update(json.dumps(QC.CLIMATOLOGY, sort_keys=True).encode())
+    for path in DATA:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(('%s %d %d' % (os.path.basename(path), stat.st_size, stat.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+# Values of a column as QC reads them
+def _hashable(values, name):
+    if name == 'DATETIME':
+        values = values if is_datetime(values) else as_datetime(values).to_numpy()
+        return np.ascontiguousarray(values, dtype='datetime64[ns]')
+    return np.ascontiguousarray(values, dtype=float)
+
+
+# Rows of the input as a frame of its columns
+def _take(df, names, positions):
+    if isinstance(df, pd.DataFrame):
+        return df.iloc[positions]
+    return pd.DataFrame({name: _values(df, name)[positions] for name in names})
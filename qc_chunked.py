@@ -0,0 +1,642 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import geopy.distance
+
+from QC import QC
+import land_mask
+import climatology
+import vessel_regions
+import qc_io
+import qc_kernels
+import qc_pipeline
+from qc_kernels import shift, neighbours, rolling_mean
+
+
+# Out-of-core QC of one long time series (e.g. the archive of a moored logger) that does not fit in memory.
+# The input file (any qc_io format) is read once, batch by batch, and its columns are spilled to flat files in a
+# scratch directory. Every test then walks the series chunk by chunk, reading back only the rows of the chunk with the
+# overlap the test needs around it (the previous sample for speed and the Moana gaps, +-2 samples for spike, rollover
+# and stuck, the 10-sample centered window of the direction smoothing), and writes its flags to uint8 flat files.
+# Nothing is memory-mapped, so the pages of the scratch files never count in the memory of the process.
+# The values that depend on the whole series are reduced over the chunks first:
+#  - the pressure and time quantiles of the segmentation are exact order statistics, selected 16 bits at a time
+#  - the standard deviations (bottom pressure, rate of change per segment) sum the samples in order, each chunk on
+#    top of the totals of the previous ones, so the sums are the ones of a single pass (as in qc_kernels.group_std)
+#  - the segmentation reduces to the boundaries of the down cast and of the up cast
+#  - the mud test rolls its 10-sample window over the deeper half of the casts with the samples of the next chunk
+# so the flags are the same as QC on the whole frame, and memory is bounded by chunk_size whatever the size of the
+# series. Peak memory is a few arrays of chunk_size samples, plus 65536 counts per quantile.
+class QCChunked(object):
+    def __init__(self, path, vessel, gear_type, zone, sensor_type, tests=None, chunk_size=1000000, columns=None,
+                 scratch=None, profiler=None):
+        self.vessel = vessel
+        self.gear = gear_type
+        self.zone = zone
+        self.sensor_type = sensor_type
+        self.chunk_size = chunk_size
+        self.distance = None
+        self.dir = tempfile.mkdtemp(prefix='qc_chunked_', dir=scratch)
+        try:
+            self.data = self._spill(path, columns, tests)
+            self.n = len(self.data['DATETIME'])
+            self.salinity = 'SALINITY' in self.data
+            self.speed = 'SPEED' in self.data
+            # segmentation: type 2 before down_end, up_type (1, or 3 without up cast) from up_start
+            self.down_end, self.up_start, self.up_type = None, None, None
+            self.columns = {}
+            self._new('flag')
+            for step in qc_pipeline.plan(tests, fuse=profiler is None) + ['aggregate_flag']:
+                if profiler is None:
+                    getattr(self, step)()
+                else:
+                    profiler.run(self, step)
+        except Exception:
+            self.close()
+            raise
+
+    # Same tests, in the same order, as QC
+
+    def regions(self):
+        self._new('flag_vessel_region')
+        registry = vessel_regions.load()
+        for start, stop in self._chunks():
+            outside = registry.outside(self.zone, self._read('LATITUDE', start, stop),
+                                       self._read('LONGITUDE', start, stop))
+            self._set('flag_vessel_region', start, outside, 3)
+
+    def gear_type(self):
+        self._new('flag_gear_type')
+        coords_1 = self.data['LATITUDE'][0], self.data['LONGITUDE'][0]
+        coords_2 = self.data['LATITUDE'][-1], self.data['LONGITUDE'][-1]
+        self.distance = geopy.distance.geodesic(coords_1, coords_2).m
+        gt = 1 if self.distance > 200 else 0
+        if (gt == 1 and self.gear == 'Fixed') or (gt == 0 and self.gear == 'Mobile'):
+            self._fill('flag_gear_type', 3)
+
+    def impossible_date(self):
+        self._new('flag_date')
+        currdate = np.datetime64(datetime.utcnow())
+        mindate = np.datetime64(datetime(2010, 1, 1))
+        for start, stop in self._chunks():
+            dt = self._read('DATETIME', start, stop)
+            self._set('flag_date', start, (dt > currdate) | (dt < mindate), 4)
+
+    def impossible_location(self):
+        self._new('flag_location')
+        for start, stop in self._chunks():
+            lat, lon = self._read('LATITUDE', start, stop), self._read('LONGITUDE', start, stop)
+            self._set('flag_location', start, (lat < -90) | (lat > 90) | (lon < -180) | (lon > 180), 4)
+
+    def position_on_land(self):
+        mask = land_mask.load()
+        if mask is None:
+            return
+        self._new('flag_land')
+        for start, stop in self._chunks():
+            self._set('flag_land', start, mask.is_land(self._read('LATITUDE', start, stop),
+                                                       self._read('LONGITUDE', start, stop)), 4)
+
+    def impossible_speed(self):
+        self._new('flag_speed')
+        # times from the first sample of the series, as QC does on the whole track
+        origin = self.data['DATETIME'][0]
+        for start, rows, chunk in self._halo(['LATITUDE', 'LONGITUDE', 'DATETIME', 'SPEED'], 1, 0):
+            flags = qc_kernels.impossible_speed(chunk['LATITUDE'], chunk['LONGITUDE'], chunk['DATETIME'],
+                                                chunk.get('SPEED'), origin=origin)
+            self._write('flag_speed', start, flags[rows])
+
+    def global_range(self):
+        max_press, min_temp, max_temp, min_sal, max_sal = [np.nan if limit is None else limit
+                                                           for limit in QC.global_limits(self.sensor_type,
+                                                                                         self.salinity)]
+
+        self._new('flag_global_range')
+        for start, stop in self._chunks():
+            pressure, temperature = self._read('PRESSURE', start, stop), self._read('TEMPERATURE', start, stop)
+            self._set('flag_global_range', start, (pressure >= -5) & (pressure < 0), 3)
+            self._set('flag_global_range', start, pressure > max_press, 3)
+            self._set('flag_global_range', start, pressure < -5, 4)
+            self._set('flag_global_range', start, (temperature < min_temp) | (temperature > max_temp), 4)
+            if self.salinity:
+                salinity = self._read('SALINITY', start, stop)
+                self._set('flag_global_range', start, (salinity < min_sal) | (salinity > max_sal), 4)
+
+    def neighbour_tests(self):
+        self.parse_segments()
+        self._neighbour_tests(qc_pipeline.FUSED['neighbour_tests'])
+
+    def spike(self):
+        self._neighbour_tests(['spike'])
+
+    def rollover(self):
+        self.parse_segments()
+        self._neighbour_tests(['rollover'])
+
+    def stuck(self):
+        self.parse_segments()
+        self._neighbour_tests(['stuck'])
+
+    def rate_of_change(self):
+        self.parse_segments()
+        self._neighbour_tests(['rate_of_change'])
+
+    def timing_gap(self):
+        self._new('flag_timing_gap')
+        currdate = np.datetime64(datetime.utcnow())
+        tim_inc = 24  # hours
+        time_gap = (currdate - self.data['DATETIME'][-1]) / np.timedelta64(1, 's')
+        if time_gap / 3600 > tim_inc:
+            self._fill('flag_timing_gap', 3)
+
+    def climatology(self):
+        zone_limits = QC.zone_limits(self.zone)
+        self._new('flag_clima')
+        for start, stop in self._chunks():
+            temperature = self._read('TEMPERATURE', start, stop)
+            min_temp, max_temp, min_sal, max_sal = climatology.limits(
+                zone_limits, self._read('DATETIME', start, stop), self._read('PRESSURE', start, stop),
+                self._read('LATITUDE', start, stop), self._read('LONGITUDE', start, stop))
+            self._set('flag_clima', start, (temperature < min_temp) | (temperature > max_temp), 3)
+            if self.salinity:
+                salinity = self._read('SALINITY', start, stop)
+                self._set('flag_clima', start, (salinity < min_sal) | (salinity > max_sal), 3)
+
+    def drift(self):
+        self._new('flag_drift')
+        self.parse_segments()
+        bottom = self._bottom()
+        if bottom is None:
+            return
+        first, last = bottom
+        # QC.drift compares Timedelta.seconds, which never reaches a day, against 24 hours: the time window always passes
+        temperature = self.data['TEMPERATURE']
+        if abs(temperature[first] - temperature[last]) > 3:
+            self._fill('flag_drift', 3)
+        if self.salinity and abs(self.data['SALINITY'][first] - self.data['SALINITY'][last]) > 8:
+            self._fill('flag_drift', 3)
+
+    # qc_kernels.mud on the whole series: the flat rolling temperature changes of the deeper half of the up and down
+    # casts are counted chunk by chunk, and the crossover walks the up cast forward and the down cast backward
+    def mud(self):
+        self.parse_segments()
+        self._new('flag_mud')
+        threshold = 0.005
+        up_max = self._reduce(np.fmax, lambda start, stop, p, types: np.where(types == 1, p, np.nan))
+        down_max = self._reduce(np.fmax, lambda start, stop, p, types: np.where(types == 2, p, np.nan))
+        shallow = self._reduce(np.fmax, lambda start, stop, p, types: p) < 100
+
+        n_up, n_flat_up, last_flat = 0, 0, -1
+        for pos, mean in self._rolling_temp_diff(1, up_max):
+            flat = np.abs(mean) < threshold
+            n_up += len(pos)
+            n_flat_up += int(flat.sum())
+            if flat.any():
+                last_flat = int(pos[flat][-1])
+        n_flat_down = sum(int((np.abs(mean) < threshold).sum()) for pos, mean in self._rolling_temp_diff(2, down_max))
+
+        muddy = not shallow and n_flat_up > 0 and n_flat_down < 2 and n_flat_up > 10
+        if not muddy or self.up_type != 1 or self.up_start >= self.n:
+            return
+        if n_flat_up / n_up > 0.9:
+            self._fill('flag_mud', 3, self.up_start)
+            return
+        inter_point = self._crossover(last_flat)
+        if inter_point > self.up_start:
+            self._fill('flag_mud', 3, self.up_start, inter_point)
+
+    def aggregate_flag(self):
+        names = [name for name in self.columns if name not in QC.NOT_AGGREGATED]
+        for start, stop in self._chunks():
+            self.columns['flag'][start:stop] = np.maximum.reduce([self.columns[name][start:stop] for name in names])
+
+    # The boundaries of Segments._parse, computed over the chunks. A series on which QC raises the IndexError of the
+    # segmentation raises it here too.
+    def parse_segments(self):
+        if self.down_end is not None:
+            return
+        if 'Moana' in self.sensor_type:
+            self._segments_moana()
+        else:
+            self._segments_profile()
+
+    # Output
+
+    # Rows and flag columns, as seen by qc_profile (which loads a whole flag column, n bytes)
+    def rows(self):
+        return self.n
+
+    def flag_values(self, name):
+        return self.columns[name][:] if name in self.columns else None
+
+    # The flags (and type) of rows start to stop, as QCBatch.flags
+    def flag_table(self, start=0, stop=None):
+        stop = self.n if stop is None else min(stop, self.n)
+        columns = {name: values[start:stop] for name, values in self.columns.items()}
+        if self.down_end is not None:
+            columns['type'] = self._types(start, stop)
+        return pd.DataFrame(columns, index=pd.RangeIndex(start, stop))
+
+    # The input columns with their flags, written to a Parquet file chunk by chunk (as qc_io.run)
+    def write(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for start, stop in self._chunks():
+                flags = self.flag_table(start, stop)
+                df = pd.DataFrame({name: self._read(name, start, stop) for name in self.data if name not in flags},
+                                  index=flags.index)
+                table = pa.Table.from_pandas(pd.concat([df, flags], axis=1), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+
+    # Removes the scratch files
+    def close(self):
+        self.data, self.columns = {}, {}
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Helpers
+
+    # Every column read from path goes to a flat file of the scratch directory
+    def _spill(self, path, columns, tests):
+        files, dtypes, n = {}, {}, 0
+        try:
+            for df in qc_io.iter_batches(path, self.chunk_size, columns, tests):
+                for name in df.columns:
+                    if name not in files:
+                        values = df[name].to_numpy()
+                        dtypes[name] = values.dtype if name == 'DATETIME' else np.dtype(float)
+                        files[name] = open(os.path.join(self.dir, name + '.bin'), 'wb')
+                    df[name].to_numpy(dtype=dtypes[name]).tofile(files[name])
+                n += len(df)
+        finally:
+            for f in files.values():
+                f.close()
+        if n == 0:
+            raise ValueError('No samples in %s' % path)
+        return {name: _Column(os.path.join(self.dir, name + '.bin'), dtypes[name], n) for name in files}
+
+    def _chunks(self, reverse=False):
+        starts = range(0, self.n, self.chunk_size)
+        for start in (reversed(starts) if reverse else starts):
+            yield start, min(start + self.chunk_size, self.n)
+
+    # Rows start to stop of a column, in memory
+    def _read(self, name, start, stop):
+        return self.data[name][max(start, 0):min(stop, self.n)]
+
+    # Every chunk with before/after samples around it (fewer at the ends of the series): yields the start of the
+    # chunk, the slice of the chunk in the arrays and the arrays of the given columns (and type, once segmented)
+    def _halo(self, names, before, after):
+        for start, stop in self._chunks():
+            lo, hi = max(start - before, 0), min(stop + after, self.n)
+            chunk = {name: self._read(name, lo, hi) for name in names if name in self.data}
+            if self.down_end is not None:
+                chunk['type'] = self._types(lo, hi)
+            yield start, slice(start - lo, stop - lo), chunk
+
+    def _types(self, start, stop):
+        pos = np.arange(start, stop)
+        types = np.full(len(pos), 3, dtype=np.int64)
+        types[pos < self.down_end] = 2
+        types[pos >= self.up_start] = self.up_type
+        return types
+
+    # First and last sample of the bottom (type 3), None without bottom
+    def _bottom(self):
+        if self.up_type == 3:
+            first, last = min(self.down_end, self.up_start), self.n - 1
+        else:
+            first, last = self.down_end, self.up_start - 1
+        return (first, last) if first <= last else None
+
+    def _new(self, name):
+        if name not in self.columns:
+            self.columns[name] = _Column(os.path.join(self.dir, name + '.flag'), np.uint8, self.n)
+        self._fill(name, 1)
+
+    def _fill(self, name, value, start=0, stop=None):
+        stop = self.n if stop is None else stop
+        for chunk in range(start, stop, self.chunk_size):
+            self.columns[name][chunk:min(chunk + self.chunk_size, stop)] = value
+
+    def _set(self, name, start, mask, value):
+        values = self.columns[name][start:start + len(mask)]
+        values[mask] = value
+        self.columns[name][start:start + len(mask)] = values
+
+    def _write(self, name, start, values):
+        if name not in self.columns:
+            self._new(name)
+        self.columns[name][start:start + len(values)] = values
+
+    # Spike, rollover, stuck and rate of change over the chunks, +-2 samples around each, in QC column order
+    def _neighbour_tests(self, tests):
+        sd = {}
+        if 'rate_of_change' in tests:
+            for name in ['TEMPERATURE', 'SALINITY'] if self.salinity else ['TEMPERATURE']:
+                sd[name] = self._group_std(name, lambda start, stop: self._types(start, stop), 4)
+        for start, rows, chunk in self._halo(['TEMPERATURE', 'PRESSURE', 'SALINITY'], 2, 2):
+            temperature, pressure, types = chunk['TEMPERATURE'], chunk['PRESSURE'], chunk.get('type')
+            salinity = chunk.get('SALINITY')
+            temp = neighbours(temperature)
+            sal = neighbours(salinity) if salinity is not None else None
+            flags = {}
+            if 'spike' in tests:
+                flags['flag_temp_spike'] = qc_kernels.spike(temperature, temp, pressure, 6, 2)
+                if sal is not None:
+                    flags['flag_sal_spike'] = qc_kernels.spike(salinity, sal, pressure, 0.9, 0.3)
+            if 'rollover' in tests:
+                flags['flag_rollover'] = qc_kernels.rollover(temperature, temp, types)
+            if 'stuck' in tests:
+                flags['flag_temp_stuck'] = qc_kernels.stuck(temperature, temp, types)
+                if sal is not None:
+                    flags['flag_sal_stuck'] = qc_kernels.stuck(salinity, sal, types)
+            if 'rate_of_change' in tests:
+                flags['flag_RoC'] = qc_kernels.rate_of_change(temperature, temp, types, sd=sd['TEMPERATURE'])
+                if sal is not None:
+                    flags['flag_RoC'] = np.maximum(flags['flag_RoC'], qc_kernels.rate_of_change(
+                        salinity, sal, types, sd=sd['SALINITY']))
+            for name, values in flags.items():
+                self._write(name, start, values[rows])
+
+    # qc_kernels.group_std of a column over the whole series, key(start, stop) giving the key of the rows.
+    # np.bincount adds the weights in order: the totals of the previous chunks are passed first, one per key.
+    def _group_std(self, name, key, length, values=None):
+        values = values or (lambda start, stop: self._read(name, start, stop))
+        seed = np.arange(length)
+        count, total, squares = np.zeros(length, dtype=np.int64), np.zeros(length), np.zeros(length)
+        for start, stop in self._chunks():
+            v, k = values(start, stop), key(start, stop)
+            valid = ~np.isnan(v)
+            count += np.bincount(k[valid], minlength=length)
+            total = np.bincount(np.r_[seed, k[valid]], np.r_[total, v[valid]], minlength=length)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        for start, stop in self._chunks():
+            v, k = values(start, stop), key(start, stop)
+            valid = ~np.isnan(v)
+            squares = np.bincount(np.r_[seed, k[valid]], np.r_[squares, (v[valid] - mean[k[valid]]) ** 2],
+                                  minlength=length)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = squares / (count - 1)
+        return np.sqrt(np.where(count > 1, var, np.nan))
+
+    # ufunc reduction of values(start, stop, pressure, types) over the chunks (types None before the segmentation)
+    def _reduce(self, ufunc, values):
+        out = np.nan
+        for start, stop in self._chunks():
+            types = self._types(start, stop) if self.down_end is not None else None
+            chunk = values(start, stop, self._read('PRESSURE', start, stop), types)
+            out = ufunc(out, ufunc.reduce(chunk)) if len(chunk) else out
+        return out
+
+    # Series.quantile(q) of a column, for every q (linear interpolation as in qc_batch._quantile)
+    def _quantiles(self, name, qs):
+        n = 0
+        for start, stop in self._chunks():
+            n += int((~_missing(self._read(name, start, stop))).sum())
+        if n == 0:
+            return [np.nan] * len(qs)
+        ranks = []
+        for q in qs:
+            virtual = (n - 1) * q
+            previous = n - 1 if virtual >= n - 1 else int(np.floor(virtual))
+            following = previous if virtual >= n - 1 else previous + 1
+            ranks.append((virtual - np.floor(virtual), previous, following))
+        values = self._select(name, sorted(set(r for _, previous, following in ranks for r in (previous, following))))
+        out = []
+        for gamma, previous, following in ranks:
+            a, b = values[previous], values[following]
+            diff = b - a
+            out.append(b - diff * (1 - gamma) if gamma >= 0.5 else a + diff * gamma)
+        return out
+
+    # Exact order statistics (0-based ranks among the non-missing values) of a column: the values are mapped to
+    # unsigned keys in the same order and every pass over the chunks counts the next 16 bits of the keys sharing the
+    # bits already found, 4 passes in all
+    def _select(self, name, ranks):
+        prefix = {rank: 0 for rank in ranks}
+        remaining = {rank: rank for rank in ranks}
+        dtype = self.data[name].dtype
+        for bit in (48, 32, 16, 0):
+            counts = {rank: np.zeros(1 << 16, dtype=np.int64) for rank in ranks}
+            for start, stop in self._chunks():
+                values = self._read(name, start, stop)
+                keys = _keys(values[~_missing(values)])
+                digits = (keys >> np.uint64(bit)) & np.uint64(0xFFFF)
+                for rank in ranks:
+                    match = digits if bit == 48 else digits[(keys >> np.uint64(bit + 16)) == np.uint64(prefix[rank])]
+                    counts[rank] += np.bincount(match.astype(np.int64), minlength=1 << 16)
+            for rank in ranks:
+                cumulative = np.cumsum(counts[rank])
+                digit = int(np.searchsorted(cumulative, remaining[rank], side='right'))
+                remaining[rank] -= int(cumulative[digit - 1]) if digit else 0
+                prefix[rank] = (prefix[rank] << 16) | digit
+        return {rank: _values(np.array([prefix[rank]], dtype=np.uint64), dtype)[0] for rank in ranks}
+
+    # qc_kernels.seg_size of the series (of the series reversed)
+    def _seg_size(self, threshold, reverse=False):
+        running = np.nan
+        for start, stop in self._chunks(reverse):
+            pressure = self._read('PRESSURE', start, stop)
+            if reverse:
+                pressure = pressure[::-1]
+            cummax = np.fmax.accumulate(np.r_[running, pressure])[1:]
+            below = cummax < threshold
+            if not below.all():
+                i = int(np.argmin(below))
+                return self.n - (stop - 1 - i) if reverse else start + i + 1
+            running = cummax[-1]
+        return self.n
+
+    # Segments._parse, non-Moana branch (as qc_batch._segments_profile)
+    def _segments_profile(self):
+        max_pressure = self._reduce(np.fmax, lambda start, stop, p, types: p)
+        q90 = self._quantiles('PRESSURE', [0.9])[0]
+        max_gap = self._reduce(np.fmax, lambda start, stop, p, types: np.abs(p - q90))
+
+        # DatetimeArray quantiles are truncated back to the datetime unit
+        q10_time, q90_time = self._quantiles('DATETIME', [0.1, 0.9])
+        has_time = not np.isnan(q10_time)
+        q10_time, q90_time = np.int64(np.nan_to_num(q10_time)), np.int64(np.nan_to_num(q90_time))
+
+        def middle(start, stop):
+            time = self._read('DATETIME', start, stop)
+            valid = ~np.isnat(time)
+            time = time.view(np.int64)
+            inside = valid & has_time & (time > q10_time) & (time < q90_time)
+            return np.where(inside, self._read('PRESSURE', start, stop), np.nan)
+
+        std_bottom = self._group_std('PRESSURE', lambda start, stop: np.zeros(stop - start, dtype=np.int64), 1,
+                                     middle)[0]
+        flat = std_bottom < 0.2
+        threshold = (0.9 if flat else 0.5) * max_pressure
+        down_seg_size = self._seg_size(threshold)
+        min_seg_size = self._seg_size(threshold, reverse=True)
+        nodown = flat and down_seg_size == 1
+        noup = flat and min_seg_size == 1
+
+        # True down and False up, smoothed over 10 samples (5 before, 4 after) near the bottom
+        first_up, last_down = self.n, -1
+        for start, rows, chunk in self._halo(['PRESSURE'], 6, 4):
+            pressure = chunk['PRESSURE']
+            near_bottom = np.abs(pressure - q90) > 0.5 * max_gap
+            direction = qc_kernels.direction(pressure, near_bottom)[rows]
+            pos = np.arange(start, start + len(direction))
+            direction[pos <= min_seg_size] = True
+            direction[pos >= self.n - min_seg_size] = False
+            if first_up == self.n and not direction.all():
+                first_up = start + int(np.argmin(direction))
+            if direction.any():
+                last_down = start + len(direction) - 1 - int(np.argmax(direction[::-1]))
+        if first_up == self.n or last_down == -1:
+            raise IndexError('single positional indexer is out-of-bounds')
+
+        self.down_end = 0 if nodown else first_up
+        self.up_start, self.up_type = last_down + 1, 3 if noup else 1
+
+    # Segments._parse, Moana branch: fishing is a gap of more than 3 minutes below half the maximum pressure
+    def _segments_moana(self):
+        max_pressure = self._reduce(np.fmax, lambda start, stop, p, types: p)
+        first_fishing, last_fishing, deepest = None, None, None
+        for start, rows, chunk in self._halo(['DATETIME', 'PRESSURE'], 1, 0):
+            time, pressure = chunk['DATETIME'], chunk['PRESSURE']
+            gap = np.full(len(time), np.nan)
+            gap[1:] = (time[1:] - time[:-1]) / np.timedelta64(1, 's')
+            fishing = np.flatnonzero(((gap > 180) & (pressure > max_pressure / 2))[rows])
+            if len(fishing):
+                first_fishing = start + fishing[0] if first_fishing is None else first_fishing
+                last_fishing = start + fishing[-1]
+            if deepest is None and (pressure[rows] == max_pressure).any():
+                deepest = start + int(np.argmax(pressure[rows] == max_pressure))
+
+        if first_fishing is None:
+            if deepest is None:
+                raise IndexError('index 0 is out of bounds for axis 0 with size 0')
+            self.down_end, self.up_start = deepest + 1, deepest + 1
+        else:
+            self.down_end, self.up_start = first_fishing, max(last_fishing - 1, 0)
+        self.up_type = 1
+
+    # Rolling mean (10 samples, centered) of the temperature change over the deeper half of a cast, as
+    # qc_kernels.mud: the window runs over the selected samples only, so the last samples of every chunk wait for the
+    # selected samples of the next one. Yields the positions and rolling means, in order.
+    def _rolling_temp_diff(self, cast, max_pressure, window=10):
+        before, after = window // 2, window - window // 2 - 1
+        positions, values, done = np.zeros(0, dtype=np.int64), np.zeros(0), 0
+        for start, rows, chunk in self._halo(['TEMPERATURE', 'PRESSURE'], 1, 0):
+            temperature = chunk['TEMPERATURE']
+            temp_diff = (temperature - shift(temperature, 1))[rows]
+            selected = np.flatnonzero((chunk['type'][rows] == cast) & (chunk['PRESSURE'][rows] > max_pressure / 2))
+            positions, values = np.r_[positions, start + selected], np.r_[values, temp_diff[selected]]
+            ready = len(values) - after
+            if ready > done:
+                mean = rolling_mean(values, window)
+                yield positions[done:ready], mean[done:ready]
+                keep = max(ready - before, 0)
+                positions, values, done = positions[keep:], values[keep:], ready - keep
+        if len(values) > done:
+            yield positions[done:], rolling_mean(values, window)[done:]
+
+    # qc_kernels._crossover: first sample of the up cast, after last_flat + 1, colder than or as warm as the down cast
+    # sample of the same rank from the bottom (0 when they never cross)
+    def _crossover(self, last_flat):
+        first = max(self.up_start, last_flat + 2)
+        if first >= self.n:
+            return 0
+        deepest = self._reduce(np.fmax, lambda start, stop, p, types: np.where(
+            np.arange(start, stop) >= first, p, np.nan))
+        down_end = min(self.down_end, self.up_start)
+        rank = 0
+        for start, stop in self._chunks(reverse=True):
+            if start >= down_end:
+                continue
+            stop = min(stop, down_end)
+            down = np.flatnonzero(self._read('PRESSURE', start, stop) < deepest)[::-1][:self.n - first - rank]
+            if len(down) == 0:
+                if rank >= self.n - first:
+                    break
+                continue
+            down_temperature = self._read('TEMPERATURE', start, stop)[down]
+            up_temperature = self._read('TEMPERATURE', first + rank, first + rank + len(down))
+            crossed = np.flatnonzero(down_temperature <= up_temperature)
+            if len(crossed):
+                return first + rank + int(crossed[0])
+            rank += len(down)
+        return 0
+
+
+# A column stored in a flat file, read and written by slices of rows (a row by an integer)
+class _Column(object):
+    def __init__(self, path, dtype, n):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n = n
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(n * self.dtype.itemsize)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(self.n)
+            return np.fromfile(self.path, dtype=self.dtype, count=max(stop - start, 0),
+                               offset=start * self.dtype.itemsize)
+        row = rows + self.n if rows < 0 else rows
+        return self[row:row + 1][0]
+
+    def __setitem__(self, rows, values):
+        start, stop, _ = rows.indices(self.n)
+        values = np.ascontiguousarray(np.broadcast_to(np.asarray(values, dtype=self.dtype), (max(stop - start, 0),)))
+        with open(self.path, 'r+b') as f:
+            f.seek(start * self.dtype.itemsize)
+            values.tofile(f)
+
+
+# Missing values: NaN, or NaT for datetimes
+def _missing(values):
+    return np.isnat(values) if values.dtype.kind == 'M' else np.isnan(values)
+
+
+# Unsigned keys in the order of the values (float64 or datetime64 as int64), and back
+def _keys(values):
+    sign = np.uint64(1 << 63)
+    if values.dtype.kind == 'f':
+        bits = values.astype(np.float64).view(np.uint64)
+        return np.where(bits & sign, ~bits, bits | sign)
+    return values.view(np.int64).view(np.uint64) ^ sign
+
+
+def _values(keys, dtype):
+    sign = np.uint64(1 << 63)
+    if dtype.kind == 'f':
+        return np.where(keys & sign, keys ^ sign, ~keys).view(np.float64)
+    return (keys ^ sign).view(np.int64)
+
+
+# Runs QCChunked on path and writes the input columns with their flags to output (Parquet); returns the number of rows
+def run(path, vessel, gear_type, zone, sensor_type, output, tests=None, chunk_size=1000000, columns=None,
+        scratch=None, profiler=None):
+    with QCChunked(path, vessel, gear_type, zone, sensor_type, tests, chunk_size, columns, scratch,
+                   profiler) as qc:
+        qc.write(output)
+        return qc.rows()
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import qc_pipeline
+from QC import as_datetime
+from qc_batch import QCBatch
+
+# Columnar input/output for QC: Parquet and Arrow/Feather (pyarrow), NumPy .npz, and CSV.
+# Only the columns the selected tests read (qc_pipeline.columns) and the key are loaded. Parquet and Arrow keep
+# DATETIME as a timestamp column, and .npz as a datetime64 array, so nothing is parsed again on the way to QC. CSV
+# DATETIME is parsed once here. Flags are written as uint8 columns.
+# run() streams a Parquet (or CSV) archive of hauls stored one after the other by row groups of batch_size rows,
+# runs QCBatch on the complete hauls of every batch and appends their flags to a Parquet file, so memory stays
+# bounded by the batch (plus one haul) whatever the size of the archive.
+
+PARQUET, ARROW, NPZ, CSV = '.parquet', '.arrow', '.npz', '.csv'
+FORMATS = {'.parquet': PARQUET, '.pq': PARQUET, '.arrow': ARROW, '.feather': ARROW, '.npz': NPZ, '.csv': CSV}
+
+
+def file_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError('Unsupported file format: %s' % path)
+    return FORMATS[ext]
+
+
+# Column names stored in the file, read from its schema or header only
+def file_columns(path):
+    fmt = file_format(path)
+    if fmt == PARQUET:
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+    if fmt == ARROW:
+        import pyarrow.feather as feather
+        return feather.read_table(path, memory_map=True).schema.names
+    if fmt == NPZ:
+        with np.load(path) as data:
+            return list(data.files)
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+# Columns to load: the given ones, else the inputs of the selected tests, plus the key, when the file has them
+def projection(path, columns=None, tests=None, key=None):
+    available = file_columns(path)
+    wanted = list(columns) if columns is not None else qc_pipeline.columns(tests)
+    if key is not None and key not in wanted:
+        wanted.append(key)
+    return [c for c in wanted if c in available]
+
+
+def read(path, columns=None, tests=None, key=None):
+    fmt = file_format(path)
+    columns = projection(path, columns, tests, key)
+    if fmt == PARQUET:
+        import pyarrow.parquet as pq
+        df = pq.read_table(path, columns=columns).to_pandas()
+    elif fmt == ARROW:
+        import pyarrow.feather as feather
+        df = feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    elif fmt == NPZ:
+        with np.load(path) as data:
+            df = pd.DataFrame({c: data[c] for c in columns})
+    else:
+        df = pd.read_csv(path, usecols=columns)
+    return _typed(df)
+
+
+# Frames of at most batch_size rows (Parquet row groups, CSV chunks). With a key, a haul is never split: the rows of
+# the last haul of a batch are held back and sent with the next one.
+def iter_batches(path, batch_size=1000000, columns=None, tests=None, key=None):
+    fmt = file_format(path)
+    columns = projection(path, columns, tests, key)
+    if fmt == PARQUET:
+        import pyarrow.parquet as pq
+        # without pre-buffering, the reader only holds the pages of the batch it decodes
+        parquet = pq.ParquetFile(path, pre_buffer=False)
+        batches = (b.to_pandas() for b in parquet.iter_batches(batch_size=batch_size, columns=columns))
+    elif fmt == CSV:
+        batches = pd.read_csv(path, usecols=columns, chunksize=batch_size)
+    else:
+        df = read(path, columns)
+        batches = (df.iloc[i:i + batch_size] for i in range(0, len(df), batch_size))
+
+    start, held = 0, None
+    for df in batches:
+        df = _typed(df).set_axis(pd.RangeIndex(start, start + len(df)))
+        start += len(df)
+        if held is not None:
+            df = pd.concat([held, df])
+        if key is None or len(df) == 0:
+            held = None
+            yield df
+            continue
+        last = df[key].iloc[-1]
+        keep = df[key].to_numpy() != last
+        first_held = len(keep) - int(np.argmax(keep[::-1])) if keep.any() else 0
+        held = df.iloc[first_held:]
+        if first_held:
+            yield df.iloc[:first_held]
+    if held is not None and len(held):
+        yield held
+
+
+def write(path, df):
+    fmt = file_format(path)
+    df = df.astype({c: np.uint8 for c in df.columns if c.startswith('flag')})
+    if fmt == PARQUET:
+        df.to_parquet(path, index=False)
+    elif fmt == ARROW:
+        df.reset_index(drop=True).to_feather(path)
+    elif fmt == NPZ:
+        np.savez(path, **{c: df[c].to_numpy() for c in df.columns})
+    else:
+        df.to_csv(path, index=False)
+
+
+# Streams the hauls of path (key column, meta indexed by the key) through QCBatch and writes the input columns with
+# the flags to output (Parquet). Returns the errors of the hauls left out, as QCBatch.errors.
+def run(path, meta, output, key='HAUL', tests=None, batch_size=1000000, columns=None, profiler=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    errors, writer = {}, None
+    try:
+        for df in iter_batches(path, batch_size, columns, tests, key):
+            batch = QCBatch(df, meta, key, tests, profiler)
+            errors.update(batch.errors)
+            if len(batch.flags) == 0:
+                continue
+            flags = batch.flags
+            out = pd.concat([df.loc[flags.index].drop(columns=[c for c in flags.columns if c in df]), flags], axis=1)
+            table = pa.Table.from_pandas(out, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output, table.schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    return errors
+
+
+def _typed(df):
+    if 'DATETIME' in df:
+        df['DATETIME'] = as_datetime(df['DATETIME'])
+    return df
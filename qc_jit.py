@@ -0,0 +1,209 @@
+import numpy as np
+import numba
+
+# Numba versions of the loop kernels of qc_kernels, with the same arguments and the same results: the direction
+# smoothing and threshold crossing of the segmentation, spike, stuck value and mud. Each one is a single loop over the
+# arrays instead of a chain of array temporaries.
+# qc_kernels uses them when Numba is installed (importing this module raises ImportError otherwise). They are compiled
+# on first use and cached to disk (cache=True: __pycache__ next to this file, or NUMBA_CACHE_DIR), so only the first
+# process after a change of this file pays for the compilation.
+
+_NO_GROUP = np.zeros(0, dtype=np.int64)
+
+
+def _float(values):
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+
+def _int(values):
+    return np.ascontiguousarray(values, dtype=np.int64)
+
+
+def _group(group):
+    return _NO_GROUP if group is None else _int(group)
+
+
+def direction(pressure, where, group=None):
+    return _direction(_float(pressure), np.ascontiguousarray(where, dtype=np.bool_), _group(group))
+
+
+def seg_size(pressure, threshold):
+    return int(_seg_size(_float(pressure), float(threshold)))
+
+
+def spike(values, near, pressure, shallow, deep):
+    return _spike(_float(values), _float(near[1]), _float(near[-1]), _float(pressure), float(shallow), float(deep))
+
+
+def stuck(values, near, types):
+    return _stuck(_float(values), _float(near[2]), _float(near[1]), _float(near[-1]), _float(near[-2]), _int(types))
+
+
+def mud(temperature, pressure, types, group=None, threshold=0.005):
+    return _mud(_float(temperature), _float(pressure), _int(types), _group(group), float(threshold))
+
+
+# Compiled kernels. An empty group stands for a single haul.
+
+@numba.njit(cache=True, nogil=True)
+def _same_haul(group, i, j):
+    return len(group) == 0 or group[i] == group[j]
+
+
+@numba.njit(cache=True, nogil=True)
+def _direction(pressure, where, group):
+    n = len(pressure)
+    rising = np.zeros(n, dtype=np.bool_)
+    for i in range(1, n):
+        rising[i] = _same_haul(group, i, i - 1) and pressure[i - 1] < pressure[i]
+    out = rising.copy()
+    for i in range(n):
+        if not where[i]:
+            continue
+        total, count = 0, 0
+        for j in range(max(i - 5, 0), min(i + 5, n)):
+            if _same_haul(group, i, j):
+                total += rising[j]
+                count += 1
+        if 2 * total > count:
+            out[i] = True
+        elif 2 * total < count:
+            out[i] = False
+    return out
+
+
+@numba.njit(cache=True, nogil=True)
+def _seg_size(pressure, threshold):
+    running = np.nan
+    for i in range(len(pressure)):
+        if not np.isnan(pressure[i]) and (np.isnan(running) or pressure[i] > running):
+            running = pressure[i]
+        if not running < threshold:
+            return i + 1
+    return len(pressure)
+
+
+@numba.njit(cache=True, nogil=True)
+def _spike(values, prev, post, pressure, shallow, deep):
+    flags = np.ones(len(values), dtype=np.uint8)
+    for i in range(len(values)):
+        val = np.abs(values[i] - (post[i] + prev[i]) / 2) - np.abs((post[i] - prev[i]) / 2)
+        if (pressure[i] < 500 and val > shallow) or (pressure[i] >= 500 and val > deep):
+            flags[i] = 4
+    return flags
+
+
+@numba.njit(cache=True, nogil=True)
+def _stuck(values, prev2, prev, post, post2, types):
+    flags = np.ones(len(values), dtype=np.uint8)
+    for i in range(len(values)):
+        if prev[i] == values[i] and post[i] == values[i] and types[i] != 3:
+            flags[i] = 4 if prev2[i] == values[i] and post2[i] == values[i] else 3
+    return flags
+
+
+@numba.njit(cache=True, nogil=True)
+def _mud(temperature, pressure, types, group, threshold):
+    n = len(temperature)
+    flags = np.ones(n, dtype=np.uint8)
+    start = 0
+    while start < n:
+        stop = start + 1
+        while stop < n and len(group) != 0 and group[stop] == group[start]:
+            stop += 1
+        if len(group) == 0:
+            stop = n
+        _mud_haul(temperature[start:stop], pressure[start:stop], types[start:stop], threshold, flags[start:stop])
+        start = stop
+    return flags
+
+
+# Rolling mean (10 samples, 5 before and 4 after, NaN skipped) of values[rows[k]] over k, compared to the threshold
+@numba.njit(cache=True, nogil=True)
+def _flat(values, rows, m, threshold):
+    flat = np.zeros(m, dtype=np.bool_)
+    for k in range(m):
+        total, count = 0.0, 0
+        for j in range(max(k - 5, 0), min(k + 5, m)):
+            if not np.isnan(values[rows[j]]):
+                total += values[rows[j]]
+                count += 1
+        flat[k] = count > 0 and np.abs(total / count) < threshold
+    return flat
+
+
+@numba.njit(cache=True, nogil=True)
+def _mud_haul(temperature, pressure, types, threshold, flags):
+    n = len(temperature)
+    up_max, down_max, max_pressure = np.nan, np.nan, np.nan
+    for i in range(n):
+        p = pressure[i]
+        if np.isnan(p):
+            continue
+        if np.isnan(max_pressure) or p > max_pressure:
+            max_pressure = p
+        if types[i] == 1 and (np.isnan(up_max) or p > up_max):
+            up_max = p
+        if types[i] == 2 and (np.isnan(down_max) or p > down_max):
+            down_max = p
+
+    temp_diff = np.full(n, np.nan)
+    for i in range(1, n):
+        temp_diff[i] = temperature[i] - temperature[i - 1]
+    up_n, down_n = np.empty(n, dtype=np.int64), np.empty(n, dtype=np.int64)
+    n_up, n_down = 0, 0
+    for i in range(n):
+        if types[i] == 1 and pressure[i] > up_max / 2:
+            up_n[n_up] = i
+            n_up += 1
+        elif types[i] == 2 and pressure[i] > down_max / 2:
+            down_n[n_down] = i
+            n_down += 1
+
+    flat_up = _flat(temp_diff, up_n, n_up, threshold)
+    n_flat_up, last_flat = 0, -1
+    for k in range(n_up):
+        if flat_up[k]:
+            n_flat_up += 1
+            last_flat = up_n[k]
+    n_flat_down = _flat(temp_diff, down_n, n_down, threshold).sum()
+
+    shallow = max_pressure < 100
+    if shallow or n_flat_up <= 10 or n_flat_down >= 2:
+        return
+    if n_flat_up / n_up > 0.9:
+        for i in range(n):
+            if types[i] == 1:
+                flags[i] = 3
+        return
+
+    # Down/up temperature crossover after the last flat sample
+    first_up, first, deepest = -1, -1, np.nan
+    for i in range(n):
+        if types[i] == 1:
+            if first_up < 0:
+                first_up = i
+            if i > last_flat + 1:
+                if first < 0:
+                    first = i
+                if not np.isnan(pressure[i]) and (np.isnan(deepest) or pressure[i] > deepest):
+                    deepest = pressure[i]
+    if first_up < 0:
+        return
+    inter_point = 0
+    if first >= 0:
+        # the up cast after first is walked upwards, the down cast from the bottom
+        up = first
+        for i in range(n - 1, -1, -1):
+            if types[i] != 2 or not pressure[i] < deepest:
+                continue
+            while up < n and types[up] != 1:
+                up += 1
+            if up >= n:
+                break
+            if temperature[i] <= temperature[up]:
+                inter_point = up
+                break
+            up += 1
+    for i in range(first_up, min(inter_point, n)):
+        flags[i] = 3
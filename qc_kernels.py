@@ -0,0 +1,271 @@
+import os
+
+import numpy as np
+
+
+# Array kernels of the neighbour based tests: speed, spike, rollover, stuck value, rate of change and mud, and of the
+# segmentation.
+# They work on contiguous float arrays and return uint8 flag arrays (1 good, 3 suspect, 4 bad), so the caller only
+# writes the results to its frame once. group optionally holds the haul of every sample when several hauls are stored
+# one after the other: neighbours are never taken across two hauls.
+# The loop kernels (direction, seg_size, spike, stuck and mud) run compiled with Numba (qc_jit) when it is installed,
+# with the same results; QC_BACKEND=numpy in the environment, or use('numpy'), keeps the NumPy versions below.
+
+# Series.shift(periods), within every haul
+def shift(values, periods, group=None):
+    out = np.full(len(values), np.nan)
+    if periods > 0:
+        out[periods:] = values[:-periods]
+        if group is not None:
+            out[periods:][group[periods:] != group[:-periods]] = np.nan
+    elif periods < 0:
+        out[:periods] = values[-periods:]
+        if group is not None:
+            out[:periods][group[:periods] != group[-periods:]] = np.nan
+    else:
+        out[:] = values
+    return out
+
+
+# The two previous and two following samples, computed once and shared by all the tests
+def neighbours(values, group=None):
+    return {periods: shift(values, periods, group) for periods in (2, 1, -1, -2)}
+
+
+# Series.rolling(window, center=True, min_periods=1).mean(), within every haul
+def rolling_mean(values, window=10, group=None):
+    values = values.astype(float)
+    total, count = np.zeros(len(values)), np.zeros(len(values))
+    for offset in range(-(window // 2), window - window // 2):
+        shifted = shift(values, -offset, group)
+        valid = ~np.isnan(shifted)
+        total += np.where(valid, shifted, 0)
+        count += valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+
+# Series.std() of every key in range(length); the samples of a key do not need to be contiguous
+def group_std(values, key, length):
+    valid = ~np.isnan(values)
+    key = key[valid]
+    count = np.bincount(key, minlength=length)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(key, values[valid], minlength=length) / count
+        var = np.bincount(key, (values[valid] - mean[key]) ** 2, minlength=length) / (count - 1)
+    return np.sqrt(np.where(count > 1, var, np.nan))
+
+
+# Direction of the segmentation: True where the pressure rises from the previous sample. On the samples of where, the
+# direction of the majority of the 10 samples around (5 before, 4 after) is taken instead; ties keep their own.
+def direction(pressure, where, group=None):
+    jit = _compiled()
+    if jit is not None:
+        return jit.direction(pressure, where, group)
+    rising = shift(pressure, 1, group) < pressure
+    smooth = rolling_mean(rising, 10, group)
+    return np.where(where & (smooth > 0.5), True, np.where(where & (smooth < 0.5), False, rising))
+
+
+# Length of the shortest leading slice whose running maximum reaches the threshold, in a single cumulative max pass
+def seg_size(pressure, threshold):
+    jit = _compiled()
+    if jit is not None:
+        return jit.seg_size(pressure, threshold)
+    below = np.fmax.accumulate(pressure) < threshold
+    if below.all():
+        return len(pressure)
+    return int(np.argmin(below)) + 1
+
+
+EARTH_RADIUS = 6371008.8  # mean radius in m
+
+
+# Great circle (haversine) distance in m from the previous sample, NaN for the first sample of every haul
+def track_distance(latitude, longitude, group=None):
+    lat, lon = np.radians(latitude), np.radians(longitude)
+    prev_lat, prev_lon = shift(lat, 1, group), shift(lon, 1, group)
+    h = np.sin((lat - prev_lat) / 2) ** 2 + np.cos(lat) * np.cos(prev_lat) * np.sin((lon - prev_lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1)))
+
+
+# Speed in m/s from the previous sample along the track; NaN where the time does not increase.
+# Times are taken in seconds from origin (the first sample by default), so a slice of a track given the origin of the
+# whole track gets the same speeds.
+def track_speed(latitude, longitude, datetime, group=None, origin=None):
+    if len(datetime) == 0:
+        return np.zeros(0)
+    seconds = (datetime - (datetime[0] if origin is None else origin)) / np.timedelta64(1, 's')
+    elapsed = seconds - shift(seconds, 1, group)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(elapsed > 0, track_distance(latitude, longitude, group) / elapsed, np.nan)
+
+
+# 7. Impossible speed test: faster than 4.12 m/s along the track, or in the SPEED column when there is one
+def impossible_speed(latitude, longitude, datetime, speed=None, group=None, limit=4.12, origin=None):
+    flags = np.ones(len(latitude), dtype=np.uint8)
+    flags[track_speed(latitude, longitude, datetime, group, origin) > limit] = 4
+    if speed is not None:
+        flags[speed > limit] = 4
+    return flags
+
+
+# 9. Spike test: shallow/deep thresholds above/below 500 dbar
+def spike(values, near, pressure, shallow, deep):
+    jit = _compiled()
+    if jit is not None:
+        return jit.spike(values, near, pressure, shallow, deep)
+    prev, post = near[1], near[-1]
+    val = np.abs(values - (post + prev) / 2) - np.abs((post - prev) / 2)
+    flags = np.ones(len(values), dtype=np.uint8)
+    flags[((pressure < 500) & (val > shallow)) | ((pressure >= 500) & (val > deep))] = 4
+    return flags
+
+
+# 10. Rollover (bottom spike) test
+def rollover(values, near, types, threshold=0.5):
+    flags = np.ones(len(values), dtype=np.uint8)
+    flags[(np.abs(values - near[1]) > threshold) & (types == 3)] = 3
+    return flags
+
+
+# 11. Stuck value test: 3 identical samples are suspect, 5 are bad; not applied at the bottom
+def stuck(values, near, types):
+    jit = _compiled()
+    if jit is not None:
+        return jit.stuck(values, near, types)
+    flags = np.ones(len(values), dtype=np.uint8)
+    same = (near[1] == values) & (near[-1] == values) & (types != 3)
+    flags[same] = 3
+    flags[same & (near[2] == values) & (near[-2] == values)] = 4
+    return flags
+
+
+# 12. Rate of change test: step larger than n_dev standard deviations of the down, bottom or up segment.
+# sd: the standard deviation of every type (index 0 to 3) when it is already known, e.g. computed over a whole series
+# that is checked slice by slice (single haul only)
+def rate_of_change(values, near, types, group=None, n_dev=3, sd=None):
+    if sd is not None:
+        sd = np.asarray(sd)[types]
+    else:
+        key = types if group is None else group * 4 + types
+        sd = group_std(values, key, key.max() + 1 if len(key) else 0)[key]
+    flags = np.ones(len(values), dtype=np.uint8)
+    flags[np.abs(values - near[1]) > n_dev * sd] = 3
+    return flags
+
+
+# Spike, rollover, stuck and rate of change flags of temperature (and salinity) in one pass, in QC column order
+def neighbour_flags(temperature, pressure, types, salinity=None, group=None):
+    temp = neighbours(temperature, group)
+    flags = {'flag_temp_spike': spike(temperature, temp, pressure, 6, 2)}
+    if salinity is not None:
+        sal = neighbours(salinity, group)
+        flags['flag_sal_spike'] = spike(salinity, sal, pressure, 0.9, 0.3)
+    flags['flag_rollover'] = rollover(temperature, temp, types)
+    flags['flag_temp_stuck'] = stuck(temperature, temp, types)
+    if salinity is not None:
+        flags['flag_sal_stuck'] = stuck(salinity, sal, types)
+    flags['flag_RoC'] = rate_of_change(temperature, temp, types, group)
+    if salinity is not None:
+        flags['flag_RoC'] = np.maximum(flags['flag_RoC'], rate_of_change(salinity, sal, types, group))
+    return flags
+
+
+# Mud test: the temperature of the up cast stays flat while the sensor is stuck in the mud.
+# The up cast is suspect when more than 10 samples of its deeper half have a flat rolling temperature change and the
+# down cast has at most one: all of it when more than 90% of those samples are flat, else from its start until the
+# temperature of the up cast, after the last flat sample, crosses the one of the down cast at the same rank (both
+# walked from the bottom upwards). group: hauls stored one after the other, as in the other kernels.
+def mud(temperature, pressure, types, group=None, threshold=0.005):
+    jit = _compiled()
+    if jit is not None:
+        return jit.mud(temperature, pressure, types, group, threshold)
+    flags = np.ones(len(temperature), dtype=np.uint8)
+    if len(temperature) == 0:
+        return flags
+    first = np.r_[True, group[1:] != group[:-1]] if group is not None else np.r_[True, np.zeros(len(types) - 1, bool)]
+    starts = np.flatnonzero(first)
+    haul = np.cumsum(first) - 1
+    pos = np.arange(len(types)) - starts[haul]
+    n_hauls = len(starts)
+
+    temp_diff = temperature - shift(temperature, 1, haul)
+    up, down = types == 1, types == 2
+    up_max = np.fmax.reduceat(np.where(up, pressure, np.nan), starts)
+    down_max = np.fmax.reduceat(np.where(down, pressure, np.nan), starts)
+    up_n = np.flatnonzero(up & (pressure > up_max[haul] / 2))
+    down_n = np.flatnonzero(down & (pressure > down_max[haul] / 2))
+
+    flat_up = np.abs(rolling_mean(temp_diff[up_n], 10, haul[up_n])) < threshold
+    flat_down = np.abs(rolling_mean(temp_diff[down_n], 10, haul[down_n])) < threshold
+    n_flat_up = np.bincount(haul[up_n][flat_up], minlength=n_hauls)
+    n_flat_down = np.bincount(haul[down_n][flat_down], minlength=n_hauls)
+    n_up = np.bincount(haul[up_n], minlength=n_hauls)
+
+    shallow = np.fmax.reduceat(pressure, starts) < 100
+    muddy = ~shallow & (n_flat_up > 0) & (n_flat_down < 2) & (n_flat_up > 10)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        whole_up = muddy & (n_flat_up / n_up > 0.9)
+    flags[whole_up[haul] & up] = 3
+
+    # Down/up temperature crossover, only for the few hauls that get this far
+    last_flat = np.full(n_hauls, -1)
+    np.maximum.at(last_flat, haul[up_n][flat_up], pos[up_n][flat_up])
+    ends = np.r_[starts[1:], len(types)]
+    for h in np.flatnonzero(muddy & ~whole_up):
+        rows = slice(starts[h], ends[h])
+        flags[rows][_crossover(temperature[rows], pressure[rows], types[rows], last_flat[h])] = 3
+    return flags
+
+
+# Samples of the up cast before its temperature crosses the down cast, after the last flat sample of one haul
+def _crossover(temperature, pressure, types, last_flat):
+    pos = np.arange(len(types))
+    up = np.flatnonzero((types == 1) & (pos > last_flat + 1))
+    inter_point = 0
+    if len(up):
+        down = np.flatnonzero((types == 2) & (pressure < np.nanmax(pressure[up])))[::-1]
+        m = min(len(down), len(up))
+        crossed = np.flatnonzero(temperature[down[:m]] <= temperature[up[:m]])
+        if len(crossed):
+            inter_point = up[crossed[0]]
+    first_up = np.flatnonzero(types == 1)
+    if len(first_up) == 0:
+        return np.zeros(len(types), dtype=bool)
+    return (pos < inter_point) & (pos >= first_up[0])
+
+
+NUMPY, NUMBA = 'numpy', 'numba'
+_jit, _backend = None, None
+
+
+# Selects the backend of the loop kernels: 'numba', 'numpy', or None for Numba when it can be imported. Returns the
+# backend in use.
+def use(backend=None):
+    global _jit, _backend
+    if backend not in (None, NUMPY, NUMBA):
+        raise ValueError('Unknown kernel backend: %s' % backend)
+    _jit = None
+    if backend != NUMPY:
+        try:
+            import qc_jit
+            _jit = qc_jit
+        except ImportError:
+            if backend == NUMBA:
+                raise
+    _backend = NUMPY if _jit is None else NUMBA
+    return _backend
+
+
+# Backend of the loop kernels in use, selected as by the first kernel call when use() was not called
+def backend():
+    _compiled()
+    return _backend
+
+
+# The compiled kernels, or None; Numba is only imported by the first kernel call
+def _compiled():
+    if _backend is None:
+        use(os.environ.get('QC_BACKEND') or None)
+    return _jit
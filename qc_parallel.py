@@ -0,0 +1,159 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+import numpy as np
+
+from QC import as_datetime
+from qc_batch import QCBatch
+from qc_profile import QCProfiler
+
+COLUMNS = ['DATETIME', 'TEMPERATURE', 'PRESSURE', 'LATITUDE', 'LONGITUDE', 'SALINITY', 'SPEED']
+
+
+# Runs QCBatch over a process pool.
+# The hauls are sharded in chunks of chunk_size hauls. Workers only receive the plain column arrays of their shard
+# (DATETIME already parsed to datetime64) and the metadata of its hauls, and send back the flag arrays, so no
+# DataFrame is pickled either way. Results are collected in the order of the input. A haul on which QC fails is
+# reported in errors (haul -> exception) and left out of the flags, without aborting the rest of the run.
+# With profile=True every shard is profiled in its worker and the records are collected in profiler (one record per
+# step and shard).
+class QCRunner(object):
+    def __init__(self, workers=None, chunk_size=200, key='HAUL', tests=None, profile=False):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.key = key
+        self.tests = tests
+        self.profile = profile
+        self.profiler = QCProfiler() if profile else None
+        self.errors = {}
+
+    # One long frame with a key column, meta indexed by the key (vessel, gear_type, zone, sensor_type)
+    def run_frame(self, df, meta):
+        self.errors = {}
+        codes, hauls = pd.factorize(df[self.key])
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        starts = np.searchsorted(codes, np.arange(0, len(hauls), self.chunk_size))
+        bounds = list(zip(starts, np.r_[starts[1:], len(codes)].astype(np.int64)))
+
+        columns = {c: _column(df[c])[order] for c in COLUMNS if c in df}
+        meta = meta.loc[hauls].set_axis(np.arange(len(hauls)))
+        shards = (dict({c: values[a:b] for c, values in columns.items()}, **{self.key: codes[a:b]}) for a, b in bounds)
+        metas = (meta.iloc[codes[a]:codes[b - 1] + 1] for a, b in bounds)
+
+        positions, parts = [], []
+        results = self._map(_run_shard, shards, metas, repeat(self.key), repeat(self.tests), repeat(self.profile))
+        for (a, b), (rows, flags, errors, records) in zip(bounds, results):
+            self.errors.update({hauls[h]: error for h, error in errors.items()})
+            if self.profiler is not None:
+                self.profiler.extend(records)
+            # a shard whose hauls all failed has no flags
+            if len(rows) > 0:
+                positions.append(order[a:b][rows])
+                parts.append((len(rows), flags))
+
+        positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+        # every flag column of any shard, 1 on the rows of the shards without it
+        dtypes = {}
+        for n, part in parts:
+            for c, values in part.items():
+                dtypes.setdefault(c, values.dtype)
+        flags = {c: np.concatenate([part[c] if c in part else np.ones(n, dtype=dtype) for n, part in parts])
+                 for c, dtype in dtypes.items()}
+        # back to the row order of the input
+        keep = np.argsort(positions, kind='stable')
+        return pd.DataFrame({c: values[keep] for c, values in flags.items()}, index=df.index[positions[keep]])
+
+    # One haul per CSV file, meta indexed by path. Without output_dir the flags of every file are returned, with it the
+    # workers write the flagged file to output_dir (same file name) and the written paths are returned.
+    def run_files(self, paths, meta, output_dir=None):
+        self.errors = {}
+        paths = list(paths)
+        chunks = [paths[i:i + self.chunk_size] for i in range(0, len(paths), self.chunk_size)]
+        metas = (meta.loc[chunk] for chunk in chunks)
+
+        results = {}
+        for outputs, errors, records in self._map(_run_files, chunks, metas, repeat(output_dir), repeat(self.tests),
+                                                  repeat(self.profile)):
+            results.update(outputs)
+            self.errors.update(errors)
+            if self.profiler is not None:
+                self.profiler.extend(records)
+        return results
+
+    def _map(self, func, *iterables):
+        if self.workers == 1:
+            return map(func, *iterables)
+        # the pool is shut down once all results have been consumed
+        return _pool_map(self.workers, func, *iterables)
+
+
+def _pool_map(workers, func, *iterables):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(func, *iterables):
+            yield result
+
+
+def _column(series):
+    if series.name == 'DATETIME':
+        return as_datetime(series).to_numpy()
+    return series.to_numpy()
+
+
+# Worker side
+
+def _run_shard(columns, meta, key, tests, profile):
+    df = pd.DataFrame(columns, copy=False)
+    profiler = QCProfiler() if profile else None
+    try:
+        batch = QCBatch(df, meta, key, tests, profiler)
+        flags, errors = batch.flags, batch.errors
+    except Exception:
+        # An unexpected failure only takes its own haul down
+        flags, errors = [], {}
+        for haul in meta.index:
+            try:
+                batch = QCBatch(df[df[key] == haul], meta, key, tests, profiler)
+                flags.append(batch.flags)
+                errors.update(batch.errors)
+            except Exception as e:
+                errors[haul] = e
+        flags = pd.concat(flags) if flags else pd.DataFrame()
+    records = profiler.records if profiler is not None else []
+    return flags.index.to_numpy(), {c: flags[c].to_numpy() for c in flags.columns}, errors, records
+
+
+def _run_files(paths, meta, output_dir, tests, profile):
+    outputs, errors, data = {}, {}, []
+    profiler = QCProfiler() if profile else None
+    records = profiler.records if profiler is not None else []
+    for path in paths:
+        try:
+            data.append(pd.read_csv(path).assign(FILE=path))
+        except Exception as e:
+            errors[path] = e
+    if len(data) == 0:
+        return outputs, errors, records
+
+    df = pd.concat(data, ignore_index=True)
+    try:
+        batch = QCBatch(df, meta, 'FILE', tests, profiler)
+        flags = batch.flags
+        errors.update(batch.errors)
+    except Exception as e:
+        errors.update({path: e for path in paths if path not in errors})
+        return outputs, errors, records
+
+    for path, flagged in flags.groupby(df.loc[flags.index, 'FILE'], sort=False):
+        flagged = flagged.reset_index(drop=True)
+        if output_dir is None:
+            outputs[path] = flagged
+        else:
+            original = df[df['FILE'] == path].drop(columns=['FILE']).reset_index(drop=True)
+            out = os.path.join(output_dir, os.path.basename(path))
+            original.drop(columns=[c for c in flagged.columns if c in original]).join(flagged).to_csv(out, index=False)
+            outputs[path] = out
+    # keep the order of the input paths
+    return {path: outputs[path] for path in paths if path in outputs}, errors, records
@@ -0,0 +1,102 @@
+from collections import namedtuple
+
+# Registry of the QC tests, shared by QC and QCBatch (same method names).
+# Every test declares the columns it reads, the flag columns it writes, the steps it depends on and a cost tier:
+#  - 'realtime': per sample or per haul checks, cheap enough for the real-time path
+#  - 'delayed': the tests that need the down/bottom/up segmentation (and the segmentation itself)
+# plan() turns a selection of test names and/or tiers into the methods to call, in QC order: the steps a test
+# depends on are added just before the first test needing them, and nothing else is run, so parse_segments is only
+# computed when a selected test uses it. A test selected more than once runs once.
+
+Test = namedtuple('Test', ['name', 'inputs', 'outputs', 'requires', 'tier'])
+
+REALTIME, DELAYED = 'realtime', 'delayed'
+TIERS = (REALTIME, DELAYED)
+
+POSITION = ['LATITUDE', 'LONGITUDE']
+
+# Steps other tests depend on; they write no flag
+STEPS = {'parse_segments': Test('parse_segments', ['DATETIME', 'PRESSURE'], ['type'], [], DELAYED)}
+
+TESTS = [
+    Test('regions', POSITION, ['flag_vessel_region'], [], REALTIME),
+    Test('gear_type', POSITION, ['flag_gear_type'], [], REALTIME),
+    Test('impossible_date', ['DATETIME'], ['flag_date'], [], REALTIME),
+    Test('impossible_location', POSITION, ['flag_location'], [], REALTIME),
+    Test('position_on_land', POSITION, ['flag_land'], [], REALTIME),
+    Test('impossible_speed', POSITION + ['DATETIME', 'SPEED'], ['flag_speed'], [], REALTIME),
+    Test('global_range', ['PRESSURE', 'TEMPERATURE', 'SALINITY'], ['flag_global_range'], [], REALTIME),
+    Test('spike', ['TEMPERATURE', 'PRESSURE', 'SALINITY'], ['flag_temp_spike', 'flag_sal_spike'], [], REALTIME),
+    Test('rollover', ['TEMPERATURE'], ['flag_rollover'], ['parse_segments'], DELAYED),
+    Test('stuck', ['TEMPERATURE', 'SALINITY'], ['flag_temp_stuck', 'flag_sal_stuck'], ['parse_segments'], DELAYED),
+    Test('rate_of_change', ['TEMPERATURE', 'SALINITY'], ['flag_RoC'], ['parse_segments'], DELAYED),
+    Test('timing_gap', ['DATETIME'], ['flag_timing_gap'], [], REALTIME),
+    Test('climatology', ['DATETIME', 'PRESSURE', 'TEMPERATURE', 'SALINITY'] + POSITION, ['flag_clima'], [],
+         REALTIME),
+    Test('drift', ['DATETIME', 'TEMPERATURE', 'SALINITY'], ['flag_drift'], ['parse_segments'], DELAYED),
+    Test('mud', ['TEMPERATURE', 'PRESSURE'], ['flag_mud'], ['parse_segments'], DELAYED),
+]
+
+# Tests run together in one method when they are all selected (they share the neighbours of every sample)
+FUSED = {'neighbour_tests': ['spike', 'rollover', 'stuck', 'rate_of_change']}
+
+_tests = {test.name: test for test in TESTS}
+
+
+# Selected tests, in QC order. tests: None for all of them, or names of tests and/or tiers
+def select(tests=None):
+    if tests is None:
+        return list(TESTS)
+    if isinstance(tests, str):
+        tests = [tests]
+    names = set()
+    for name in tests:
+        if name in TIERS:
+            names.update(test.name for test in TESTS if test.tier == name)
+        elif name in FUSED:
+            names.update(FUSED[name])
+        elif name in _tests:
+            names.add(name)
+        else:
+            raise ValueError('Unknown QC test or tier: %s' % name)
+    return [test for test in TESTS if test.name in names]
+
+
+# Methods to call for the selected tests, dependencies included. fuse=False keeps the tests of FUSED as separate
+# methods (e.g. to profile every test on its own), in the same place and with the same steps before them
+def plan(tests=None, fuse=True):
+    selected = select(tests)
+    names = [test.name for test in selected]
+    steps = []
+    for test in selected:
+        method, requires = test.name, test.requires
+        for fused, members in FUSED.items():
+            if test.name in members and all(member in names for member in members):
+                # a fused method takes the place of its members and needs what all of them need
+                requires = [step for member in members for step in _tests[member].requires]
+                method = fused if fuse else test.name
+        for step in requires + [method]:
+            if step not in steps:
+                steps.append(step)
+    return steps
+
+
+# Input columns of the selected tests and of their dependencies (some, like SALINITY and SPEED, are optional)
+def columns(tests=None):
+    out = []
+    for test in select(tests):
+        for column in [c for step in test.requires for c in STEPS[step].inputs] + test.inputs:
+            if column not in out:
+                out.append(column)
+    return out
+
+
+# Flag columns written by a step: a test, fused tests or aggregate_flag
+def outputs(step):
+    if step in FUSED:
+        return [output for member in FUSED[step] for output in _tests[member].outputs]
+    if step in _tests:
+        return _tests[step].outputs
+    if step == 'aggregate_flag':
+        return ['flag']
+    return []
@@ -0,0 +1,85 @@
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+import numpy as np
+
+import qc_pipeline
+
+
+# Opt-in profiling of the QC steps: pass a QCProfiler as profiler= to QC, QCBatch or QCRunner(profile=True).
+# Every step (test method, parse_segments, aggregate_flag) records its wall time, the peak of the memory it allocated
+# (tracemalloc, only when memory=True as tracing slows Python allocations down) and the number of rows its flags mark
+# as suspect or bad. Tests that otherwise run fused (qc_pipeline.FUSED: spike, rollover, stuck and rate_of_change in
+# neighbour_tests) run one by one under a profiler, so every test has its own records. Without a profiler the steps
+# are called directly, so profiling costs nothing when off.
+# One profiler can be reused over many hauls and batches (set haul to label the records of the next QC); summary()
+# aggregates the records per step.
+class QCProfiler(object):
+    FIELDS = ['step', 'haul', 'rows', 'hauls', 'seconds', 'peak_memory', 'flagged']
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.haul = None
+        self.records = []
+
+    # Calls qc.<step>() and records it; a QCBatch records the whole batch at once (hauls > 1)
+    def run(self, qc, step, hauls=1):
+        # tracing is only on during the step, unless the caller traces already
+        started = self.memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            result = getattr(qc, step)()
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - before if self.memory else np.nan
+        finally:
+            if started:
+                tracemalloc.stop()
+
+        flagged = np.zeros(qc.rows(), dtype=bool)
+        for name in qc_pipeline.outputs(step):
+            values = qc.flag_values(name)
+            if values is not None:
+                flagged |= values > 1
+        self.records.append({'step': step, 'haul': self.haul, 'rows': qc.rows(), 'hauls': hauls, 'seconds': seconds,
+                             'peak_memory': peak, 'flagged': int(flagged.sum())})
+        return result
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    # One row per step: number of calls, rows and hauls, total/mean/max time, max peak memory, rows flagged
+    def summary(self):
+        records = pd.DataFrame(self.records, columns=self.FIELDS)
+        grouped = records.groupby('step', sort=False)
+        return pd.DataFrame({'calls': grouped.size(), 'rows': grouped['rows'].sum(), 'hauls': grouped['hauls'].sum(),
+                             'seconds': grouped['seconds'].sum(), 'mean_seconds': grouped['seconds'].mean(),
+                             'max_seconds': grouped['seconds'].max(), 'peak_memory': grouped['peak_memory'].max(),
+                             'flagged': grouped['flagged'].sum()})
+
+    # Records and summary as a dict, and written as JSON when a path is given
+    def report(self, path=None):
+        summary = self.summary()
+        report = {'records': self.records,
+                  'summary': [dict(step=step, **row) for step, row in summary.to_dict('index').items()]}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=1, default=_json_default)
+        return report
+
+    # Records (or the summary) as CSV; the text is returned when no path is given
+    def to_csv(self, path=None, summary=False):
+        table = self.summary() if summary else pd.DataFrame(self.records, columns=self.FIELDS)
+        return table.to_csv(path, index=summary)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
@@ -0,0 +1,271 @@
+import struct
+import zlib
+
+import pandas as pd
+import numpy as np
+
+from QC import as_datetime
+import qc_pipeline
+
+# Compact binary encoding of a QC'd haul for Iridium SBD messages (rockBlock, at most 340 bytes per message), and the
+# shore side decoder.
+# A haul is encoded once into a payload:
+#  - header: format version, column mask, number of samples, mask of the flag columns sent
+#  - DATETIME in whole seconds since 2010-01-01, the values in fixed point (DECIMALS: 10^-decimals units), each column
+#    as its first value and the differences between consecutive samples, zigzag varints; missing values (NaN/NaT) are
+#    left out and marked in a bitmap
+#  - type (down/bottom/up of parse_segments) as runs of (type, length)
+#  - every flag column sent as 2 bits per sample (1, 3, 4 and 9 for anything else), 4 samples per byte
+# The payload is deflated when that makes it shorter. It is then split into messages of at most size bytes, each one
+# with a header (magic byte, message id, sequence number, number of messages) so the shore side can put them back
+# together whatever the order they arrive in (Reassembler).
+# decimate keeps one sample out of k in every down, bottom and up segment (e.g. {'bottom': 10}), always keeping the
+# first and last sample of a segment and the bad ones (flag 4). messages() can pick the decimation to fit a number of
+# messages.
+
+SBD_SIZE = 340
+MAGIC = 0xBD
+VERSION = 1
+EPOCH = np.datetime64('2010-01-01T00:00:00', 's')
+
+HEADER = struct.Struct('<BHBB')  # magic, message id, sequence number, number of messages
+PAYLOAD = struct.Struct('<BBHI')  # version, column mask, samples, flag column mask
+
+# Value columns in payload order, with their default fixed point decimals
+DECIMALS = {'PRESSURE': 1, 'TEMPERATURE': 3, 'SALINITY': 3, 'LATITUDE': 5, 'LONGITUDE': 5}
+SEGMENTS = {'down': 2, 'bottom': 3, 'up': 1}
+# Flag columns that can be sent, bit i of the flag column mask standing for FLAGS[i]. Part of the format of VERSION:
+# the order never changes, a new QC flag is added at the end with VERSION bumped.
+FLAGS = ['flag', 'flag_vessel_region', 'flag_gear_type', 'flag_date', 'flag_location', 'flag_land', 'flag_speed',
+         'flag_global_range', 'flag_temp_spike', 'flag_sal_spike', 'flag_rollover', 'flag_temp_stuck',
+         'flag_sal_stuck', 'flag_RoC', 'flag_timing_gap', 'flag_clima', 'flag_drift', 'flag_mud']
+_missing = [name for test in qc_pipeline.TESTS for name in test.outputs if name not in FLAGS]
+if _missing:
+    raise RuntimeError('QC flags %s are not in qc_sbd.FLAGS: add them at the end and bump VERSION' % _missing)
+FLAG_CODES = np.array([1, 3, 4, 9], dtype=np.uint8)
+
+_DEFLATED, _SALINITY, _POSITION, _TYPE = 1, 2, 4, 8
+
+
+# The messages of a haul: the QC frame (QC(...).df or any frame with DATETIME, PRESSURE, TEMPERATURE and flag
+# columns, SALINITY, LATITUDE/LONGITUDE and type being optional). message_id tells the hauls apart on the shore side
+# (0-65535, e.g. a counter). With max_messages the decimation is coarsened (every segment k times more, k growing
+# by a quarter) until the haul fits in that many messages.
+def messages(df, message_id, flags=('flag',), decimate=None, decimals=None, position=True, size=SBD_SIZE,
+             max_messages=None):
+    decimate = dict(decimate or {})
+    factor = 1
+    while True:
+        steps = {segment: decimate.get(segment, 1) * factor for segment in SEGMENTS}
+        payload = encode(df, flags, steps if factor > 1 or decimate else None, decimals, position)
+        out = fragment(payload, message_id, size)
+        if max_messages is None or len(out) <= max_messages:
+            return out
+        if factor >= len(df):
+            raise ValueError('Haul does not fit in %d messages of %d bytes' % (max_messages, size))
+        factor = min(factor + max(factor // 4, 1), len(df))
+
+
+# One haul as a payload (bytes)
+def encode(df, flags=('flag',), decimate=None, decimals=None, position=True):
+    flags = [name for name in flags if name in df]
+    unknown = [name for name in flags if name not in FLAGS]
+    if unknown:
+        raise ValueError('Unknown flag columns: %s' % ', '.join(unknown))
+    if decimate:
+        df = df.iloc[_decimated(df, decimate)]
+    decimals = dict(DECIMALS, **(decimals or {}))
+
+    columns = ['PRESSURE', 'TEMPERATURE']
+    mask = 0
+    if 'SALINITY' in df:
+        columns.append('SALINITY')
+        mask |= _SALINITY
+    if position and 'LATITUDE' in df and 'LONGITUDE' in df:
+        columns += ['LATITUDE', 'LONGITUDE']
+        mask |= _POSITION
+    if 'type' in df:
+        mask |= _TYPE
+    if len(df) > 0xFFFF:
+        raise ValueError('At most 65535 samples per haul, decimate the haul')
+
+    flag_mask = 0
+    for name in flags:
+        flag_mask |= 1 << FLAGS.index(name)
+    body = [bytes([decimals[name] for name in columns])]
+
+    time = as_datetime(df['DATETIME']).to_numpy()
+    seconds = (time.astype('datetime64[s]') - EPOCH).astype(np.int64)
+    body.append(_column(seconds, ~np.isnat(time)))
+    for name in columns:
+        values = df[name].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        body.append(_column(np.round(np.where(valid, values, 0) * 10 ** decimals[name]).astype(np.int64), valid))
+    if mask & _TYPE:
+        body.append(_runs(df['type'].to_numpy(dtype=np.int64)))
+    for name in FLAGS:
+        if name in flags:
+            body.append(_pack(df[name].to_numpy()))
+
+    body = b''.join(body)
+    deflated = zlib.compress(body, 9)[2:-4]  # raw deflate, without the zlib header and checksum
+    if len(deflated) < len(body):
+        body = deflated
+        mask |= _DEFLATED
+    return PAYLOAD.pack(VERSION, mask, len(df), flag_mask) + body
+
+
+# A payload back to a frame: DATETIME, the value columns, type and the flag columns (uint8)
+def decode(payload):
+    version, mask, n, flag_mask = PAYLOAD.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError('Unknown SBD payload version: %d' % version)
+    body = payload[PAYLOAD.size:]
+    if mask & _DEFLATED:
+        body = zlib.decompress(body, -15)
+    columns = ['PRESSURE', 'TEMPERATURE'] + (['SALINITY'] if mask & _SALINITY else []) + (
+        ['LATITUDE', 'LONGITUDE'] if mask & _POSITION else [])
+    data = np.frombuffer(body, dtype=np.uint8)
+    decimals = dict(zip(columns, data[:len(columns)]))
+    pos = len(columns)
+
+    df = pd.DataFrame(index=pd.RangeIndex(n))
+    seconds, valid, pos = _read_column(data, pos, n)
+    time = EPOCH + seconds.astype('timedelta64[s]')
+    time[~valid] = np.datetime64('NaT')
+    df['DATETIME'] = time
+    for name in columns:
+        values, valid, pos = _read_column(data, pos, n)
+        df[name] = np.where(valid, values / 10 ** int(decimals[name]), np.nan)
+    if mask & _TYPE:
+        df['type'], pos = _read_runs(data, pos, n)
+    for i, name in enumerate(FLAGS):
+        if flag_mask & 1 << i:
+            df[name] = _unpack(data[pos:pos + (n + 3) // 4], n)
+            pos += (n + 3) // 4
+    return df
+
+
+# A payload as messages of at most size bytes
+def fragment(payload, message_id, size=SBD_SIZE):
+    chunk = size - HEADER.size
+    count = max((len(payload) + chunk - 1) // chunk, 1)
+    if count > 255:
+        raise ValueError('Payload of %d bytes needs more than 255 messages' % len(payload))
+    return [HEADER.pack(MAGIC, message_id, seq, count) + payload[seq * chunk:(seq + 1) * chunk]
+            for seq in range(count)]
+
+
+# Shore side: add() the messages as they arrive, in any order and possibly repeated; the decoded haul is returned once
+# all the messages of its message id have arrived (None until then). A message id starting again with a different
+# number of messages drops the incomplete haul.
+class Reassembler(object):
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, message):
+        magic, message_id, seq, count = HEADER.unpack_from(message)
+        if magic != MAGIC or seq >= count:
+            raise ValueError('Not a QC SBD message')
+        chunks = self.pending.get(message_id)
+        if chunks is None or chunks[0] != count:
+            chunks = self.pending[message_id] = (count, {})
+        chunks[1][seq] = bytes(message[HEADER.size:])
+        if len(chunks[1]) < count:
+            return None
+        del self.pending[message_id]
+        return decode(b''.join(chunks[1][i] for i in range(count)))
+
+
+# Rows kept by the decimation: one out of k in every segment, the first and last of a segment and the bad rows
+def _decimated(df, decimate):
+    if 'type' not in df:
+        raise ValueError('Decimation by segment needs the type column (parse_segments)')
+    types = df['type'].to_numpy()
+    keep = np.zeros(len(df), dtype=bool)
+    starts = np.flatnonzero(np.r_[True, types[1:] != types[:-1]])
+    stops = np.r_[starts[1:], len(types)]
+    step = {SEGMENTS[segment]: int(k) for segment, k in decimate.items()}
+    for a, b in zip(starts, stops):
+        keep[a:b:max(step.get(types[a], 1), 1)] = True
+        keep[b - 1] = True
+    if 'flag' in df:
+        keep |= df['flag'].to_numpy() == 4
+    return np.flatnonzero(keep)
+
+
+# Integers (valid ones only) as first value and differences, with a bitmap of the valid ones when some are missing
+def _column(values, valid):
+    if valid.all():
+        return b'\x00' + _varints(np.diff(values, prepend=0))
+    values = values[valid]
+    return b'\x01' + np.packbits(valid).tobytes() + _varints(np.diff(values, prepend=0))
+
+
+def _read_column(data, pos, n):
+    if data[pos]:
+        valid = np.unpackbits(data[pos + 1:pos + 1 + (n + 7) // 8], count=n).astype(bool)
+        pos += 1 + (n + 7) // 8
+    else:
+        valid = np.ones(n, dtype=bool)
+        pos += 1
+    deltas, pos = _read_varints(data, pos, int(valid.sum()))
+    values = np.zeros(n, dtype=np.int64)
+    values[valid] = np.cumsum(deltas)
+    return values, valid, pos
+
+
+def _runs(types):
+    starts = np.flatnonzero(np.r_[True, types[1:] != types[:-1]]) if len(types) else np.zeros(0, dtype=np.int64)
+    lengths = np.diff(np.r_[starts, len(types)])
+    return _varints(np.r_[len(starts), np.ravel(np.c_[types[starts], lengths])].astype(np.int64))
+
+
+def _read_runs(data, pos, n):
+    count, pos = _read_varints(data, pos, 1)
+    runs, pos = _read_varints(data, pos, 2 * int(count[0]))
+    types = np.repeat(runs[0::2], runs[1::2])
+    return types[:n], pos
+
+
+# Flags as 2 bit codes (FLAG_CODES), 4 per byte
+def _pack(flags):
+    codes = np.full(len(flags), 3, dtype=np.uint8)
+    for code, flag in enumerate(FLAG_CODES[:3]):
+        codes[flags == flag] = code
+    codes = np.r_[codes, np.zeros(-len(codes) % 4, dtype=np.uint8)].reshape(-1, 4)
+    return (codes[:, 0] | codes[:, 1] << 2 | codes[:, 2] << 4 | codes[:, 3] << 6).astype(np.uint8).tobytes()
+
+
+def _unpack(data, n):
+    codes = np.c_[data & 3, data >> 2 & 3, data >> 4 & 3, data >> 6].ravel()[:n]
+    return FLAG_CODES[codes]
+
+
+# Signed integers as zigzag LEB128 varints
+def _varints(values):
+    z = ((values << 1) ^ (values >> 63)).astype(np.uint64)
+    sizes = np.ones(len(z), dtype=np.int64)
+    for k in range(1, 10):
+        sizes += z >= np.uint64(1) << np.uint64(7 * k)
+    out = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    offsets = np.cumsum(sizes) - sizes
+    for k in range(int(sizes.max()) if len(z) else 0):
+        more = sizes > k
+        group = (z[more] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        out[offsets[more] + k] = group | np.where(sizes[more] > k + 1, 0x80, 0).astype(np.uint64)
+    return out.tobytes()
+
+
+def _read_varints(data, pos, count):
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), pos
+    ends = pos + np.flatnonzero(data[pos:] < 0x80)[:count]
+    if len(ends) < count:
+        raise ValueError('Truncated SBD payload')
+    stop = int(ends[-1]) + 1
+    chunk = data[pos:stop].astype(np.uint64)
+    starts = np.r_[0, ends[:-1] + 1 - pos]
+    shift = (np.arange(len(chunk)) - np.repeat(starts, np.diff(np.r_[starts, len(chunk)]))) * 7
+    z = np.bitwise_or.reduceat((chunk & np.uint64(0x7F)) << shift.astype(np.uint64), starts)
+    return (z >> np.uint64(1)).astype(np.int64) ^ -(z & np.uint64(1)).astype(np.int64), stop
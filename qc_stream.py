@@ -0,0 +1,262 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime
+import geopy.distance
+
+from QC import QC, as_datetime
+import qc_kernels
+import land_mask
+import climatology
+import vessel_regions
+
+COLUMNS = ['DATETIME', 'TEMPERATURE', 'PRESSURE', 'LATITUDE', 'LONGITUDE', 'SALINITY', 'SPEED']
+DOWN, BOTTOM, UP = 2, 3, 1
+
+
+# Real-time QC of a haul whose samples arrive a few at a time (telemetry).
+# push(samples) only runs the tests on the new samples against a small rolling state, instead of re-running QC on the
+# growing haul:
+#  - vessel region, date, location, land, speed, global range and climatology only look at the sample itself (and
+#    the previous one for the speed) and are final on arrival.
+#  - spike, rollover, stuck value and rate of change, and the down/bottom/up segment of a sample, are provisional until
+#    LOOKAHEAD more samples have arrived, then final. Segments are found online from the direction of the pressure,
+#    smoothed over the same 10 samples window as QC.parse_segments, and the maximum pressure so far.
+#  - rate of change uses the standard deviation of the segment so far (running Welford variance), not the one of the
+#    whole segment as delayed-mode QC does.
+#  - gear type, timing gap and drift are haul tests: they are updated from running state on every push and reported
+#    with the emitted samples. Mud needs the whole up cast and is left to delayed-mode QC.
+# push and close return the flags of the new samples and of the samples finalized by that call, indexed by sample
+# number, with a 'final' column. A provisional sample is emitted again once it is final.
+class QCStream(object):
+    LOOKAHEAD = 4
+    # finalized samples kept as the left neighbours of the pending ones (10 samples window of the direction)
+    CONTEXT = 6
+
+    def __init__(self, vessel, gear_type, zone, sensor_type, salinity=False):
+        self.vessel = vessel
+        self.gear = gear_type
+        self.zone = zone
+        self.sensor_type = sensor_type
+        self.salinity = salinity
+        self.count = 0  # samples received
+        self.final = 0  # samples finalized
+        self.start = 0  # sample number of the first buffered sample
+        self.buffer = {c: np.zeros(0, dtype='datetime64[us]' if c == 'DATETIME' else float) for c in COLUMNS}
+        self.sample_flags = {}
+        self.types = np.zeros(0, dtype=np.int64)
+
+        # running state
+        self.state = DOWN
+        self.max_pressure = -np.inf
+        self.first_position = None
+        self.first_bottom = None
+        self.roc = {c: {t: _Welford() for t in (DOWN, BOTTOM, UP)} for c in ('TEMPERATURE', 'SALINITY')}
+        self.haul_flags = {'flag_gear_type': 1, 'flag_timing_gap': 1, 'flag_drift': 1}
+
+    def push(self, samples):
+        samples = pd.DataFrame(samples)
+        n = len(samples)
+        if n == 0:
+            # nothing new (the columns may be missing too): an empty result, with the columns of any other push
+            samples = pd.DataFrame({'DATETIME': np.zeros(0, dtype='datetime64[us]')})
+        new = {'DATETIME': as_datetime(samples['DATETIME']).to_numpy().astype('datetime64[us]')}
+        for c in COLUMNS[1:]:
+            new[c] = samples[c].to_numpy(dtype=float) if c in samples else np.full(n, np.nan)
+
+        for c in COLUMNS:
+            self.buffer[c] = np.concatenate([self.buffer[c], new[c]])
+        for name, values in self._sample_tests(new).items():
+            self.sample_flags[name] = np.concatenate([self.sample_flags.get(name, np.zeros(0, np.uint8)), values])
+        self.types = np.concatenate([self.types, np.full(n, self.state)])
+        self.count += n
+        if n:
+            self._haul_tests(new)
+        return self._process(self.count - self.LOOKAHEAD, self.count - n)
+
+    # End of the haul: the pending samples are finalized with the neighbours they have
+    def close(self):
+        return self._process(self.count, self.count)
+
+    def _process(self, finalize_to, first_new):
+        a = self.final - self.start
+        b = max(finalize_to, self.final) - self.start
+        pressure = self.buffer['PRESSURE']
+        previous = qc_kernels.shift(pressure, 1)
+        self.types[a:b] = self._segment(pressure[a:b], qc_kernels.rolling_mean(previous < pressure)[a:b],
+                                        qc_kernels.rolling_mean(previous > pressure)[a:b])
+        self.types[b:] = self.state
+        self._drift(a, b)
+
+        flags = {name: values for name, values in self.sample_flags.items() if name != 'flag_clima'}
+        flags.update(self._neighbour_tests(a, b))
+        flags['flag_clima'] = self.sample_flags['flag_clima']
+        rows = np.union1d(np.arange(a, b), np.arange(first_new - self.start, len(self.types)))
+        out = self._emit(rows, flags, b)
+
+        self.final += b - a
+        drop = max(b - self.CONTEXT, 0)
+        self.start += drop
+        for c in COLUMNS:
+            self.buffer[c] = self.buffer[c][drop:]
+        for name in self.sample_flags:
+            self.sample_flags[name] = self.sample_flags[name][drop:]
+        self.types = self.types[drop:]
+        return out
+
+    def _emit(self, rows, flags, final):
+        out = {'flag_vessel_region': flags['flag_vessel_region'][rows],
+               'flag_gear_type': np.full(len(rows), self.haul_flags['flag_gear_type'], dtype=np.uint8)}
+        out.update({name: values[rows] for name, values in flags.items() if name != 'flag_clima'})
+        out['flag_timing_gap'] = np.full(len(rows), self.haul_flags['flag_timing_gap'], dtype=np.uint8)
+        out['flag_clima'] = flags['flag_clima'][rows]
+        out['flag_drift'] = np.full(len(rows), self.haul_flags['flag_drift'], dtype=np.uint8)
+        aggregated = [values for name, values in out.items() if name not in QC.NOT_AGGREGATED]
+        out['flag'] = np.maximum.reduce(aggregated + [np.ones(len(rows), dtype=np.uint8)])
+        out['type'] = self.types[rows]
+        out['final'] = rows < final
+        return pd.DataFrame(out, index=pd.RangeIndex(0, 0) if len(rows) == 0 else self.start + rows)
+
+    # 2., 4.-8., 14. Tests on every sample on its own, final on arrival
+    def _sample_tests(self, new):
+        max_press, min_temp, max_temp, min_sal, max_sal = [np.nan if limit is None else limit
+                                                           for limit in QC.global_limits(self.sensor_type,
+                                                                                         self.salinity)]
+        temperature, pressure, salinity = new['TEMPERATURE'], new['PRESSURE'], new['SALINITY']
+        mask = land_mask.load()
+        names = ['flag_vessel_region', 'flag_date', 'flag_location'] + (['flag_land'] if mask is not None else []) + [
+            'flag_speed', 'flag_global_range', 'flag_clima']
+        flags = {name: np.ones(len(pressure), dtype=np.uint8) for name in names}
+
+        flags['flag_vessel_region'][vessel_regions.load().outside(self.zone, new['LATITUDE'], new['LONGITUDE'])] = 3
+        flags['flag_date'][(new['DATETIME'] > np.datetime64(datetime.utcnow())) |
+                           (new['DATETIME'] < np.datetime64('2010-01-01'))] = 4
+        flags['flag_location'][(new['LATITUDE'] < -90) | (new['LATITUDE'] > 90) | (new['LONGITUDE'] < -180) | (
+                new['LONGITUDE'] > 180)] = 4
+        if mask is not None:
+            flags['flag_land'][mask.is_land(new['LATITUDE'], new['LONGITUDE'])] = 4
+        # speed from the previous sample, already in the buffer
+        m = min(len(pressure) + 1, len(self.buffer['DATETIME']))
+        flags['flag_speed'] = qc_kernels.impossible_speed(*[self.buffer[c][-m:] for c in (
+            'LATITUDE', 'LONGITUDE', 'DATETIME', 'SPEED')])[m - len(pressure):]
+
+        global_range = flags['flag_global_range']
+        global_range[(pressure >= -5) & (pressure < 0)] = 3
+        global_range[pressure > max_press] = 3
+        global_range[pressure < -5] = 4
+        global_range[(temperature < min_temp) | (temperature > max_temp)] = 4
+        if self.salinity:
+            global_range[(salinity < min_sal) | (salinity > max_sal)] = 4
+
+        min_temp, max_temp, min_sal, max_sal = climatology.limits(QC.zone_limits(self.zone), new['DATETIME'], pressure,
+                                                                  new['LATITUDE'], new['LONGITUDE'])
+        flags['flag_clima'][(temperature < min_temp) | (temperature > max_temp)] = 3
+        if self.salinity:
+            flags['flag_clima'][(salinity < min_sal) | (salinity > max_sal)] = 3
+        return flags
+
+    # 3., 13. Haul tests, from the first and last positions and last time so far
+    def _haul_tests(self, new):
+        latitude, longitude = new['LATITUDE'], new['LONGITUDE']
+        if self.first_position is None:
+            self.first_position = latitude[0], longitude[0]
+        d = geopy.distance.geodesic(self.first_position, (latitude[-1], longitude[-1])).m
+        gt = 1 if d > 200 else 0
+        self.haul_flags['flag_gear_type'] = 3 if (gt == 1 and self.gear == 'Fixed') or (
+                gt == 0 and self.gear == 'Mobile') else 1
+
+        time_gap = np.datetime64(datetime.utcnow()) - new['DATETIME'][-1]
+        self.haul_flags['flag_timing_gap'] = 3 if time_gap / np.timedelta64(1, 'h') > 24 else 1
+
+    # 9.-12. Neighbour tests on the buffer: rows a:b are final, the ones after b provisional (missing neighbours)
+    def _neighbour_tests(self, a, b):
+        temperature, pressure = self.buffer['TEMPERATURE'], self.buffer['PRESSURE']
+        salinity = self.buffer['SALINITY'] if self.salinity else None
+        temp = qc_kernels.neighbours(temperature)
+        flags = {'flag_temp_spike': qc_kernels.spike(temperature, temp, pressure, 6, 2)}
+        if salinity is not None:
+            sal = qc_kernels.neighbours(salinity)
+            flags['flag_sal_spike'] = qc_kernels.spike(salinity, sal, pressure, 0.9, 0.3)
+        flags['flag_rollover'] = qc_kernels.rollover(temperature, temp, self.types)
+        flags['flag_temp_stuck'] = qc_kernels.stuck(temperature, temp, self.types)
+        if salinity is not None:
+            flags['flag_sal_stuck'] = qc_kernels.stuck(salinity, sal, self.types)
+        flags['flag_RoC'] = self._rate_of_change('TEMPERATURE', temp[1], a, b)
+        if salinity is not None:
+            flags['flag_RoC'] = np.maximum(flags['flag_RoC'], self._rate_of_change('SALINITY', sal[1], a, b))
+        return flags
+
+    # 12. Rate of change against the running standard deviation of the segment
+    def _rate_of_change(self, column, previous, a, b, n_dev=3):
+        values = self.buffer[column]
+        sd = np.full(len(values), np.nan)
+        for t, welford in self.roc[column].items():
+            rows = a + np.flatnonzero(self.types[a:b] == t)
+            sd[rows] = welford.update(values[rows])
+            sd[b:][self.types[b:] == t] = welford.std
+        flags = np.ones(len(values), dtype=np.uint8)
+        flags[np.abs(values - previous) > n_dev * sd] = 3
+        return flags
+
+    # Drift between the first and the last final bottom sample
+    def _drift(self, a, b):
+        bottom = a + np.flatnonzero(self.types[a:b] == BOTTOM)
+        if len(bottom) == 0:
+            return
+        last = {c: self.buffer[c][bottom[-1]] for c in ('DATETIME', 'TEMPERATURE', 'SALINITY')}
+        if self.first_bottom is None:
+            self.first_bottom = {c: self.buffer[c][bottom[0]] for c in ('DATETIME', 'TEMPERATURE', 'SALINITY')}
+        first = self.first_bottom
+        flag = 1
+        if (pd.Timedelta(last['DATETIME'] - first['DATETIME']).seconds / 3600) < 24:
+            if abs(first['TEMPERATURE'] - last['TEMPERATURE']) > 3:
+                flag = 3
+            if self.salinity and abs(first['SALINITY'] - last['SALINITY']) > 8:
+                flag = 3
+        self.haul_flags['flag_drift'] = flag
+
+    # Online down/bottom/up segmentation of the samples being finalized: down until the pressure stops increasing in
+    # the deeper half of the haul, bottom until it keeps decreasing below 90% of the maximum, then up.
+    def _segment(self, pressure, rising, falling):
+        types = np.empty(len(pressure), dtype=np.int64)
+        i = 0
+        while i < len(pressure):
+            max_pressure = np.fmax(np.fmax.accumulate(pressure[i:]), self.max_pressure)
+            if self.state == DOWN:
+                switch = (rising[i:] <= 0.5) & (pressure[i:] >= 0.5 * max_pressure)
+            elif self.state == BOTTOM:
+                switch = (falling[i:] >= 0.8) & (pressure[i:] < 0.9 * max_pressure)
+            else:
+                switch = np.zeros(len(pressure) - i, dtype=bool)
+            j = i + int(np.argmax(switch)) if switch.any() else len(pressure)
+            types[i:j] = self.state
+            if j > i:
+                self.max_pressure = max_pressure[j - i - 1]
+            if j < len(pressure):
+                self.state = BOTTOM if self.state == DOWN else UP
+            i = j
+        return types
+
+
+# Running mean and variance (Welford), updated with a block of samples at once (Chan et al. pairwise update)
+class _Welford(object):
+    def __init__(self):
+        self.n, self.mean, self.m2 = 0, 0.0, 0.0
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else np.nan
+
+    # Adds the samples in order and returns the standard deviation (ddof=1) after each of them; NaN are skipped
+    def update(self, values):
+        valid = ~np.isnan(values)
+        shifted = np.where(valid, values - self.mean, 0)
+        k = np.cumsum(valid)
+        s1, s2 = np.cumsum(shifted), np.cumsum(shifted ** 2)
+        n = self.n + k
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(k > 0, s1 / k, 0)
+            m2 = self.m2 + np.where(k > 0, s2 - s1 * delta, 0) + delta ** 2 * self.n * k / np.maximum(n, 1)
+            std = np.where(n > 1, np.sqrt(np.maximum(m2, 0) / (n - 1)), np.nan)
+        if len(values) and k[-1]:
+            self.mean, self.m2, self.n = self.mean + delta[-1] * k[-1] / n[-1], m2[-1], int(n[-1])
+        return std
@@ -5,6 +5,8 @@ import time
 
 import serial
 
+from rockBlockEngine import rockBlockEngine
+
 
 class rockBlockProtocol(object):
 
@@ -35,19 +37,27 @@ class rockBlockException(Exception):
 
 class rockBlock(object):
     IRIDIUM_EPOCH = 1399818235000  # May 11, 2014, at 14:23:55 (This will be 're-epoched' every couple of years!)
+    SIGNAL_THRESHOLD = 2
 
+    # Commands go through rockBlockEngine: every response is read up to its final result code, so nothing waits for a
+    # line that does not come, and a missing or extra line does not shift the responses of the next commands
+    # portId: a serial port, or an open serial-like object (e.g. rockBlockSimulator)
     def __init__(self, portId, callback):
         self.s = None
+        self.engine = None
         self.portId = portId
         self.callback = callback
         self.autoSession = True  # When True, we'll automatically initiate additional sessions if more messages to download
         self.sent = True
         
         try:
-            self.s = serial.Serial(self.portId, 19200, timeout = 5)
+            if (isinstance(self.portId, str)):
+                self.s = serial.Serial(self.portId, 19200, timeout = 5)
+            else:
+                self.s = self.portId
+            self.engine = rockBlockEngine(self.s)
             if (self._configurePort()):
                 self.ping()  # KEEP SACRIFICIAL!
-                self.s.timeout = 60
                 if (self.ping()):
                     if (self.callback != None and callable(self.callback.rockBlockConnected)):
                         self.callback.rockBlockConnected()
@@ -63,33 +73,16 @@ class rockBlock(object):
     # Ensure that the connection is still alive
     def ping(self):
         self._ensureConnectionStatus()
-        command = "AT"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            if (self.s.readline().strip().decode() == "OK"):
-                return True
-        return False
+        return self.engine.execute("AT", timeout=5).ok
 
     # Handy function to check the connection is still alive, else throw an Exception
     def pingception(self):
-        self._ensureConnectionStatus()
-        self.s.timeout = 5
         if (self.ping() == False):
             raise rockBlockException
-        self.s.timeout = 60
 
     def requestSignalStrength(self):
         self._ensureConnectionStatus()
-        command = "AT+CSQ"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            response = self.s.readline().strip().decode()
-            if (response.find("+CSQ") >= 0):
-                self.s.readline().strip().decode()  # OK
-                self.s.readline().strip().decode()  # BLANK
-                if (len(response) == 6):
-                    return int(response[5])
-        return -1
+        return self._signalStrength(self.engine.execute("AT+CSQ"))
 
     def messageCheck(self):
         self._ensureConnectionStatus()
@@ -103,14 +96,10 @@ class rockBlock(object):
 
     def networkTime(self):
         self._ensureConnectionStatus()
-        command = "AT-MSSTM"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            response = self.s.readline().strip().decode()
-            self.s.readline().strip().decode()  # BLANK
-            self.s.readline().strip().decode()  # OK
-            if (not "no network service" in response):
-                utc = int(response[8:], 16)
+        response = self.engine.execute("AT-MSSTM")
+        if (response.ok):
+            if (not "no network service" in response.line):
+                utc = int(response.line[8:], 16)
                 utc = int((self.IRIDIUM_EPOCH + (utc * 90)) / 1000)
                 return utc
             else:
@@ -135,15 +124,24 @@ class rockBlock(object):
             self.callback.rockBlockTxFailed()
         return False
  
+    # One message in one session (a single AT+SBDIX, no retry), without waiting for network time and signal first: for
+    # senders that check the signal themselves, send several messages in a row and retry later themselves
+    # (rockBlockOutbox.rockBlockSender)
+    def transmitMessage(self, msg):
+        self._ensureConnectionStatus()
+        if (self.callback != None and callable(self.callback.rockBlockTxStarted)):
+            self.callback.rockBlockTxStarted()
+        if (self._queueMessage(msg) and self._attemptSession(1)):
+            return True
+        if (self.callback != None and callable(self.callback.rockBlockTxFailed)):
+            self.callback.rockBlockTxFailed()
+        return False
+
     def getSerialIdentifier(self):
         self._ensureConnectionStatus()
-        command = "AT+GSN"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            response = self.s.readline().strip().decode()
-            self.s.readline().strip().decode()  # BLANK
-            self.s.readline().strip().decode()  # OK
-            return response
+        response = self.engine.execute("AT+GSN")
+        if (response.ok):
+            return response.line
 
     # One-time initial setup function (Disables Flow Control)
     # This only needs to be called once, as is stored in non-volitile memory
@@ -151,25 +149,12 @@ class rockBlock(object):
     # Make sure you DISCONNECT RockBLOCK from power for a few minutes after this command has been issued...
     def setup(self):
         self._ensureConnectionStatus()
-        # Disable Flow Control
-        command = "AT&K0"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command and self.s.readline().strip().decode() == "OK"):
-            # Store Configuration into Profile0
-            command = "AT&W0"
-            self.s.write(str.encode(command + "\r"))
-            if (self.s.readline().strip().decode() == command and self.s.readline().strip().decode() == "OK"):
-                # Use Profile0 as default
-                command = "AT&Y0"
-                self.s.write(str.encode(command + "\r"))
-                if (self.s.readline().strip().decode() == command and self.s.readline().strip().decode() == "OK"):
-                    # Flush Memory
-                    command = "AT*F"
-                    self.s.write(str.encode(command + "\r"))
-                    if (self.s.readline().strip().decode() == command and self.s.readline().strip().decode() == "OK"):
-                        # self.close()
-                        return True
-        return False
+        # Disable Flow Control, Store Configuration into Profile0, Use Profile0 as default, Flush Memory
+        for command in ["AT&K0", "AT&W0", "AT&Y0", "AT*F"]:
+            if (not self.engine.execute(command).ok):
+                return False
+        # self.close()
+        return True
 
     def close(self):
         if (self.s != None):
@@ -199,116 +184,74 @@ class rockBlock(object):
     # Private Methods - Don't call these directly!
     def _queueMessage(self, msg):
         self._ensureConnectionStatus()
-        if (len(msg) > 340):
+        # msg: text, or bytes as is (e.g. the binary messages of qc_sbd)
+        data = msg if isinstance(msg, (bytes, bytearray)) else str.encode(str(msg))
+        if (len(data) > 340):
             print("sendMessageWithBytes bytes should be <= 340 bytes")
             return False 
-        command = "AT+SBDWB=" + str(len(msg))
-        #print(command,"rockBlock\n")
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            if (self.s.readline().strip().decode() == "READY"):
-                checksum = 0
-                for c in msg:
-                    checksum = checksum + ord(c)
-                #print(checksum,'\n',str.encode(str(msg)),'\n',str.encode(hex(checksum >> 8)),'\n',str.encode(chr(checksum & 0xFF)))
-                self.s.write(str.encode(str(msg)))
-                #print(checksum >> 8, checksum & 0xFF)
-                #print(checksum)
-                self.s.write(bytes([checksum >> 8]))
-                self.s.write(bytes([checksum & 0xFF]))               
-                #self.s.write(str.encode(chr(checksum >> 8)))
-                #self.s.write(str.encode(chr(checksum & 0xFF)))
-                self.s.readline().strip().decode()  # BLANK
-                result = False
-                transmission = self.s.readline().strip().decode()
-                print("Transmission,",transmission)
-                
-                if (transmission == "0"):
-                    result = True
-                self.s.readline().strip().decode()  # BLANK
-                self.s.readline().strip().decode()  # OK
-                return result
+        if (self.engine.execute("AT+SBDWB=" + str(len(data))).result == "READY"):
+            # least significant 2 bytes of the sum of the message bytes
+            checksum = sum(data) & 0xFFFF
+            response = self.engine.writeData(bytes(data) + bytes([checksum >> 8, checksum & 0xFF]))
+            print("Transmission,", response.line)
+            return response.ok and response.line == "0"
         return False
 
     def _configurePort(self):
-        if (self._enableEcho() and self._disableFlowControl and self._disableRingAlerts() and self.ping()):
+        if (self._enableEcho() and self._disableFlowControl() and self._disableRingAlerts() and self.ping()):
             return True
         else:
             return False
 
     def _enableEcho(self):
         self._ensureConnectionStatus()
-        command = "ATE1"
-        self.s.write(str.encode(command + "\r"))
-        response = self.s.readline().strip().decode()
-        if (response == command or response == ""):
-            if (self.s.readline().strip().decode() == "OK"):
-                return True
-        return False
+        # the echo may still be off: no echo before OK
+        return self.engine.execute("ATE1", timeout=5, echo=None).ok
 
     def _disableFlowControl(self):
         self._ensureConnectionStatus()
-        command = "AT&K0"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            if (self.s.readline().strip().decode() == "OK"):
-                return True
-        return False
+        return self.engine.execute("AT&K0", timeout=5).ok
 
     def _disableRingAlerts(self):
         self._ensureConnectionStatus()
-        command = "AT+SBDMTA=0"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            if (self.s.readline().strip().decode() == "OK"):
-                return True
-        return False
+        return self.engine.execute("AT+SBDMTA=0", timeout=5).ok
 
-    def _attemptSession(self):
+    # Up to attempts SBD sessions, until the message is sent
+    def _attemptSession(self, attempts=8):
         self._ensureConnectionStatus()
-        SESSION_ATTEMPTS = 8
+        SESSION_ATTEMPTS = attempts
         while (True):
             if (SESSION_ATTEMPTS == 0):
                 return False
             SESSION_ATTEMPTS = SESSION_ATTEMPTS - 1
-            command = "AT+SBDIX"
-            self.s.write(str.encode(command + "\r"))
-            if (self.s.readline().strip().decode() == command):
-                response = self.s.readline().strip().decode()
-                if (response.find("+SBDIX:") >= 0):
-                    self.s.readline().decode()  # BLANK
-                    self.s.readline().decode()  # OK
-                    response = response.replace("+SBDIX: ",
-                                                "")  # +SBDIX:<MO status>,<MOMSN>,<MT status>,<MTMSN>,<MT length>,<MTqueued>
-                    parts = response.split(",")
-                    moStatus = int(parts[0])
-                    #print("moStatus,",moStatus)
-                    moMsn = int(parts[1])
-                    mtStatus = int(parts[2])
-                    mtMsn = int(parts[3])
-                    mtLength = int(parts[4])
-                    mtQueued = int(parts[5])
-                    # Mobile Originated
-                    if (moStatus <= 4):
-                        self._clearMoBuffer()
-                        if (self.callback != None and callable(self.callback.rockBlockTxSuccess)):
-                            self.callback.rockBlockTxSuccess(moMsn)
-                        pass
-                    else:
-                        if (self.callback != None and callable(self.callback.rockBlockTxFailed)):
-                            self.callback.rockBlockTxFailed()
-                    if (
-                            mtStatus == 1 and mtLength > 0):  # SBD message successfully received from the GSS.
-                        self._processMtMessage(mtMsn)
-                        # AUTOGET NEXT MESSAGE
-                    if (self.callback != None and callable(self.callback.rockBlockRxMessageQueue)):
-                        self.callback.rockBlockRxMessageQueue(mtQueued)
-                    # There are additional MT messages to queued to download
-                    if (mtQueued > 0 and self.autoSession == True):
-                        self._attemptSession()
-                    if (moStatus <= 4):
-                        return True
-        return False
+            response = self.engine.execute("AT+SBDIX")
+            if (response.ok and response.line.find("+SBDIX:") >= 0):
+                # +SBDIX:<MO status>,<MOMSN>,<MT status>,<MTMSN>,<MT length>,<MTqueued>
+                parts = response.line.replace("+SBDIX:", "").split(",")
+                moStatus = int(parts[0])
+                moMsn = int(parts[1])
+                mtStatus = int(parts[2])
+                mtMsn = int(parts[3])
+                mtLength = int(parts[4])
+                mtQueued = int(parts[5])
+                # Mobile Originated
+                if (moStatus <= 4):
+                    self._clearMoBuffer()
+                    if (self.callback != None and callable(self.callback.rockBlockTxSuccess)):
+                        self.callback.rockBlockTxSuccess(moMsn)
+                else:
+                    if (self.callback != None and callable(self.callback.rockBlockTxFailed)):
+                        self.callback.rockBlockTxFailed()
+                if (mtStatus == 1 and mtLength > 0):  # SBD message successfully received from the GSS.
+                    self._processMtMessage(mtMsn)
+                    # AUTOGET NEXT MESSAGE
+                if (self.callback != None and callable(self.callback.rockBlockRxMessageQueue)):
+                    self.callback.rockBlockRxMessageQueue(mtQueued)
+                # There are additional MT messages to queued to download
+                if (mtQueued > 0 and self.autoSession == True):
+                    self._attemptSession(attempts)
+                if (moStatus <= 4):
+                    return True
 
     def _attemptConnection(self):
         self._ensureConnectionStatus()
@@ -316,75 +259,66 @@ class rockBlock(object):
         TIME_DELAY = 1
         SIGNAL_ATTEMPTS = 10
         RESCAN_DELAY = 5
-        SIGNAL_THRESHOLD = 2
-        # Wait for valid Network Time
+        # Wait for valid Network Time; the signal strength is asked in the same round trip
         while True:
             if (TIME_ATTEMPTS == 0):
                 if (self.callback != None and callable(self.callback.rockBlockSignalFail)):
                     self.callback.rockBlockSignalFail()
                 return False
-            if (self._isNetworkTimeValid()):
+            networkTime, signalStrength = self.engine.pipeline(["AT-MSSTM", "AT+CSQ"])
+            if (self._validNetworkTime(networkTime)):
+                sign = self._signalStrength(signalStrength)
                 break
             TIME_ATTEMPTS = TIME_ATTEMPTS - 1
             time.sleep(TIME_DELAY)
         # Wait for acceptable signal strength
         while True:
-            sign = self.requestSignalStrength()
             if (SIGNAL_ATTEMPTS == 0 or sign < 0):
                 print("NO SIGNAL")
                 self.sent = False
                 if (self.callback != None and callable(self.callback.rockBlockSignalFail)):
                     self.callback.rockBlockSignalFail()
                 return False
-            self.callback.rockBlockSignalUpdate(sign)
-            if (sign >= SIGNAL_THRESHOLD):
+            if (self.callback != None and callable(self.callback.rockBlockSignalUpdate)):
+                self.callback.rockBlockSignalUpdate(sign)
+            if (sign >= self.SIGNAL_THRESHOLD):
                 if (self.callback != None and callable(self.callback.rockBlockSignalPass)):
                     self.callback.rockBlockSignalPass()
                 return True
             SIGNAL_ATTEMPTS = SIGNAL_ATTEMPTS - 1
             time.sleep(RESCAN_DELAY)
+            sign = self.requestSignalStrength()
 
+    # MT message content: the message bytes as text (latin-1, one character per byte)
     def _processMtMessage(self, mtMsn):
         self._ensureConnectionStatus()
-        self.s.write(str.encode("AT+SBDRB\r"))
-        response = self.s.readline().strip().decode().replace("AT+SBDRB\r", "").strip()
-        if (response == "OK"):
+        response = self.engine.execute("AT+SBDRB", binary=True)
+        if (not response.data):
             print("No message content.. strange!")
             if (self.callback != None and callable(self.callback.rockBlockRxReceived)):
                 self.callback.rockBlockRxReceived(mtMsn, "")
         else:
-            content = response[2:-2]
             if (self.callback != None and callable(self.callback.rockBlockRxReceived)):
-                self.callback.rockBlockRxReceived(mtMsn, content)
-            self.s.readline().decode()  # BLANK?
+                self.callback.rockBlockRxReceived(mtMsn, response.data.decode('latin-1'))
 
-    def _isNetworkTimeValid(self):
-        self._ensureConnectionStatus()
-        command = "AT-MSSTM"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):  # Echo
-            response = self.s.readline().strip().decode()
-            if (response.startswith("-MSSTM")):  # -MSSTM: a5cb42ad / no network service
-                self.s.readline().decode()  # OK
-                self.s.readline().decode()  # BLANK
-                if (len(response) == 16):
-                    return True
-        return False
+    # -MSSTM: a5cb42ad / no network service
+    @staticmethod
+    def _validNetworkTime(response):
+        return response.ok and response.line.startswith("-MSSTM") and len(response.line) == 16
+
+    # +CSQ:<0-5>, -1 when there is no answer
+    @staticmethod
+    def _signalStrength(response):
+        if (response.ok and response.line.find("+CSQ") >= 0 and len(response.line) == 6):
+            return int(response.line[5])
+        return -1
 
     def _clearMoBuffer(self):
         self._ensureConnectionStatus()
-        command = "AT+SBDD0"
-        self.s.write(str.encode(command + "\r"))
-        if (self.s.readline().strip().decode() == command):
-            if (self.s.readline().strip().decode() == "0"):
-                self.s.readline().decode() # BLANK
-                if (self.s.readline().strip().decode() == "OK"):
-                    return True
-        return False
+        response = self.engine.execute("AT+SBDD0")
+        return response.ok and response.line == "0"
 
     def _ensureConnectionStatus(self):
         if (self.s == None or self.s.isOpen() == False):
             print ('no connection')
             raise rockBlockException()
-
-
@@ -0,0 +1,261 @@
+import asyncio
+import inspect
+
+from rockBlock import rockBlock, rockBlockException
+from rockBlockEngine import rockBlockParser, DEFAULT_TIMEOUT, TIMEOUTS
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+# asyncio version of rockBlock: the same AT commands, parsed by the same rockBlockParser, over an asyncio stream
+# (pyserial-asyncio for a serial port, or any StreamReader/StreamWriter pair), so that waiting for the modem (up to a
+# minute for a session, retries and signal scans) never blocks the event loop and the process keeps acquiring and
+# QC'ing data meanwhile. Every command has its own deadline (rockBlockEngine.TIMEOUTS).
+# One command runs at a time (the modem talks to one caller at a time): concurrent calls wait for each other.
+# The rockBlockProtocol callbacks become events: the method of callback with the same name is called (and awaited
+# when it is a coroutine function), and every queue returned by subscribe() receives (name, args).
+class rockBlockAsync(object):
+    IRIDIUM_EPOCH = rockBlock.IRIDIUM_EPOCH
+    SIGNAL_THRESHOLD = rockBlock.SIGNAL_THRESHOLD
+
+    def __init__(self, reader, writer, callback=None):
+        self.reader = reader
+        self.writer = writer
+        self.callback = callback
+        self.parser = rockBlockParser()
+        self.auto_session = True  # When True, we'll automatically initiate additional sessions if more messages to download
+        self.sent = True
+        self.lock = asyncio.Lock()
+        self.subscribers = []
+
+    # Opens the serial port and configures the modem (echo on, no flow control, no ring alerts)
+    @classmethod
+    async def connect(cls, port_id, callback=None, baudrate=19200):
+        if serial_asyncio is None:
+            raise ImportError('rockBlockAsync.connect needs pyserial-asyncio')
+        reader, writer = await serial_asyncio.open_serial_connection(url=port_id, baudrate=baudrate)
+        modem = cls(reader, writer, callback)
+        await modem.open()
+        return modem
+
+    async def open(self):
+        if await self._configure_port():
+            await self.ping()  # KEEP SACRIFICIAL!
+            if await self.ping():
+                await self._emit('rockBlockConnected')
+                return
+        self.close()
+        raise rockBlockException()
+
+    # Events (name, args) of the callbacks, from now on
+    def subscribe(self):
+        queue = asyncio.Queue()
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.remove(queue)
+
+    async def ping(self):
+        async with self.lock:
+            return (await self._execute("AT", timeout=5)).ok
+
+    async def signal_strength(self):
+        async with self.lock:
+            return rockBlock._signalStrength(await self._execute("AT+CSQ"))
+
+    async def message_check(self):
+        async with self.lock:
+            await self._emit('rockBlockRxStarted')
+            if await self._attempt_connection() and await self._attempt_session():
+                return True
+            await self._emit('rockBlockRxFailed')
+            return False
+
+    async def network_time(self):
+        async with self.lock:
+            response = await self._execute("AT-MSSTM")
+            if response.ok:
+                if not "no network service" in response.line:
+                    utc = int(response.line[8:], 16)
+                    return int((self.IRIDIUM_EPOCH + (utc * 90)) / 1000)
+                return 0
+
+    # Text or bytes (e.g. the messages of qc_sbd), at most 340 bytes
+    async def send_message(self, msg):
+        async with self.lock:
+            await self._emit('rockBlockTxStarted')
+            if await self._queue_message(msg) and await self._attempt_connection():
+                session_attempts = 6
+                while True:
+                    session_attempts -= 1
+                    if session_attempts == 0:
+                        break
+                    if await self._attempt_session():
+                        return True
+                    await asyncio.sleep(1)
+            await self._emit('rockBlockTxFailed')
+            return False
+
+    # One message in one session (a single AT+SBDIX, no retry), without waiting for network time and signal first (see
+    # rockBlock.transmitMessage)
+    async def transmit_message(self, msg):
+        async with self.lock:
+            await self._emit('rockBlockTxStarted')
+            if await self._queue_message(msg) and await self._attempt_session(1):
+                return True
+            await self._emit('rockBlockTxFailed')
+            return False
+
+    async def serial_identifier(self):
+        async with self.lock:
+            response = await self._execute("AT+GSN")
+            if response.ok:
+                return response.line
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    # Private Methods - Don't call these directly! (the caller holds the lock)
+
+    # Commands written back to back, their responses (rockBlockResponse) once complete or at the deadline
+    async def _pipeline(self, commands, timeout=None, echo=True, binary=False):
+        self._ensure_connection_status()
+        responses = [self.parser.expect(command, echo, binary) for command in commands]
+        self.writer.write(b''.join(str.encode(command + "\r") for command in commands))
+        if timeout is None:
+            timeout = max(TIMEOUTS.get(command, DEFAULT_TIMEOUT) for command in commands)
+        return await self._wait(responses, timeout)
+
+    async def _execute(self, command, timeout=None, echo=True, binary=False):
+        return (await self._pipeline([command], timeout, echo, binary))[0]
+
+    async def _write_data(self, data, timeout=DEFAULT_TIMEOUT):
+        self._ensure_connection_status()
+        response = self.parser.expect(None, echo=False)
+        self.writer.write(bytes(data))
+        return (await self._wait([response], timeout))[0]
+
+    async def _wait(self, responses, timeout):
+        await self.writer.drain()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not responses[-1].done:
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                data = await asyncio.wait_for(self.reader.read(4096), remaining)
+            except asyncio.TimeoutError:
+                for response in responses:
+                    self.parser.abandon(response)
+                break
+            if not data:
+                # connection closed: nothing more will come for these commands
+                for response in responses:
+                    self.parser.abandon(response)
+                raise rockBlockException()
+            self.parser.feed(data)
+        return responses
+
+    async def _queue_message(self, msg):
+        data = msg if isinstance(msg, (bytes, bytearray)) else str.encode(str(msg))
+        if len(data) > 340:
+            return False
+        if (await self._execute("AT+SBDWB=" + str(len(data)))).result == "READY":
+            # least significant 2 bytes of the sum of the message bytes
+            checksum = sum(data) & 0xFFFF
+            response = await self._write_data(bytes(data) + bytes([checksum >> 8, checksum & 0xFF]))
+            return response.ok and response.line == "0"
+        return False
+
+    async def _configure_port(self):
+        # the echo may still be off: no echo before the OK of ATE1
+        return (await self._execute("ATE1", timeout=5, echo=None)).ok and \
+            (await self._execute("AT&K0", timeout=5)).ok and \
+            (await self._execute("AT+SBDMTA=0", timeout=5)).ok and \
+            (await self._execute("AT", timeout=5)).ok
+
+    # Up to attempts SBD sessions, until the message is sent
+    async def _attempt_session(self, attempts=8):
+        session_attempts = attempts
+        while True:
+            if session_attempts == 0:
+                return False
+            session_attempts -= 1
+            response = await self._execute("AT+SBDIX")
+            if response.ok and response.line.find("+SBDIX:") >= 0:
+                # +SBDIX:<MO status>,<MOMSN>,<MT status>,<MTMSN>,<MT length>,<MTqueued>
+                parts = response.line.replace("+SBDIX:", "").split(",")
+                mo_status, mo_msn, mt_status, mt_msn, mt_length, mt_queued = [int(part) for part in parts]
+                # Mobile Originated
+                if mo_status <= 4:
+                    await self._clear_mo_buffer()
+                    await self._emit('rockBlockTxSuccess', mo_msn)
+                else:
+                    await self._emit('rockBlockTxFailed')
+                if mt_status == 1 and mt_length > 0:  # SBD message successfully received from the GSS.
+                    await self._process_mt_message(mt_msn)
+                await self._emit('rockBlockRxMessageQueue', mt_queued)
+                # There are additional MT messages to queued to download
+                if mt_queued > 0 and self.auto_session:
+                    await self._attempt_session(attempts)
+                if mo_status <= 4:
+                    return True
+
+    async def _attempt_connection(self):
+        time_attempts = 10
+        time_delay = 1
+        signal_attempts = 10
+        rescan_delay = 5
+        # Wait for valid Network Time; the signal strength is asked in the same round trip
+        while True:
+            if time_attempts == 0:
+                await self._emit('rockBlockSignalFail')
+                return False
+            network_time, signal_strength = await self._pipeline(["AT-MSSTM", "AT+CSQ"])
+            if rockBlock._validNetworkTime(network_time):
+                sign = rockBlock._signalStrength(signal_strength)
+                break
+            time_attempts -= 1
+            await asyncio.sleep(time_delay)
+        # Wait for acceptable signal strength
+        while True:
+            if signal_attempts == 0 or sign < 0:
+                self.sent = False
+                await self._emit('rockBlockSignalFail')
+                return False
+            await self._emit('rockBlockSignalUpdate', sign)
+            if sign >= self.SIGNAL_THRESHOLD:
+                await self._emit('rockBlockSignalPass')
+                return True
+            signal_attempts -= 1
+            await asyncio.sleep(rescan_delay)
+            sign = rockBlock._signalStrength(await self._execute("AT+CSQ"))
+
+    # MT message content: the message bytes as text (latin-1, one character per byte), as rockBlock
+    async def _process_mt_message(self, mt_msn):
+        response = await self._execute("AT+SBDRB", binary=True)
+        await self._emit('rockBlockRxReceived', mt_msn, (response.data or b'').decode('latin-1'))
+
+    async def _clear_mo_buffer(self):
+        response = await self._execute("AT+SBDD0")
+        return response.ok and response.line == "0"
+
+    async def _emit(self, name, *args):
+        for queue in self.subscribers:
+            queue.put_nowait((name, args))
+        method = getattr(self.callback, name, None)
+        if callable(method):
+            result = method(*args)
+            if inspect.isawaitable(result):
+                await result
+
+    def _ensure_connection_status(self):
+        if self.writer is None or self.writer.is_closing():
+            raise rockBlockException()
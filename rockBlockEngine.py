@@ -0,0 +1,173 @@
+import collections
+import time
+
+# AT command/response engine of the rockBlock drivers.
+# rockBlockParser frames the bytes coming from the modem (no I/O of its own, so the blocking and the asyncio drivers
+# share it): it buffers them, splits them into lines (ended by CR and/or LF, blank lines dropped) and gives every line
+# to the oldest command still waiting for its response. A command first waits for its echo; the lines after it are
+# its response until a final result code (OK, ERROR, or READY for AT+SBDWB), or its binary payload (AT+SBDRB: 2-byte
+# length, message, 2-byte checksum) then the final result code. Lines that belong to no command (SBDRING, the late
+# response of a command that timed out, noise) are kept in unsolicited, so a missing line never shifts the responses
+# of the commands that follow.
+# Commands can be pipelined: written back to back (e.g. AT-MSSTM and AT+CSQ) and their responses matched in order, with
+# one deadline for the whole pipeline instead of a wait per line.
+
+FINAL = ('OK', 'ERROR', 'READY')
+DEFAULT_TIMEOUT = 10
+# Commands that take longer than a serial round trip: a session waits for the satellite
+TIMEOUTS = {'AT+SBDIX': 60}
+
+
+# Response of one command: the info lines between the echo and the final result code, the final result code (None
+# while waiting, or when the command timed out) and the binary payload of AT+SBDRB
+class rockBlockResponse(object):
+    def __init__(self, command, echo=True, binary=False):
+        self.command = command
+        self.echo = echo  # True: the echo comes first, None: optional (ATE1, echo may still be off), False: none
+        self.binary = binary
+        self.lines = []
+        self.result = None
+        self.data = None
+        self.done = False
+        self._echoed = not echo
+
+    @property
+    def ok(self):
+        return self.result == 'OK'
+
+    @property
+    def timedOut(self):
+        return self.result is None
+
+    # First info line ("" when there is none)
+    @property
+    def line(self):
+        return self.lines[0] if self.lines else ""
+
+    # Consumes what the parser has for this response: True once complete
+    def step(self, parser):
+        while not self.done:
+            if self._echoed and self.binary and self.data is None:
+                data = parser.raw()
+                if data is None:
+                    return False
+                self.data = data
+                continue
+            line = parser.line()
+            if line is None:
+                return False
+            if not self._echoed:
+                if line == self.command:
+                    self._echoed = True
+                elif self.echo is None and line in FINAL:
+                    self.result, self.done = line, True
+                else:
+                    parser.unsolicited.append(line)
+            elif line in FINAL:
+                self.result, self.done = line, True
+            else:
+                self.lines.append(line)
+        return True
+
+    def __repr__(self):
+        return 'rockBlockResponse(%r, %r, %r)' % (self.command, self.lines, self.result)
+
+
+class rockBlockParser(object):
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.unsolicited = []
+
+    # Registers a command written to the modem (or about to be): its response is filled as the bytes come
+    def expect(self, command, echo=True, binary=False):
+        response = rockBlockResponse(command, echo, binary)
+        self.pending.append(response)
+        return response
+
+    # Stops waiting for a response (timed out): its late lines will be unsolicited
+    def abandon(self, response):
+        if response in self.pending:
+            self.pending.remove(response)
+
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.pending:
+                if not self.pending[0].step(self):
+                    return
+                self.pending.popleft()
+            else:
+                line = self.line()
+                if line is None:
+                    return
+                self.unsolicited.append(line)
+
+    # Next non blank line, None until one is complete
+    def line(self):
+        while True:
+            ends = [i for i in (self.buffer.find(b'\r'), self.buffer.find(b'\n')) if i >= 0]
+            if not ends:
+                return None
+            end = min(ends)
+            line = bytes(self.buffer[:end]).strip().decode(errors='replace')
+            del self.buffer[:end + 1]
+            if line:
+                return line
+
+    # Binary payload of AT+SBDRB (length, message, checksum), the message only, None until complete
+    def raw(self):
+        # the CR/LF left from the echo line
+        while self.buffer[:1] in (b'\r', b'\n'):
+            del self.buffer[:1]
+        if len(self.buffer) < 2:
+            return None
+        n = int.from_bytes(self.buffer[:2], 'big')
+        if len(self.buffer) < n + 4:
+            return None
+        data = bytes(self.buffer[2:n + 2])
+        del self.buffer[:n + 4]
+        return data
+
+    def clearUnsolicited(self):
+        lines, self.unsolicited = self.unsolicited, []
+        return lines
+
+
+# Blocking engine over a pyserial-like port (read, write, timeout and in_waiting)
+class rockBlockEngine(object):
+    def __init__(self, s):
+        self.s = s
+        self.parser = rockBlockParser()
+
+    # One command: its response once complete, or timed out (result None) at its deadline
+    def execute(self, command, timeout=None, echo=True, binary=False):
+        return self.pipeline([command], timeout, echo, binary)[0]
+
+    # Commands written back to back, their responses matched in order within one deadline
+    def pipeline(self, commands, timeout=None, echo=True, binary=False):
+        responses = [self.parser.expect(command, echo, binary) for command in commands]
+        self.s.write(b''.join(str.encode(command + "\r") for command in commands))
+        if timeout is None:
+            timeout = max(TIMEOUTS.get(command, DEFAULT_TIMEOUT) for command in commands)
+        return self._wait(responses, timeout)
+
+    # Raw bytes (the message of AT+SBDWB), then the lines up to the final result code
+    def writeData(self, data, timeout=DEFAULT_TIMEOUT):
+        response = self.parser.expect(None, echo=False)
+        self.s.write(bytes(data))
+        return self._wait([response], timeout)[0]
+
+    def _wait(self, responses, timeout):
+        deadline = time.monotonic() + timeout
+        while not responses[-1].done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for response in responses:
+                    self.parser.abandon(response)
+                break
+            self.s.timeout = remaining
+            data = self.s.read(max(self.s.in_waiting, 1))
+            if data:
+                self.parser.feed(data)
+        return responses
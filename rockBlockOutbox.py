@@ -0,0 +1,166 @@
+import sqlite3
+import threading
+import time
+
+from rockBlock import rockBlock
+
+
+# Durable outbox for rockBlock: messages are written to a SQLite file before any attempt to send them, so a queued
+# message survives the process. A message is only marked as sent once its session succeeded; a process dying in
+# between sends it again (at least once delivery).
+# Messages are sent by priority (highest first), then newest batch first (a batch being the messages put together,
+# e.g. the qc_sbd messages of one haul, sent in the order they were put). A failed message waits before its next
+# attempt, twice as long after every failure (retryDelay up to maxRetryDelay).
+# One outbox can be shared by the threads queuing messages and the sender thread.
+class rockBlockOutbox(object):
+    def __init__(self, path='outbox.sqlite', retryDelay=30, maxRetryDelay=3600, clock=time.time):
+        self.path = path
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, data BLOB, '
+                        'priority INTEGER, created REAL, attempts INTEGER DEFAULT 0, nextAttempt REAL, sent REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messagesPending ON messages (sent, priority, created)')
+        self.db.commit()
+
+    # Queues one message (text or bytes), returns its id
+    def put(self, msg, priority=0):
+        return self.putMessages([msg], priority)[0]
+
+    # Queues messages sent one after the other (e.g. the fragments of a haul), returns their ids
+    def putMessages(self, msgs, priority=0):
+        with self.lock:
+            now = self.clock()
+            ids = []
+            with self.db:
+                for msg in msgs:
+                    data = msg if isinstance(msg, (bytes, bytearray)) else str.encode(str(msg))
+                    if (len(data) > 340):
+                        raise ValueError('Messages should be <= 340 bytes')
+                    cursor = self.db.execute('INSERT INTO messages (data, priority, created, nextAttempt) '
+                                             'VALUES (?, ?, ?, ?)', (bytes(data), priority, now, now))
+                    ids.append(cursor.lastrowid)
+            return ids
+
+    # Next message to send as (id, data), None when nothing is due
+    def next(self):
+        with self.lock:
+            row = self.db.execute('SELECT id, data FROM messages WHERE sent IS NULL AND nextAttempt <= ? '
+                                  'ORDER BY priority DESC, created DESC, id LIMIT 1', (self.clock(),)).fetchone()
+            return None if row is None else (row[0], row[1])
+
+    def markSent(self, messageId):
+        with self.lock:
+            with self.db:
+                self.db.execute('UPDATE messages SET sent = ?, attempts = attempts + 1 WHERE id = ?',
+                                (self.clock(), messageId))
+
+    def markFailed(self, messageId):
+        with self.lock:
+            attempts = self.db.execute('SELECT attempts FROM messages WHERE id = ?', (messageId,)).fetchone()[0] + 1
+            delay = min(self.retryDelay * 2 ** (attempts - 1), self.maxRetryDelay)
+            with self.db:
+                self.db.execute('UPDATE messages SET attempts = ?, nextAttempt = ? WHERE id = ?',
+                                (attempts, self.clock() + delay, messageId))
+
+    # Messages waiting to be sent
+    def depth(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM messages WHERE sent IS NULL').fetchone()[0]
+
+    # Queue depth, messages due now, age of the oldest waiting message, messages and bytes sent (in total and in the
+    # last window seconds) and the throughput over that window in messages per hour
+    def metrics(self, window=3600):
+        with self.lock:
+            now = self.clock()
+            depth, due, oldest = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(nextAttempt <= ?), 0), MIN(created) FROM messages WHERE sent IS NULL',
+                (now,)).fetchone()
+            sent, sentBytes, attempts = self.db.execute(
+                'SELECT COUNT(sent), COALESCE(SUM(CASE WHEN sent IS NULL THEN 0 ELSE LENGTH(data) END), 0), '
+                'COALESCE(SUM(attempts), 0) FROM messages').fetchone()
+            recent, recentBytes = self.db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM messages '
+                                                  'WHERE sent >= ?', (now - window,)).fetchone()
+            return {'depth': depth, 'due': due, 'oldestAge': 0 if oldest is None else now - oldest, 'sent': sent,
+                    'sentBytes': sentBytes, 'attempts': attempts, 'recentSent': recent, 'recentBytes': recentBytes,
+                    'messagesPerHour': recent * 3600.0 / window}
+
+    # Deletes the messages sent more than age seconds ago
+    def purge(self, age=7 * 24 * 3600):
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM messages WHERE sent < ?', (self.clock() - age,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Sender loop draining a rockBlockOutbox through a rockBlock.
+# The signal is checked once per window; with good signal the due messages are then sent one after the other, one
+# session attempt each (rockBlock.transmitMessage), until the outbox is empty or maxFailures sessions in a row failed
+# (the signal is most likely gone). A failed message is not retried in the window but by the outbox backoff. Without
+# signal, or when nothing could be sent, the next window waits twice as long (windowDelay up to maxWindowDelay); a
+# successful window resets it.
+class rockBlockSender(object):
+    SIGNAL_THRESHOLD = rockBlock.SIGNAL_THRESHOLD
+
+    def __init__(self, rockBlock, outbox, windowDelay=5, maxWindowDelay=300, idleDelay=60, maxFailures=2):
+        self.rockBlock = rockBlock
+        self.outbox = outbox
+        self.windowDelay = windowDelay
+        self.maxWindowDelay = maxWindowDelay
+        self.idleDelay = idleDelay
+        self.maxFailures = maxFailures
+        self.delay = windowDelay
+        self.windows = 0
+        self.signalFailures = 0
+        self.sessionFailures = 0
+        self.sent = 0
+
+    # One window: returns the number of messages sent
+    def drain(self):
+        self.windows += 1
+        sign = self.rockBlock.requestSignalStrength()
+        if (sign < self.SIGNAL_THRESHOLD):
+            self.signalFailures += 1
+            return 0
+        sent, failures = 0, 0
+        while (failures < self.maxFailures):
+            message = self.outbox.next()
+            if (message is None):
+                break
+            messageId, data = message
+            if (self.rockBlock.transmitMessage(data)):
+                self.outbox.markSent(messageId)
+                sent += 1
+                failures = 0
+            else:
+                self.outbox.markFailed(messageId)
+                self.sessionFailures += 1
+                failures += 1
+        self.sent += sent
+        return sent
+
+    # Drains the outbox until stop (a threading.Event) is set, waiting idleDelay while it is empty
+    def run(self, stop):
+        while (not stop.is_set()):
+            if (self.outbox.next() is None):
+                stop.wait(self.idleDelay)
+                continue
+            if (self.drain() > 0):
+                self.delay = self.windowDelay
+            else:
+                self.delay = min(self.delay * 2, self.maxWindowDelay)
+            stop.wait(self.delay)
+
+    # Outbox metrics with the windows, signal and session failures and messages sent by this sender
+    def metrics(self, window=3600):
+        metrics = self.outbox.metrics(window)
+        metrics.update({'windows': self.windows, 'signalFailures': self.signalFailures,
+                        'sessionFailures': self.sessionFailures, 'senderSent': self.sent, 'windowDelay': self.delay})
+        return metrics
@@ -0,0 +1,190 @@
+import random
+import time
+
+
+# Simulated RockBLOCK (Iridium 9602/9603) behind a pyserial-like interface (write, read, in_waiting, timeout,
+# readline, isOpen, close), to run rockBlock (pass it as portId), rockBlockEngine and the outbox without a device.
+# It answers the AT commands the drivers use: AT, ATE0/ATE1, AT&K0, AT&W0, AT&Y0, AT*F, AT+SBDMTA, AT+CSQ, AT-MSSTM,
+# AT+SBDWB (with the checksum checked), AT+SBDIX, AT+SBDRB, AT+SBDD0 and AT+GSN, with the echo and line endings of the
+# modem.
+# One modem second takes timeScale wall seconds (modem seconds = wall seconds / timeScale, so timeScale < 1 runs the
+# modem faster than real time): every response comes latency modem seconds after its command, sessionLatency for
+# AT+SBDIX.
+# signal is the AT+CSQ bars (0-5): a number, a callable of the modem time, or a list of (seconds, bars) repeated over
+# time. A session fails without signal and else with probability failureRate. mtMessages are delivered one per
+# successful session, the others being reported as queued. delivered holds the MO messages sent, in order.
+class rockBlockSimulator(object):
+    IRIDIUM_EPOCH = 1399818235000
+    MO_FAILED, MO_NO_NETWORK = 18, 32
+
+    def __init__(self, signal=5, latency=0.05, sessionLatency=8.0, failureRate=0.0, mtMessages=(), timeScale=1.0,
+                 echo=True, serial='300234010753370', seed=0):
+        self.signal = signal
+        self.latency = latency
+        self.sessionLatency = sessionLatency
+        self.failureRate = failureRate
+        self.mtMessages = [bytes(message) for message in mtMessages]
+        self.timeScale = timeScale
+        self.echo = echo
+        self.serial = serial
+        self.random = random.Random(seed)
+        self.timeout = None
+        self.start = time.monotonic()
+        self.pending = []  # (ready at, bytes) in order
+        self.input = bytearray()
+        self.binary = 0  # bytes expected after AT+SBDWB
+        self.moBuffer = None
+        self.mtBuffer = None
+        self.momsn, self.mtmsn = 0, 0
+        self.delivered = []
+        self.sessions, self.failedSessions, self.commands = 0, 0, 0
+        self._open = True
+
+    # Modem time in seconds
+    def clock(self):
+        return (time.monotonic() - self.start) / self.timeScale
+
+    def bars(self):
+        if callable(self.signal):
+            return int(self.signal(self.clock()))
+        if isinstance(self.signal, (list, tuple)):
+            t = self.clock() % sum(seconds for seconds, bars in self.signal)
+            for seconds, bars in self.signal:
+                if t < seconds:
+                    return bars
+                t -= seconds
+        return int(self.signal)
+
+    # Serial interface
+
+    def isOpen(self):
+        return self._open
+
+    is_open = property(isOpen)
+
+    def close(self):
+        self._open = False
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        return sum(len(data) for ready, data in self.pending if ready <= now)
+
+    def write(self, data):
+        self.input += data
+        while self._command():
+            pass
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        out = bytearray()
+        while len(out) < size:
+            now = time.monotonic()
+            while self.pending and self.pending[0][0] <= now and len(out) < size:
+                ready, data = self.pending.pop(0)
+                take = size - len(out)
+                out += data[:take]
+                if len(data) > take:
+                    self.pending.insert(0, (ready, data[take:]))
+            if len(out) >= size or (deadline is not None and now >= deadline):
+                break
+            wake = self.pending[0][0] if self.pending else now + 0.01
+            if deadline is not None:
+                wake = min(wake, deadline)
+            time.sleep(max(wake - now, 0))
+        return bytes(out)
+
+    def readline(self):
+        line = bytearray()
+        while not line.endswith(b'\n'):
+            data = self.read(1)
+            if not data:
+                break
+            line += data
+        return bytes(line)
+
+    # Modem
+
+    def _respond(self, *lines, **kwargs):
+        delay = kwargs.get('delay', self.latency)
+        ready = max(time.monotonic() + delay * self.timeScale, self.pending[-1][0] if self.pending else 0)
+        data = b''.join(line if isinstance(line, bytes) else b'\r\n' + line.encode() + b'\r\n' for line in lines)
+        self.pending.append((ready, data))
+
+    def _command(self):
+        if self.binary:
+            if len(self.input) < self.binary:
+                return False
+            data, checksum = bytes(self.input[:self.binary - 2]), self.input[self.binary - 2:self.binary]
+            del self.input[:self.binary]
+            self.binary = 0
+            valid = (sum(data) & 0xFFFF) == int.from_bytes(checksum, 'big')
+            if valid:
+                self.moBuffer = data
+            self._respond('0' if valid else '2', 'OK')
+            return True
+        end = self.input.find(b'\r')
+        if end < 0:
+            return False
+        command = self.input[:end].decode(errors='replace').strip()
+        del self.input[:end + 1]
+        self.commands += 1
+        if self.echo:
+            self._respond(command.encode() + b'\r', delay=0)
+        if command in ('ATE0', 'ATE1'):
+            self.echo = command == 'ATE1'
+            self._respond('OK')
+        elif command in ('AT', 'AT&K0', 'AT&W0', 'AT&Y0', 'AT*F') or command.startswith('AT+SBDMTA='):
+            self._respond('OK')
+        elif command == 'AT+CSQ':
+            self._respond('+CSQ:%d' % self.bars(), 'OK')
+        elif command == 'AT-MSSTM':
+            if self.bars() > 0:
+                # 90 ms ticks since the Iridium epoch, in 32 bits (the count wraps, hence the re-epochs)
+                ticks = int((time.time() * 1000 - self.IRIDIUM_EPOCH) / 90) % 2 ** 32
+                self._respond('-MSSTM: %08x' % ticks, 'OK')
+            else:
+                self._respond('-MSSTM: no network service', 'OK')
+        elif command == 'AT+GSN':
+            self._respond(self.serial, 'OK')
+        elif command.startswith('AT+SBDWB='):
+            size = int(command[9:])
+            if size < 1 or size > 340:
+                self._respond('3', 'OK')
+            else:
+                self.binary = size + 2
+                self._respond('READY')
+        elif command == 'AT+SBDIX':
+            self._session()
+        elif command == 'AT+SBDRB':
+            data = self.mtBuffer or b''
+            checksum = sum(data) & 0xFFFF
+            self._respond(len(data).to_bytes(2, 'big') + data + checksum.to_bytes(2, 'big'), 'OK')
+        elif command == 'AT+SBDD0':
+            self.moBuffer = None
+            self._respond('0', 'OK')
+        else:
+            self._respond('ERROR')
+        return True
+
+    # +SBDIX: <MO status>, <MOMSN>, <MT status>, <MTMSN>, <MT length>, <MT queued>
+    def _session(self):
+        self.sessions += 1
+        bars = self.bars()
+        if bars == 0 or self.random.random() < self.failureRate:
+            self.failedSessions += 1
+            status = self.MO_NO_NETWORK if bars == 0 else self.MO_FAILED
+            self._respond('+SBDIX: %d, %d, 2, %d, 0, %d' % (status, self.momsn, self.mtmsn, len(self.mtMessages)),
+                          'OK', delay=self.sessionLatency)
+            return
+        if self.moBuffer is not None:
+            self.momsn += 1
+            self.delivered.append(self.moBuffer)
+        mtStatus, mtLength = 0, 0
+        if self.mtMessages:
+            self.mtBuffer = self.mtMessages.pop(0)
+            self.mtmsn += 1
+            mtStatus, mtLength = 1, len(self.mtBuffer)
+        self._respond('+SBDIX: 0, %d, %d, %d, %d, %d' % (self.momsn, mtStatus, self.mtmsn, mtLength,
+                                                        len(self.mtMessages)), 'OK', delay=self.sessionLatency)
@@ -0,0 +1,46 @@
+# Lookups in the gridded climatology (climatology.py): cells of a regional grid, across the antimeridian, NaN outside
+# the grid, and the wrap around of a global grid.
+# Run with: python -m pytest tests
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from climatology import Climatology
+
+DEPTH_EDGES = [0, 100, 1000]
+
+
+# Grid whose min temperature is 100 * row + column of the cell
+def grid(path, rows, columns, north, west, resolution):
+    limits = np.zeros((12, len(DEPTH_EDGES) - 1, rows, columns, 4), dtype=np.float32)
+    limits[..., 0] = 100 * np.arange(rows)[:, None] + np.arange(columns)[None, :]
+    Climatology.write(path, limits, DEPTH_EDGES, north, west, resolution)
+    return Climatology(path)
+
+
+def min_temp(climatology, latitude, longitude):
+    n = len(latitude)
+    return climatology.lookup(np.full(n, np.datetime64('2021-03-01T10:00')), np.full(n, 10.0), latitude,
+                              longitude)[0]
+
+
+def test_regional_grid(tmp_path):
+    # 10 x 20 cells of 1 degree from 60N 170E, eastwards to 170W
+    climatology = grid(str(tmp_path / 'clim.bin'), 10, 20, 60.0, 170.0, 1.0)
+    latitude = [55.5, 55.5, 55.5, 55.5, 55.5, 65.0, 45.0, np.nan]
+    longitude = [175.5, -175.5, 170.0, -160.0, 160.0, 175.5, 175.5, 175.5]
+    expected = [405, 414, 400, np.nan, np.nan, np.nan, np.nan, np.nan]
+    np.testing.assert_array_equal(min_temp(climatology, latitude, longitude), expected)
+
+
+def test_global_grid_wraps(tmp_path):
+    climatology = grid(str(tmp_path / 'clim.bin'), 18, 36, 90.0, -180.0, 10.0)
+    np.testing.assert_array_equal(min_temp(climatology, [85.0, 85.0, 85.0], [-175.0, 180.0, 175.0]), [0, 0, 35])
+
+
+def test_months(tmp_path):
+    with pytest.raises(ValueError):
+        Climatology.write(str(tmp_path / 'clim.bin'), np.zeros((6, 2, 1, 1, 4)), DEPTH_EDGES)
@@ -0,0 +1,89 @@
+# The Numba kernels (qc_jit) against the NumPy ones of qc_kernels: every loop kernel on synthetic hauls (with NaN,
+# plateaus and hauls stored one after the other), then the flags of QC and QCBatch, must be identical.
+# Run with: python -m pytest tests
+import os
+import sys
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+pytest.importorskip('numba')
+import qc_kernels
+from QC import QC
+from qc_batch import QCBatch
+import synthetic
+
+SEEDS = [0, 1, 2]
+
+
+# Runs function with each backend, returns (numpy result, numba result)
+def both(function):
+    previous = qc_kernels.backend()
+    try:
+        qc_kernels.use(qc_kernels.NUMPY)
+        expected = function()
+        qc_kernels.use(qc_kernels.NUMBA)
+        return expected, function()
+    finally:
+        qc_kernels.use(previous)
+
+
+def inputs(seed):
+    rng = np.random.default_rng(seed)
+    df, meta = synthetic.batch(12, 500, seed=seed, salinity=True)
+    batch = QCBatch(df, meta, tests=['stuck'])
+    temperature, pressure = batch.temperature.copy(), batch.pressure.copy()
+    temperature[rng.integers(0, len(temperature), len(temperature) // 100)] = np.nan
+    pressure[rng.integers(0, len(pressure), len(pressure) // 200)] = np.nan
+    # spikes around the thresholds of the spike test, plateaus for the stuck value test
+    spikes = rng.integers(0, len(temperature), len(temperature) // 50)
+    temperature[spikes] += rng.uniform(-10, 10, len(spikes))
+    for start in rng.integers(0, len(temperature) - 6, 20):
+        temperature[start:start + rng.integers(3, 7)] = temperature[start]
+    where = rng.random(len(pressure)) < 0.5
+    return temperature, pressure, batch.type, batch.group, where
+
+
+def kernels(temperature, pressure, types, group, where):
+    near = qc_kernels.neighbours(temperature, group)
+    return {
+        'direction': lambda: qc_kernels.direction(pressure, where, group),
+        'direction (one haul)': lambda: qc_kernels.direction(pressure[:500], where[:500]),
+        'seg_size': lambda: [qc_kernels.seg_size(pressure[:k], threshold) for k in (0, 1, 100, len(pressure))
+                             for threshold in (np.nan, 50.0, np.nanmax(pressure))],
+        'spike': lambda: qc_kernels.spike(temperature, near, pressure, 6, 2),
+        'stuck': lambda: qc_kernels.stuck(temperature, near, types),
+        'mud': lambda: qc_kernels.mud(temperature, pressure, types, group),
+        'mud (one haul)': lambda: qc_kernels.mud(temperature[:2000], pressure[:2000], types[:2000]),
+        'mud (empty)': lambda: qc_kernels.mud(temperature[:0], pressure[:0], types[:0]),
+    }
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('name', list(kernels(*inputs(0))))
+def test_kernel(name, seed):
+    data = inputs(seed)
+    expected, got = both(lambda: kernels(*data)[name]())
+    assert np.array_equal(np.asarray(expected), np.asarray(got))
+
+
+def assert_same_flags(expected, got):
+    assert list(expected.columns) == list(got.columns)
+    for name in [c for c in expected.columns if c.startswith('flag') or c == 'type']:
+        assert np.array_equal(expected[name].to_numpy(), got[name].to_numpy()), name
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_batch_flags(seed):
+    df, meta = synthetic.batch(40, 400, seed=seed, salinity=True)
+    assert_same_flags(*both(lambda: QCBatch(df, meta).flags))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('mud', [False, True])
+def test_qc_flags(seed, mud):
+    df = synthetic.haul(3000, seed=seed, salinity=True, mud=mud, spikes=5, stuck=2)
+    assert_same_flags(*both(lambda: QC(df.copy(), 'v', 'Mobile', 'North Sea', 'NKE').df))
@@ -0,0 +1,48 @@
+# Position on land test of QC with a small land mask written by LandMask.write, and without any mask.
+# Run with: python -m pytest tests
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+import land_mask
+from land_mask import LandMask
+from QC import QC
+import synthetic
+
+
+@pytest.fixture
+def mask_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'land_mask.bin')
+    monkeypatch.setattr(land_mask, 'DEFAULT_PATH', path)
+    monkeypatch.setattr(land_mask, '_masks', {})
+    return path
+
+
+def run(df):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return QC(df, 'v', 'Mobile', 'North Sea', 'NKE').df
+
+
+def test_land_and_ocean(mask_path):
+    # 1 degree cells, land on the cell from 57N to 56N and 3E to 4E only
+    land = np.zeros((180, 360), dtype=bool)
+    land[90 - 57, 180 + 3] = True
+    LandMask.write(mask_path, land)
+    df = synthetic.haul(400, seed=0)
+    df['LATITUDE'], df['LONGITUDE'] = 56.5, np.where(np.arange(len(df)) < 200, 3.5, 4.5)
+    out = run(df)
+    assert list(np.unique(out['flag_land'][:200])) == [4]
+    assert list(np.unique(out['flag_land'][200:])) == [1]
+
+
+def test_no_mask(mask_path):
+    with pytest.warns(UserWarning, match='land mask'):
+        out = QC(synthetic.haul(400, seed=0), 'v', 'Mobile', 'North Sea', 'NKE').df
+    assert 'flag_land' not in out
@@ -0,0 +1,36 @@
+# QCRunner when every haul of a shard fails: the flags of the other shards are kept, as QCBatch gives them, and the
+# failed hauls reported in errors.
+# Run with: python -m pytest tests
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+from qc_batch import QCBatch
+from qc_parallel import QCRunner
+import synthetic
+
+
+@pytest.mark.parametrize('failed', [[0, 1], [4, 5], [0, 1, 4, 5]])
+def test_failed_shard(failed):
+    df, meta = synthetic.batch(6, 300, seed=0, salinity=True)
+    hauls = [meta.index[i] for i in failed]
+    # temperatures that cannot be read: QCBatch raises on the whole shard, then on each of these hauls
+    df['TEMPERATURE'] = df['TEMPERATURE'].astype(object)
+    df.loc[df['HAUL'].isin(hauls), 'TEMPERATURE'] = 'bad'
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        runner = QCRunner(workers=1, chunk_size=2)
+        flags = runner.run_frame(df, meta)
+        valid = df[~df['HAUL'].isin(hauls)]
+        expected = QCBatch(valid.assign(TEMPERATURE=valid['TEMPERATURE'].astype(float)), meta).flags
+    assert set(runner.errors) == set(hauls)
+    assert list(flags.columns) == list(expected.columns)
+    assert flags.index.equals(expected.index)
+    for name in flags.columns:
+        assert np.array_equal(flags[name].to_numpy(), expected[name].to_numpy()), name
@@ -0,0 +1,60 @@
+# QCProfiler on a small haul: one record per test (the fused tests on their own), rows flagged by each, and the same
+# flags as without a profiler.
+# Run with: python -m pytest tests
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+from QC import QC
+from qc_batch import QCBatch
+from qc_profile import QCProfiler
+import qc_pipeline
+import synthetic
+
+
+def run(profiler=None):
+    df = synthetic.haul(2000, seed=0, salinity=True, mud=True, spikes=8, stuck=3)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return QC(df, 'v', 'Mobile', 'North Sea', 'NKE', profiler=profiler).df
+
+
+@pytest.mark.parametrize('memory', [False, True])
+def test_steps_and_flagged(memory):
+    profiler = QCProfiler(memory=memory)
+    df = run(profiler)
+    steps = [record['step'] for record in profiler.records]
+    assert steps == qc_pipeline.plan(fuse=False) + ['aggregate_flag']
+    assert 'neighbour_tests' not in steps
+    assert {'spike', 'rollover', 'stuck', 'rate_of_change'} <= set(steps)
+    for record in profiler.records:
+        names = [name for name in qc_pipeline.outputs(record['step']) if name in df]
+        assert record['flagged'] == int((df[names] > 1).any(axis=1).sum()) if names else record['flagged'] == 0
+        assert record['rows'] == len(df)
+    assert profiler.summary().loc['spike', 'flagged'] > 0
+
+
+def test_same_flags():
+    expected, got = run(), run(QCProfiler(memory=False))
+    assert list(expected.columns) == list(got.columns)
+    for name in expected.columns:
+        assert np.array_equal(expected[name].to_numpy(), got[name].to_numpy()), name
+
+
+def test_batch():
+    df, meta = synthetic.batch(5, 400, seed=1, salinity=True)
+    profiler = QCProfiler(memory=False)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        flags = QCBatch(df, meta, profiler=profiler).flags
+        expected = QCBatch(df, meta).flags
+    assert [record['step'] for record in profiler.records] == qc_pipeline.plan(fuse=False) + ['aggregate_flag']
+    assert all(record['hauls'] == 5 for record in profiler.records)
+    for name in expected.columns:
+        assert np.array_equal(expected[name].to_numpy(), flags[name].to_numpy()), name
@@ -0,0 +1,55 @@
+# Vessel region test: samples out of the zone are suspect, samples without a position are not flagged (as in the
+# baseline QC, which only looked at the extent of the known positions), in QC, QCBatch, QCChunked and QCStream.
+# Run with: python -m pytest tests
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+from QC import QC
+from qc_batch import QCBatch
+import qc_chunked
+from qc_stream import QCStream
+import synthetic
+
+
+@pytest.fixture
+def haul():
+    df = synthetic.haul(400, seed=0)
+    df.loc[10:19, 'LATITUDE'] = np.nan
+    df.loc[20:29, 'LONGITUDE'] = np.nan
+    # off Greenland
+    df.loc[30:39, ['LATITUDE', 'LONGITUDE']] = 65.0, -40.0
+    expected = np.ones(len(df), dtype=np.uint8)
+    expected[30:40] = 3
+    return df, expected
+
+
+def flags(df, engine, tmp_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if engine == 'QC':
+            return QC(df.copy(), 'v', 'Mobile', 'North Sea', 'NKE').df['flag_vessel_region']
+        if engine == 'QCBatch':
+            meta = dict(vessel='v', gear_type='Mobile', zone='North Sea', sensor_type='NKE')
+            return QCBatch(df, meta, key=None).flags['flag_vessel_region']
+        if engine == 'QCChunked':
+            path, output = str(tmp_path / 'haul.parquet'), str(tmp_path / 'flags.parquet')
+            df.to_parquet(path, index=False)
+            qc_chunked.run(path, 'v', 'Mobile', 'North Sea', 'NKE', output, chunk_size=100)
+            return pd.read_parquet(output)['flag_vessel_region']
+        stream = QCStream('v', 'Mobile', 'North Sea', 'NKE')
+        out = pd.concat([stream.push(df.iloc[i:i + 50]) for i in range(0, len(df), 50)] + [stream.close()])
+        return out[out['final']].sort_index()['flag_vessel_region']
+
+
+@pytest.mark.parametrize('engine', ['QC', 'QCBatch', 'QCChunked', 'QCStream'])
+def test_missing_positions(haul, engine, tmp_path):
+    df, expected = haul
+    np.testing.assert_array_equal(flags(df, engine, tmp_path).to_numpy(), expected)
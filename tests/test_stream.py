@@ -0,0 +1,39 @@
+# QCStream.push with no samples: an empty result with the columns of any other push, and the stream unchanged.
+# Run with: python -m pytest tests
+import os
+import sys
+import warnings
+
+import pandas as pd
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+from qc_stream import QCStream
+import synthetic
+
+
+def stream(df, empty=None):
+    qc = QCStream('v', 'Mobile', 'North Sea', 'NKE', salinity=True)
+    out = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for start in range(0, len(df), 7):
+            if empty is not None:
+                result = qc.push(empty)
+                assert len(result) == 0
+                out.append(result)
+            out.append(qc.push(df.iloc[start:start + 7]))
+        out.append(qc.close())
+    return out
+
+
+@pytest.mark.parametrize('empty', [pd.DataFrame(), 'slice', []])
+def test_empty_push(empty):
+    df = synthetic.haul(300, seed=0, salinity=True)
+    expected = stream(df)
+    got = stream(df, df.iloc[0:0] if isinstance(empty, str) else empty)
+    columns = list(expected[0].columns)
+    assert all(list(result.columns) == columns for result in got)
+    assert pd.concat(got[1::2] + got[-1:]).equals(pd.concat(expected))
@@ -0,0 +1,137 @@
+import json
+import os
+
+import numpy as np
+
+# Registry of the operating regions of the vessels, for the vessel ID control test.
+# The regions are (multi)polygons of a GeoJSON file, one feature per region named by its 'name' property, so new
+# regions or finer outlines only need a data change. A region can overlap others: a position is in every region that
+# contains it (boundaries included), so no region shadows another.
+# Lookups go through a grid index of resolution-degree cells storing, as 64 bit masks, the regions covering the whole
+# cell and the regions whose outline crosses it. Only the positions in a crossed cell get an exact point in polygon
+# test, so classifying positions costs one cell lookup each, whatever the number of hauls and regions.
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regions.geojson')
+
+
+class RegionRegistry(object):
+    def __init__(self, path=DEFAULT_PATH, resolution=1.0):
+        with open(path) as f:
+            features = json.load(f)['features']
+        self.names = []
+        self.polygons = []  # (region number, rings as (lon, lat) arrays)
+        for feature in features:
+            name = feature['properties']['name']
+            if name not in self.names:
+                self.names.append(name)
+            geometry = feature['geometry']
+            polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+            for rings in polygons:
+                self.polygons.append((self.names.index(name), [np.asarray(ring, dtype=float) for ring in rings]))
+        if len(self.names) > 64:
+            raise ValueError('%s: at most 64 regions, got %d' % (path, len(self.names)))
+
+        self.resolution = resolution
+        self.rows, self.columns = int(np.ceil(180 / resolution)), int(np.ceil(360 / resolution))
+        self.inside = np.zeros(self.rows * self.columns, dtype=np.uint64)  # regions covering the whole cell
+        self.partial = np.zeros(self.rows * self.columns, dtype=np.uint64)  # regions crossing the cell
+        for region, rings in self.polygons:
+            self._index(self._bit(region), rings)
+
+    # Bit mask of the regions containing every position
+    def membership(self, latitude, longitude):
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        valid = (latitude >= -90) & (latitude <= 90) & (longitude >= -180) & (longitude <= 180)
+        cell = self._cell(np.where(valid, latitude, 0), np.where(valid, longitude, 0))
+        bits = np.where(valid, self.inside[cell], np.uint64(0))
+        partial = np.where(valid, self.partial[cell], np.uint64(0))
+        for region, rings in self.polygons:
+            bit = self._bit(region)
+            rows = np.flatnonzero(partial & bit)
+            if len(rows):
+                rows = rows[_contains(rings, latitude[rows], longitude[rows])]
+                bits[rows] |= bit
+        return bits
+
+    # Bit mask of each zone name, 0 for a name not in the registry
+    def bits(self, zones):
+        return np.array([self._bit(self.names.index(zone)) if zone in self.names else 0 for zone in zones],
+                        dtype=np.uint64)
+
+    # True where the position is in the zone; zone is a name, or one name per position
+    def contains(self, zone, latitude, longitude):
+        bits = self.bits([zone])[0] if isinstance(zone, str) else self.bits(zone)
+        return (self.membership(latitude, longitude) & bits) != 0
+
+    # True where the position is known and out of the zone; a missing (NaN) position is not out of it, as QC only
+    # ever flagged the positions it had
+    def outside(self, zone, latitude, longitude):
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        return ~self.contains(zone, latitude, longitude) & ~np.isnan(latitude) & ~np.isnan(longitude)
+
+    # Table of positions x regions, True where the position is in the region
+    def classify(self, latitude, longitude):
+        bits = self.membership(latitude, longitude)
+        return (bits[:, None] & self.bits(self.names)[None, :]) != 0
+
+    @staticmethod
+    def _bit(region):
+        return np.uint64(1) << np.uint64(region)
+
+    def _cell(self, latitude, longitude):
+        row = np.clip(np.floor((90 - latitude) / self.resolution), 0, self.rows - 1).astype(np.int64)
+        column = np.clip(np.floor((longitude + 180) / self.resolution), 0, self.columns - 1).astype(np.int64)
+        return row * self.columns + column
+
+    def _index(self, bit, rings):
+        # cells crossed by the outline, sampled every quarter of a cell along every edge, and their neighbours
+        crossed = []
+        for ring in rings:
+            for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+                steps = int(np.ceil(max(abs(x1 - x0), abs(y1 - y0)) * 4 / self.resolution)) + 1
+                crossed.append(self._cell(np.linspace(y0, y1, steps + 1), np.linspace(x0, x1, steps + 1)))
+        crossed = np.unique(np.concatenate(crossed))
+        row, column = np.divmod(crossed, self.columns)
+        row = np.clip(row[:, None] + np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1]), 0, self.rows - 1)
+        column = np.clip(column[:, None] + np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1]), 0, self.columns - 1)
+        crossed = np.unique(row * self.columns + column)
+        self.partial[crossed] |= bit
+
+        # every other cell of the bounding box is either fully in or fully out: its centre tells which
+        points = np.concatenate(rings)
+        first, last = self._cell(points[:, 1].max(), points[:, 0].min()), self._cell(points[:, 1].min(),
+                                                                                      points[:, 0].max())
+        rows = np.arange(first // self.columns, last // self.columns + 1)
+        columns = np.arange(first % self.columns, last % self.columns + 1)
+        cells = (rows[:, None] * self.columns + columns[None, :]).ravel()
+        cells = cells[~np.isin(cells, crossed)]
+        row, column = np.divmod(cells, self.columns)
+        centre = _contains(rings, 90 - (row + 0.5) * self.resolution, (column + 0.5) * self.resolution - 180)
+        self.inside[cells[centre]] |= bit
+
+
+# Point in polygon (even-odd rule over all the rings, so holes are excluded); points on an edge are inside
+def _contains(rings, latitude, longitude):
+    inside = np.zeros(len(latitude), dtype=bool)
+    edge = np.zeros(len(latitude), dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for ring in rings:
+            for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+                inside ^= ((y0 > latitude) != (y1 > latitude)) & (
+                        longitude < (x1 - x0) * (latitude - y0) / (y1 - y0) + x0)
+                edge |= (np.abs((x1 - x0) * (latitude - y0) - (y1 - y0) * (longitude - x0)) <= 1e-9) & (
+                        np.minimum(x0, x1) <= longitude) & (longitude <= np.maximum(x0, x1)) & (
+                        np.minimum(y0, y1) <= latitude) & (latitude <= np.maximum(y0, y1))
+    return inside | edge
+
+
+_registries = {}
+
+
+# Registry shared by every QC of the process, read on first use
+def load(path=DEFAULT_PATH):
+    if path not in _registries:
+        _registries[path] = RegionRegistry(path)
+    return _registries[path]